@@ -0,0 +1,133 @@
+from array import array
+import adafruit_led_animation.color as C
+from JH_Sched import ticks_ms
+
+_MASK = 0x1FFFFFFF  # ticks_ms wraps at 2**29
+
+class Animator:
+    ''' Runs keyframe animations on a PixelMap without blocking. Each animation tweens linearly through a tuple of
+        colours spread evenly over 'duration' seconds and is applied to an index of the map in RASTER mode, so an
+        animation may cover a single key or any group of keys. A keyframe of None stands for the colour the first
+        of the pixels has when the animation first runs. Animation state lives in arrays sized by 'slots' when the
+        Animator is made, starting an animation only fills a slot, and nothing is painted until 'update' is
+        called from the main loop. 'update' advances every running animation to the current time and refreshes
+        the strips, but gives up after 'budget' seconds (timed to the ms) and carries on from the next slot on the
+        following call. It leaves the PixelMap indexing as the caller set it. Times are kept on the wrapping
+        ticks_ms clock, so animations run indefinitely and timing them allocates nothing.
+        Starting an animation on an index that already has one replaces it, so repeated events do not pile up.
+        When every slot is busy the oldest animation is dropped.
+    '''
+    def __init__(self, pixels, slots=16, budget=0.002):
+        self._pixels = pixels
+        self._n = slots
+        self._budget = int(budget * 1000)
+        self._start = array('l', (0 for i in range(slots)))
+        self._dur = array('l', (1 for i in range(slots)))
+        self._loop = bytearray(slots)
+        self._active = bytearray(slots)
+        self._ix = [None] * slots
+        self._frames = [None] * slots
+        self._next = 0
+        self.dropped = 0
+
+    def play(self, ix, frames, duration, loop=False):
+        ''' Starts an animation through 'frames' on the pixels addressed by 'ix' and returns its slot number.
+        '''
+        if isinstance(ix, list): ix = tuple(ix)
+        sl = self._slot(ix)
+        self._ix[sl] = ix
+        self._frames[sl] = frames
+        self._start[sl] = ticks_ms()
+        self._dur[sl] = max(int(duration * 1000), 1)
+        self._loop[sl] = 1 if loop else 0
+        self._active[sl] = 1
+        return sl
+
+    def _slot(self, ix):
+        for i in range(self._n):
+            if self._active[i] and self._ix[i] == ix: return i
+        for i in range(self._n):
+            if not self._active[i]: return i
+        now = ticks_ms()
+        sl = 0
+        for i in range(1, self._n):
+            if ((now - self._start[i]) & _MASK) > ((now - self._start[sl]) & _MASK): sl = i
+        self.dropped += 1
+        return sl
+
+    def _free(self, sl):
+        self._active[sl] = 0
+        self._ix[sl] = None
+        self._frames[sl] = None
+
+    def fade(self, ix, color, duration=0.15):
+        ''' Fades the pixels addressed by 'ix' from their present colour to 'color'.
+        '''
+        return self.play(ix, (None, color), duration)
+
+    def pulse(self, ix, color, period=1.0):
+        ''' Pulses the pixels addressed by 'ix' between black and 'color' until stopped or replaced.
+        '''
+        return self.play(ix, (C.BLACK, color, C.BLACK), period, True)
+
+    def stop(self, ix=None):
+        ''' Stops the animation on 'ix', or all animations, leaving the pixels as they are.
+        '''
+        if isinstance(ix, list): ix = tuple(ix)
+        for i in range(self._n):
+            if ix is None or self._ix[i] == ix: self._free(i)
+
+    @property
+    def running(self):
+        n = 0
+        for a in self._active: n += a
+        return n
+
+    def _color(self, sl, t):
+        fr = self._frames[sl]
+        d = self._dur[sl]
+        if t >= d:
+            if not self._loop[sl]: return fr[-1], True
+            t %= d
+        p = t * (len(fr) - 1)
+        seg = p // d
+        f = ((p - seg * d) << 8) // d
+        a, b = fr[seg], fr[seg + 1]
+        return tuple(a[i] + (((b[i] - a[i]) * f) >> 8) for i in range(len(a))), False
+
+    def update(self):
+        ''' Advances the running animations and refreshes the pixels. Call periodically from the main loop.
+        '''
+        px = self._pixels
+        st = px.indexing_state
+        px.indexing(auto_update=False)
+        now = ticks_ms()
+        for k in range(self._n):
+            sl = (self._next + k) % self._n
+            if not self._active[sl]: continue
+            if self._frames[sl][0] is None:
+                c = px[self._ix[sl]]
+                if isinstance(c, list): c = c[0]
+                self._frames[sl] = (c,) + tuple(self._frames[sl][1:])
+            c, done = self._color(sl, (now - self._start[sl]) & _MASK)
+            px[self._ix[sl]] = c
+            if done: self._free(sl)
+            if self._budget and ((ticks_ms() - now) & _MASK) >= self._budget:
+                self._next = (sl + 1) % self._n
+                break
+        else:
+            self._next = 0
+        px.indexing(*st)
+        px.show()
+'''
+import time, board, neopixel
+from JH_PixelMap import PixelMap
+from JH_Anim import Animator
+pm = PixelMap(neopixel.NeoPixel(board.D5, 48, auto_write=False), ((36,37,38,39),(35,34,33,32)))
+an = Animator(pm)
+an.pulse(0, (255, 0, 0), 2.0)
+an.fade([5, 6, 7], (0, 0, 255), 1.0)
+while True:
+    an.update()
+    time.sleep(0.02)
+'''
@@ -0,0 +1,103 @@
+import gc
+from JH_Sched import ticks_ms
+try:
+    import tracemalloc  # CPython only, used when the firmware runs on a host
+except ImportError:
+    tracemalloc = None
+
+class HeapMonitor:
+    ''' Measures heap use by the main loop and optionally takes garbage collection out of the key path.
+        'check' is called once per main loop iteration, with 'idle' True when no keys are down and no output is
+        waiting. It records the bytes allocated since the last iteration and counts a collection whenever the
+        heap shrinks. The firmware cannot time an automatic collection, so 'max_iteration' (the longest gap
+        between checks) is the bound to watch for those; collections made here are timed directly. Times are in
+        ms on the wrapping supervisor.ticks_ms clock, whose values are small integers, so that timing the loop
+        does not itself allocate.
+        With 'manual' True automatic collection is disabled and 'check' collects only when idle with at least
+        'idle_bytes' allocated since the last collection, or at once if free heap falls below 'threshold'. With
+        automatic collection disabled an allocation that does not fit raises MemoryError, so 'threshold' must
+        leave room for the most any iteration allocates.
+    '''
+    def __init__(self, manual=False, threshold=16384, idle_bytes=4096):
+        self.manual = manual
+        self.threshold = threshold
+        self.idle_bytes = idle_bytes
+        self.reset()
+        if manual: gc.disable()
+
+    @staticmethod
+    def _alloc():
+        if hasattr(gc, "mem_alloc"): return gc.mem_alloc()
+        if tracemalloc is not None and tracemalloc.is_tracing(): return tracemalloc.get_traced_memory()[0]
+        return 0
+
+    @staticmethod
+    def _free():
+        return gc.mem_free() if hasattr(gc, "mem_free") else None
+
+    def reset(self):
+        self.iterations = 0
+        self.allocated = 0
+        self.max_alloc = 0
+        self.collections = 0
+        self.auto_collections = 0
+        self.max_pause = 0
+        self.max_iteration = 0
+        self._last = HeapMonitor._alloc()
+        self._since = 0
+        self._t = ticks_ms()
+
+    def check(self, idle=False):
+        t = ticks_ms()
+        dt = (t - self._t) & 0x1FFFFFFF
+        if dt > self.max_iteration: self.max_iteration = dt
+        a = HeapMonitor._alloc()
+        d = a - self._last
+        if d < 0:
+            self.auto_collections += 1
+            self._since = 0
+        else:
+            self.allocated += d
+            self._since += d
+            if d > self.max_alloc: self.max_alloc = d
+        self.iterations += 1
+        self._last = a
+        if self.manual:
+            f = HeapMonitor._free()
+            if (idle and self._since >= self.idle_bytes) or (f is not None and f < self.threshold): self.collect()
+        self._t = ticks_ms()
+
+    def collect(self):
+        t = ticks_ms()
+        gc.collect()
+        t = (ticks_ms() - t) & 0x1FFFFFFF
+        self.collections += 1
+        if t > self.max_pause: self.max_pause = t
+        self._last = HeapMonitor._alloc()
+        self._since = 0
+
+    @property
+    def stats(self):
+        return dict(
+            iterations=self.iterations, allocated=self.allocated, max_alloc=self.max_alloc,
+            collections=self.collections, auto_collections=self.auto_collections,
+            max_pause_ms=self.max_pause, max_iteration_ms=self.max_iteration,
+            free=HeapMonitor._free()
+        )
+
+    def report(self):
+        s = self.stats
+        print(f"Heap: {s['iterations']} loops, {s['allocated']} bytes allocated (max {s['max_alloc']}/loop), "
+              f"{s['collections']} collections (max {s['max_pause_ms']} ms), {s['auto_collections']} automatic, "
+              f"longest loop {s['max_iteration_ms']} ms, {s['free']} free")
+'''
+import time
+from JH_Heap import HeapMonitor
+heap = HeapMonitor(manual=True)
+junk = []
+for i in range(2000):
+    junk = [bytearray(64) for j in range(8)]
+    heap.check(idle=i % 100 == 0)
+    time.sleep(0.001)
+heap.report()
+'''
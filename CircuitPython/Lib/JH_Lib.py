@@ -1,8 +1,16 @@
+from array import array
+
 class Enum:
     ''' Base Class for mutable enumerated types.
+        Each subclass gets an index of its states, giving the name and an ordinal of each, built the first time it
+        is needed (CircuitPython has no __init_subclass__ to do it at class creation) or at once by decorating the
+        subclass with '@Enum.register'. Name and ordinal lookups are then a single dictionary access. Ordinals
+        number the states from 0 in the order the class dictionary lists them, which is only guaranteed to be
+        definition order under CPython, so use them as compact keys rather than to rank states.
+        Comparisons are by identity of the state: 'enum.state is Class.state' is the fastest test.
     '''
     def __init__(self, init_state):
-        self.state_name(init_state)
+        if init_state not in Enum._index(type(self)): raise RuntimeError(f"State must be a method of {type(self)}")
         self.state = init_state
 
     def __repr__(self):
@@ -17,27 +25,50 @@ class Enum:
         self.state = val
 
     def __eq__(self, other):
-        if isinstance(other, Enum):
-            return self.state is other.state
-        else:
-            return self.state is other
+        return self.state is (other.state if isinstance(other, Enum) else other)
 
     @staticmethod
     def v():
         def f(*p,**k): pass
         return f
 
+    @staticmethod
+    def _index(cls):
+        ''' Returns the {state: (ordinal, name)} index of 'cls', building it on first use.
+        '''
+        ix = cls.__dict__.get("_states")
+        if ix is None:
+            ix = {}
+            for k,v in cls.__dict__.items():
+                if callable(v) and not k.startswith("_") and v not in ix: ix[v] = (len(ix), k)
+            cls._states = ix
+        return ix
+
+    @staticmethod
+    def register(cls):
+        ''' Class decorator which builds the state index when the class is defined.
+        '''
+        Enum._index(cls)
+        return cls
+
     def state_name(p1, p2=None):
         cls = p1 if isinstance(p1, type) else type(p1)
         state = p2 if p2 is not None else p1.state
-        if callable(state):
-            for k,v in cls.__dict__.items():
-                if state is v and not k.startswith("_"): return k
-        raise RuntimeError(f"State must be a method of {cls}")
+        e = Enum._index(cls).get(state) if callable(state) else None
+        if e is None: raise RuntimeError(f"State must be a method of {cls}")
+        return e[1]
 
     @classmethod
     def class_state_name(cls, state):
         return cls.state_name(cls, state)
+
+    @property
+    def ordinal(self):
+        return Enum._index(type(self))[self.state][0]
+
+    @classmethod
+    def class_ordinal(cls, state):
+        return Enum._index(cls)[state][0]
 '''
 class MyEnum(Enum):
     monday = Enum.v()
@@ -51,6 +82,7 @@ print(MyEnum.state_name(MyEnum, MyEnum.wednesday))
 print(MyEnum.class_state_name(MyEnum.wednesday))
 day2 = MyEnum(MyEnum.wednesday)
 print(day1, day2, day1 == day2, day1 == MyEnum.tuesday)
+print(day1.ordinal, MyEnum.class_ordinal(MyEnum.wednesday))
 day1[:] = MyEnum.wednesday
 print(day1, day2, day1 == day2, day1 == MyEnum.tuesday)
 '''
@@ -127,10 +159,10 @@ class BitField:
         return self.__str__()
 
     def __index__(self):
-        return self.__int__
+        return self.__int__()
 
     def __eq__(self, other):
-        return self.__int__ == int(other)
+        return self.__int__() == int(other)
 
     def __getitem__(self, ix):
         st, sp = self._normix(ix)
@@ -158,15 +190,15 @@ class BitField:
             else: val = 0
             fs = False
         else:
-            val = int(val)
+            val = int(val) << (st % 8)
         for i in range(stb, spb + 1):
             src_byte = val & 0xFF
             if fs: val >>= 8
-            msk = 0xFF
+            msk = 0
             if i == stb:
-                src_byte <<= (st % 8)
+                if not fs: src_byte <<= (st % 8)
                 src_byte &= 0xFF
-                msk &= 2 ** (st % 8) - 1
+                msk = 2 ** (st % 8) - 1
             if i == spb:
                 m = 2 ** (sp % 8 + 1) - 1
                 src_byte &= m
@@ -242,6 +274,65 @@ for w in myfield: print(BitField.bin(w, 8), end=', ')
 print()
 '''
 
+class SmallBitField(BitField):
+    ''' BitField of up to 32 bits held as a single integer rather than a bytearray. Indexing is a shift and a mask
+        from a precomputed table instead of a loop over bytes, so fields of up to 30 bits (the CircuitPython small
+        integer range) are read and written with integer and tuple indices without any heap allocation.
+    '''
+    MASKS = tuple(2 ** n - 1 for n in range(33))
+
+    def __init__(self, width, field=False, word=None):
+        self.width = int(width)
+        if self.width > 32: raise ValueError("SmallBitField is limited to 32 bits")
+        self._v = 0
+        self.__setitem__((0,self.width), field)
+        if word: self.word = word
+
+    def __int__(self):
+        return self._v
+
+    def __bool__(self):
+        return self._v != 0
+
+    def __bytes__(self):
+        return self._v.to_bytes((self.width + 7) // 8, "little")
+
+    def __getitem__(self, ix):
+        if type(ix) is int:
+            if ix < 0: ix += self.width
+            if ix < 0 or ix >= self.width: raise IndexError(f"Invalid Bitfield index {ix}")
+            return (self._v >> ix) & 1
+        if type(ix) is tuple:
+            st, sp = ix
+            if st < 0 or sp > self.width or sp <= st: raise IndexError(f"Invalid Bitfield index {st}, {sp}")
+        else:
+            st, sp = self._normix(ix)
+        return (self._v >> st) & self.MASKS[sp - st]
+
+    def __setitem__(self, ix, val):
+        if type(ix) is int:
+            if ix < 0: ix += self.width
+            if ix < 0 or ix >= self.width: raise IndexError(f"Invalid Bitfield index {ix}")
+            st, sp = ix, ix + 1
+        elif type(ix) is tuple:
+            st, sp = ix
+            if st < 0 or sp > self.width or sp <= st: raise IndexError(f"Invalid Bitfield index {st}, {sp}")
+        else:
+            st, sp = self._normix(ix)
+        m = self.MASKS[sp - st]
+        if isinstance(val, bool):
+            val = m if val else 0
+        else:
+            val = int(val) & m
+        self._v = (self._v & ~(m << st)) | (val << st)
+'''
+chord = SmallBitField(4, 0b0110)
+chord[0] = 1
+print(chord, int(chord), chord[1], chord[(1,3)], chord[2:], bytes(chord))
+chord[:] = False
+print(chord, bool(chord), chord == 0)
+'''
+
 class IMap:
     ''' Tuple with configurable base index and defaults for index under, index over and value None.
     '''
@@ -281,12 +372,19 @@ for i in range(-1,4): print(mymap[i], end=', ')
 class Cont:
     ''' Base Class for classes used as dictionary-like container were elements are member variables.
         Efficient for storage of a fixed set of variables or constants with mainly forward lookup.
-        Inefficient reverse lookup is provided primarily for diagnostic and debug reports.
+        Reverse lookup is provided primarily for diagnostic and debug reports. Integer values are found by binary
+        search of an index (a sorted array of values with the matching names) built for the classes searched on
+        first use, so it costs nothing until diagnostics need it. Other values are found by scanning.
     '''
+    _indexes = {}
+
     @classmethod
     def nameof(cls, val):
         ''' Reverse lookup in the class
         '''
+        if type(val) is int:
+            c, k = Cont._find((cls,), val)
+            return val if c is None else k
         for k,v in cls.__dict__.items():
             if v == val: return k
         return val
@@ -295,10 +393,40 @@ class Cont:
     def namein(clss, val):
         ''' Reverse lookup over a list of classes sharing this base
         '''
+        if type(val) is int:
+            c, k = Cont._find(tuple(clss), val)
+            return val if c is None else f"{c.__name__}.{k}"
         for cls in clss:
             for k,v in cls.__dict__.items():
                 if v == val: return f"{cls.__name__}.{k}"
         return val
+
+    @staticmethod
+    def _index(clss):
+        ''' Returns (values, class numbers, names) for the integer members of 'clss', sorted by value. Where a
+            value occurs more than once the member a scan would find first is kept.
+        '''
+        ix = Cont._indexes.get(clss)
+        if ix is not None: return ix
+        first = {}
+        for ci in range(len(clss)):
+            for k,v in clss[ci].__dict__.items():
+                if type(v) is int and -0x80000000 <= v <= 0x7FFFFFFF and v not in first: first[v] = (ci, k)
+        vals = sorted(first)
+        ix = (array('l', vals), bytearray(first[v][0] for v in vals), tuple(first[v][1] for v in vals))
+        Cont._indexes[clss] = ix
+        return ix
+
+    @staticmethod
+    def _find(clss, val):
+        vals, cls, names = Cont._index(clss)
+        lo, hi = 0, len(vals)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if vals[mid] < val: lo = mid + 1
+            else: hi = mid
+        if lo < len(vals) and vals[lo] == val: return clss[cls[lo]], names[lo]
+        return None, None
 '''
 class D1(Cont):
     ONE = 1
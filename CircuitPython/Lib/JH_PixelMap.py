@@ -1,3 +1,5 @@
+from array import array
+from JH_Sched import ticks_ms
 from random import randint as rand
 import adafruit_led_animation.color as C
 try:
@@ -8,23 +10,40 @@ try:
     from adafruit_dotstar import DotStar
 except ImportError:
     DotStar = None
+try:
+    from neopixel_write import neopixel_write
+except ImportError:
+    neopixel_write = None
 if NeoPixel == None and DotStar == None: raise ImportError("Neither NeoPixel nor DotStar libraries available")
 
 class PixelMap:
-    def __init__(self, strips, map, strip_period=1):
-        if isinstance(strips, NeoPixel) or isinstance(strips, DotStar):
+    ''' Maps a rectangular or linear layout onto one or more NeoPixel or DotStar strips. Writes which change a pixel
+        mark its strip dirty and 'show' pushes only dirty strips, at most once per 'frame_period' seconds. A 'show'
+        that arrives too soon leaves the frame pending for a later call, so 'show' should be called periodically.
+        With 'framebuffer' True, pixels are kept in one preallocated bytearray in the strips' byte order with
+        brightness already applied, and 'show' copies each dirty strip's slice into the strip's 'buf' in one go.
+        A second bytearray of the same layout holds the colours as written, so reading a pixel returns the colour
+        set, as it does without the framebuffer, and a brightness change rescales every pixel. Brightness is
+        applied through a 256 entry table. Colours are converted once per operation rather than once per pixel,
+        which makes the bulk operations (fill_rect, fill_rows, fill_cols, blit, blend) cheap. This needs strips
+        whose 'buf' property gives direct access to the transmitted bytes, as the CircuitPython core NeoPixel and
+        DotStar do.
+        Each strip is a shard: the strip and offset of every map position are looked up in tables built at
+        construction, and with several strips the pixels of strip 's' are numbered from s * 'strip_period' (or
+        from s times the longest strip if greater). With the framebuffer, each dirty shard is sent straight from
+        its part of the framebuffer in one write, by neopixel_write for a NeoPixel or to the SPI bus for a
+        DotStar on hardware SPI, with no copy through the strip's own buffer. Other strips are copied and shown.
+        Only dirty shards are sent, so a frame touching one chain of several costs one chain's time.
+    '''
+    def __init__(self, strips, map, strip_period=1, frame_period=0, framebuffer=False):
+        if PixelMap._kind(strips) is not None:
             self._pixels = [strips]
         else:
             self._pixels = [s for s in strips]
-        if isinstance(self._pixels[0], NeoPixel):
-            np = True
-        elif not isinstance(self._pixels[0], DotStar):
-            raise TypeError("Strips is not NeoPixel or DotStar")
+        kind = PixelMap._kind(self._pixels[0])
+        if kind is None: raise TypeError("Strips is not NeoPixel or DotStar")
         for s in self._pixels:
-            if np and not isinstance(s, NeoPixel):
-                raise TypeError("Strips must be the same type")
-            if not np and not isinstance(s, DotStar):
-                raise TypeError("Strips must be the same type")
+            if PixelMap._kind(s) is not kind: raise TypeError("Strips must be the same type")
         if len(self._pixels) > 1:
             self._sp = 1
             for p in self._pixels: self._sp = p.n if p.n > self._sp else self._sp
@@ -32,15 +51,133 @@ class PixelMap:
         else:
             self._sp = 0
         if isinstance(map[0], int):
-            self._map = [[v] for v in map]
+            self._map = list(map)
             self._rl = len(self._map)
         else:
             self._rl = len(map[0])
             self._map = []
             for r in map:
                 for c in r: self._map.append(c)
+        self._fp = int(frame_period * 1000)  # ms, on the wrapping ticks_ms clock
+        self._last = None
+        self._dlo = [p.n for p in self._pixels]
+        self._dhi = [-1 for p in self._pixels]
+        self.shows = 0
+        self._plans = ({}, {}, {}, {})
+        self._bplans = {}
+        self._fb = None
+        self._shard()
+        if framebuffer: self._framebuffer()
         self.indexing()
 
+    @staticmethod
+    def _kind(s):
+        if NeoPixel is not None and isinstance(s, NeoPixel): return NeoPixel
+        if DotStar is not None and isinstance(s, DotStar): return DotStar
+        return None
+
+    def _shard(self):
+        ''' Builds the strip ('_ps', 0xFF for no pixel) and offset in the strip ('_po') of every map position.
+        '''
+        n = len(self._map)
+        self._ps = bytearray(n)
+        self._po = array('H', (0 for i in range(n)))
+        for i in range(n):
+            x = self._map[i]
+            if x is None:
+                self._ps[i] = 0xFF
+                continue
+            si = x // self._sp if self._sp > 0 else 0
+            x -= si * self._sp
+            if si >= len(self._pixels) or x >= self._pixels[si].n: raise IndexError(f"No pixel {self._map[i]} in strips")
+            self._ps[i] = si
+            self._po[i] = x
+
+    def _framebuffer(self):
+        bo = getattr(self._pixels[0], "byteorder", "GRB")
+        self._bo = tuple("RGBW".find(ch) for ch in bo)  # -1 marks a DotStar brightness byte, sent as 0xFF
+        self._bpp = len(bo)
+        self._base = []
+        self._tx = []  # Per strip: the function sending its shard, or None to copy into 'buf' and show
+        frames = []
+        n = 0
+        for p in self._pixels:
+            pre = post = 0
+            tx = None
+            kind = PixelMap._kind(p)
+            if neopixel_write is not None and kind is NeoPixel and hasattr(p, "pin"):
+                tx = PixelMap._npw(p.pin)
+            elif kind is DotStar and getattr(p, "_spi", None) is not None:
+                tx = p._spi.write
+                pre, post = 4, p.n // 16 + 1  # Start frame of zeros and end frame of ones around the pixels
+            else:
+                b = p.buf
+                b[0] ^= 0xFF
+                ok = p.buf[0] == b[0]
+                b[0] ^= 0xFF
+                if not ok or len(b) < p.n * self._bpp:
+                    raise TypeError("Strip buf is not writable, framebuffer needs the core NeoPixel or DotStar")
+            self._tx.append(tx)
+            self._base.append(n + pre)
+            frames.append((n, pre, post))
+            n += pre + p.n * self._bpp + post
+        self._fb = bytearray(n)
+        self._fbv = memoryview(self._fb)
+        self._cb = bytearray(n)  # Unscaled colours, laid out as '_fb'
+        self._cbv = memoryview(self._cb)
+        self._lut = bytearray(256)
+        self._bufs = [p.buf for p in self._pixels]
+        self._views = []  # Per strip: what is sent, framing included
+        for i in range(len(self._pixels)):
+            o, pre, post = frames[i]
+            n = self._pixels[i].n * self._bpp
+            self._views.append(self._fbv[o:o + pre + n + post])
+            self._fbv[o + pre + n:o + pre + n + post] = b"\xff" * post
+            self._fbv[self._base[i]:self._base[i] + n] = self._bufs[i][:n]
+        self._fo = array('L', (0 if self._ps[i] == 0xFF else self._base[self._ps[i]] + self._po[i] * self._bpp
+                               for i in range(len(self._map))))
+        self._scale(False)
+        for m in range(len(self._map)):
+            if self._ps[m] != 0xFF: self._put(m, self._pack(self._pixels[self._ps[m]][self._po[m]]))
+
+    def _scale(self, rescale=True):
+        ''' Rebuilds the brightness table for the current brightness and, if 'rescale', the framebuffer from the
+            colours.
+        '''
+        br = self._pixels[0].brightness
+        for v in range(256): self._lut[v] = int(v * br)
+        if not rescale: return
+        fb, cb, lut, bpp = self._fb, self._cb, self._lut, self._bpp
+        for s in range(len(self._pixels)):
+            b = self._base[s]
+            for o in range(b, b + self._pixels[s].n * bpp, bpp):
+                for i in range(bpp):
+                    if self._bo[i] >= 0: fb[o + i] = lut[cb[o + i]]
+
+    @staticmethod
+    def _npw(pin):
+        return lambda buf: neopixel_write(pin, buf)
+
+    def _pack(self, c):
+        ''' Converts a colour tuple or 0xRRGGBB integer into framebuffer bytes, unscaled then with brightness applied.
+        '''
+        if isinstance(c, int): c = ((c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF)
+        n = self._bpp
+        b = bytearray(2 * n)
+        for i in range(n):
+            ch = self._bo[i]
+            v = 0xFF if ch < 0 else c[ch] if ch < len(c) else 0
+            b[i] = v
+            b[n + i] = v if ch < 0 else self._lut[v]
+        return b
+
+    def _unpack(self, o):
+        c = [0, 0, 0, 0]
+        for i in range(self._bpp):
+            ch = self._bo[i]
+            if ch >= 0: c[ch] = self._cb[o + i]
+        return tuple(c[:4 if self._bpp == 4 and -1 not in self._bo else 3])
+
     RASTER = 0
     ZIGZAG = 1
     ROWS = 2
@@ -50,11 +187,54 @@ class PixelMap:
     BOUNCE = 1
     RAND = 2
 
+    PLAN_CACHE = 32  # Index plans kept per (index_mode, inner_slice) before the cache is cleared
+    NO_PIXEL = 0xFFFF  # Plan entry for a map position with no pixel
+
     def indexing(self, index_mode=None, inner_slice=None, val_mode=None, auto_update=True):
         self._im = index_mode if index_mode in (PixelMap.RASTER, PixelMap.ZIGZAG, PixelMap.ROWS, PixelMap.COLUMNS) else PixelMap.RASTER
         self._is = inner_slice if isinstance(inner_slice, slice) else None
         self._vm = val_mode if val_mode in (PixelMap.RING, PixelMap.BOUNCE, PixelMap.RAND) else PixelMap.RING
         self._au = auto_update == True
+        isk = None if self._is is None else (self._is.start, self._is.stop, self._is.step)
+        self._pt = self._plans[self._im].get(isk)
+        if self._pt is None:
+            self._pt = {}
+            self._plans[self._im][isk] = self._pt
+
+    @property
+    def indexing_state(self):
+        ''' The current (index_mode, inner_slice, val_mode, auto_update), which 'indexing(*state)' restores.
+        '''
+        return self._im, self._is, self._vm, self._au
+
+    def _plan(self, ix):
+        ''' Returns the map positions of the pixels addressed by 'ix' under the current indexing as an array('H'),
+            built on first use and cached so that repeated patterns cost a dictionary lookup. A tuple of indices is
+            its own key. A list, which cannot be a key without copying it, is planned afresh on every call, so
+            index repeatedly with tuples.
+        '''
+        k = ix
+        if type(ix) is list:
+            return array('H', (PixelMap.NO_PIXEL if self._map[i] is None else i for i in self._logical(ix)))
+        if type(ix) is slice: k = (slice, ix.start, ix.stop, ix.step)
+        pl = self._pt.get(k)
+        if pl is None:
+            pl = array('H', (PixelMap.NO_PIXEL if self._map[i] is None else i for i in self._logical(ix)))
+            if len(self._pt) >= PixelMap.PLAN_CACHE: self._pt.clear()
+            self._pt[k] = pl
+        return pl
+
+    def _logical(self, ix):
+        ls = []
+        if self._im == PixelMap.ROWS:
+            for i in self._indices(ix, len(self._map) // self._rl): ls.extend(self._row_indices(i))
+        elif self._im == PixelMap.COLUMNS:
+            for i in self._indices(ix, self._rl): ls.extend(self._col_indices(i))
+        elif self._im == PixelMap.ZIGZAG:
+            for i in self._indices(ix, len(self._map)): ls.append(self._zigzag_index(i))
+        else: # RASTER:
+            ls.extend(self._indices(ix, len(self._map)))
+        return ls
 
     def _indices(self, ix, mx):
         try:
@@ -132,65 +312,195 @@ class PixelMap:
             return self._rl
         return len(self._map)
 
-    def _setpixel(self, ix, val_source):
-        c, x = val_source(), self._map[ix]
-        if x is not None:
-            si = x // self._sp if self._sp > 0 else 0
-            self._pixels[si][x + si * self._sp] = c
+    def _setpixel(self, i, c):
+        if i == PixelMap.NO_PIXEL: return
+        if self._fb is not None:
+            self._put(i, self._pack(c))
+            return
+        si = self._ps[i]
+        x = self._po[i]
+        p = self._pixels[si]
+        if p[x] == c: return
+        p[x] = c
+        if x < self._dlo[si]: self._dlo[si] = x
+        if x > self._dhi[si]: self._dhi[si] = x
+
+    def _put(self, m, b):
+        ''' Writes colour 'b', packed by '_pack', to the pixel at map position 'm' in the framebuffer.
+        '''
+        if m == PixelMap.NO_PIXEL: return
+        cb = self._cb
+        o = self._fo[m]
+        n = self._bpp
+        for i in range(n):
+            if cb[o + i] != b[i]: break
+        else:
+            return
+        for i in range(n):
+            cb[o + i] = b[i]
+            self._fb[o + i] = b[n + i]
+        si = self._ps[m]
+        x = self._po[m]
+        if x < self._dlo[si]: self._dlo[si] = x
+        if x > self._dhi[si]: self._dhi[si] = x
+
+    def _mark(self, si=None):
+        for i in range(len(self._pixels)) if si is None else (si,):
+            self._dlo[i] = 0
+            self._dhi[i] = self._pixels[i].n - 1
 
     def __setitem__(self, ix, val):
-        val = self._val_source(val)
-        if self._im == PixelMap.ROWS:
-            for i in self._indices(ix, len(self._map) // self._rl):
-                for ii in self._row_indices(i):
-                    self._setpixel(ii, val)
-        elif self._im == PixelMap.COLUMNS:
-            for i in self._indices(ix, self._rl):
-                for ii in self._col_indices(i):
-                    self._setpixel(ii, val)
-        elif self._im == PixelMap.ZIGZAG:
-            for i in self._indices(ix, len(self._map)):
-                self._setpixel(self._zigzag_index(i), val)
-        else: # RASTER:
-            for i in self._indices(ix, len(self._map)):
-                self._setpixel(i, val)
+        pl = self._plan(ix)
+        if isinstance(val, tuple) and not isinstance(val[0], tuple):
+            if self._fb is not None:
+                self._fill_plan(pl, val)
+            else:
+                for x in pl: self._setpixel(x, val)
+        else:
+            val = self._val_source(val)
+            for x in pl: self._setpixel(x, val())
         if self._au: self.show()
 
-    def _getpixel(self, ix):
-        i = self._map[ix]
-        if i is None: return C.BLACK
-        si = i // self._sp if self._sp > 0 else 0
-        return self._pixels[si][i + si * self._sp]
+    def _getpixel(self, i):
+        if i == PixelMap.NO_PIXEL: return C.BLACK
+        if self._fb is not None: return self._unpack(self._fo[i])
+        return self._pixels[self._ps[i]][self._po[i]]
 
     def __getitem__(self, ix):
-        rv = []
-        if self._im == PixelMap.ROWS:
-            for i in self._indices(ix, len(self._map) // self._rl):
-                for ii in self._row_indices(i):
-                    rv.append(self._getpixel(ii))
-        elif self._im == PixelMap.COLUMNS:
-            for i in self._indices(ix, self._rl):
-                for ii in self._col_indices(i):
-                    rv.append(self._getpixel(ii))
-        elif self._im == PixelMap.ZIGZAG:
-            for i in self._indices(ix, len(self._map)):
-                rv.append(self._getpixel(self._zigzag_index(i)))
-        else: # RASTER:
-            for i in self._indices(ix, len(self._map)):
-                rv.append(self._getpixel(i))
-        if len(rv) == 1: rv = rv[0]
-        return rv
+        pl = self._plan(ix)
+        if len(pl) == 1: return self._getpixel(pl[0])
+        return [self._getpixel(x) for x in pl]
 
     def xy(self):
         rl = self._rl
         return lambda x, y : rl * y + x
 
     def fill(self, color=C.BLACK):
-        for p in self._pixels: p.fill(color)
+        if self._fb is not None:
+            b = self._pack(color)
+            bpp = self._bpp
+            for i in range(len(self._pixels)):
+                n = self._pixels[i].n
+                self._cbv[self._base[i]:self._base[i] + n * bpp] = b[:bpp] * n
+                self._fbv[self._base[i]:self._base[i] + n * bpp] = b[bpp:] * n
+        else:
+            for p in self._pixels: p.fill(color)
+        self._mark()
+        if self._au: self.show()
+
+    def _fill_plan(self, pl, color):
+        if self._fb is not None:
+            b = self._pack(color)
+            for x in pl: self._put(x, b)
+        else:
+            for x in pl: self._setpixel(x, color)
+
+    def _bulk_plan(self, k, logical):
+        pl = self._bplans.get(k)
+        if pl is None:
+            pl = array('H', (PixelMap.NO_PIXEL if self._map[i] is None else i for i in logical()))
+            if len(self._bplans) >= PixelMap.PLAN_CACHE: self._bplans.clear()
+            self._bplans[k] = pl
+        return pl
+
+    def fill_rect(self, x, y, w, h, color):
+        ''' Fills 'w' columns from column 'x' of 'h' rows from row 'y' of the map, regardless of indexing.
+        '''
+        rl = self._rl
+        pl = self._bulk_plan(("r", x, y, w, h), lambda: [r * rl + c for r in range(y, y + h) for c in range(x, x + w)])
+        self._fill_plan(pl, color)
+        if self._au: self.show()
+
+    def fill_rows(self, rows, color):
+        ''' Fills every pixel in each row of the map listed in 'rows', regardless of indexing.
+        '''
+        rl = self._rl
+        pl = self._bulk_plan(("R", tuple(rows)), lambda: [r * rl + c for r in rows for c in range(rl)])
+        self._fill_plan(pl, color)
+        if self._au: self.show()
+
+    def fill_cols(self, cols, color):
+        ''' Fills every pixel in each column of the map listed in 'cols', regardless of indexing.
+        '''
+        rl, n = self._rl, len(self._map)
+        pl = self._bulk_plan(("C", tuple(cols)), lambda: [i for c in cols for i in range(c, n, rl)])
+        self._fill_plan(pl, color)
+        if self._au: self.show()
+
+    def snapshot(self):
+        ''' Returns a copy of the framebuffer colours, for use as a layer image with 'blit' or 'blend'.
+        '''
+        if self._fb is None: raise RuntimeError("PixelMap has no framebuffer")
+        return bytes(self._cb)
+
+    def blit(self, image):
+        ''' Replaces the whole framebuffer with a layer image taken by 'snapshot'.
+        '''
+        if self._fb is None: raise RuntimeError("PixelMap has no framebuffer")
+        self._cbv[:] = image
+        self._scale()
+        self._mark()
         if self._au: self.show()
 
-    def show(self):
-        for p in self._pixels: p.show()
+    def blend(self, image, mask=None, alpha=1.0):
+        ''' Mixes a layer image taken by 'snapshot' into the pixels selected by 'mask', an index interpreted by the
+            current indexing (all pixels if None). 'alpha' is the weight of the image, 1.0 copying it outright.
+        '''
+        if self._fb is None: raise RuntimeError("PixelMap has no framebuffer")
+        a = int(min(max(alpha, 0.0), 1.0) * 256)
+        fb, cb, lut, bo, bpp = self._fb, self._cb, self._lut, self._bo, self._bpp
+        for x in self._plan(slice(None) if mask is None else mask):
+            if x == PixelMap.NO_PIXEL: continue
+            si = self._ps[x]
+            lx = self._po[x]
+            o = self._fo[x]
+            ch = False
+            for i in range(bpp):
+                j = o + i
+                v = image[j] if a == 256 else (cb[j] * (256 - a) + image[j] * a) >> 8
+                if v != cb[j]:
+                    cb[j] = v
+                    fb[j] = v if bo[i] < 0 else lut[v]
+                    ch = True
+            if ch:
+                if lx < self._dlo[si]: self._dlo[si] = lx
+                if lx > self._dhi[si]: self._dhi[si] = lx
+        if self._au: self.show()
+
+    @property
+    def dirty(self):
+        ''' Tuple of (strip index, first, last) for every strip with pixels changed since the last frame.
+        '''
+        return tuple((i, self._dlo[i], self._dhi[i]) for i in range(len(self._pixels)) if self._dhi[i] >= 0)
+
+    def show(self, force=False):
+        ''' Pushes dirty strips unless the last frame was less than 'frame_period' ago. 'force' pushes every strip
+            immediately. Returns True if a frame was sent.
+        '''
+        if force:
+            self._mark()
+        else:
+            for h in self._dhi:
+                if h >= 0: break
+            else:
+                return False
+        now = ticks_ms()
+        if not force and self._last is not None and ((now - self._last) & 0x1FFFFFFF) < self._fp: return False
+        self._last = now
+        for i in range(len(self._pixels)):
+            if self._dhi[i] >= 0:
+                if self._fb is None:
+                    self._pixels[i].show()
+                elif self._tx[i] is not None:
+                    self._tx[i](self._views[i])
+                else:
+                    n = self._pixels[i].n * self._bpp
+                    self._bufs[i][:n] = self._fbv[self._base[i]:self._base[i] + n]
+                    self._pixels[i].show()
+                self._dlo[i] = self._pixels[i].n
+                self._dhi[i] = -1
+        self.shows += 1
+        return True
 
     @property
     def brightness(self):
@@ -198,6 +508,8 @@ class PixelMap:
     @brightness.setter
     def brightness(self, brightness):
         for p in self._pixels: p.brightness = min(max(brightness, 0.0), 1.0)
+        if self._fb is not None: self._scale()
+        self._mark()
 
     def __repr__(self):
         return f"[PixelMap rows={len(self._map)//self._rl} cols={self._rl}]"
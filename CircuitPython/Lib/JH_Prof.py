@@ -0,0 +1,116 @@
+import gc
+import time
+try:
+    import tracemalloc  # CPython only, used when the firmware runs on a host
+except ImportError:
+    tracemalloc = None
+
+class Profiler:
+    ''' Records the time and heap taken by each step of startup. 'imports' times the import of named modules
+        (import leaf modules first so each row shows only its own cost) and 'begin'/'end' bracket any other
+        block. When 'begin' is given classes, each object they construct before 'end' gets its own row, named
+        after the attribute of the 'end' container holding it, which breaks down the cost of a maps class.
+        Heap is gc.mem_alloc() after a collection, so rows show memory kept rather than garbage made. Under
+        CPython tracemalloc is used instead and must have been started. A disabled Profiler does nothing.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._rows = []
+        self._objs = []
+        self._hooked = []
+        self._depth = 0
+        self._t = 0
+        self._m = 0
+        self._gc = 0
+        self._t0 = time.monotonic_ns()
+        self._m0 = self._mem()
+
+    @staticmethod
+    def _mem():
+        gc.collect()
+        if hasattr(gc, "mem_alloc"): return gc.mem_alloc()
+        if tracemalloc is not None and tracemalloc.is_tracing(): return tracemalloc.get_traced_memory()[0]
+        return 0
+
+    def _start(self):
+        t = time.monotonic_ns()
+        self._m = self._mem()
+        self._t = time.monotonic_ns()
+        self._gc += self._t - t  # Collections made by the profiler are left out of the times
+
+    def _lap(self):
+        ''' Returns nanoseconds and bytes since the last lap or start, then starts the next lap.
+        '''
+        t = time.monotonic_ns() - self._t
+        m = self._m
+        self._start()
+        return t, self._m - m
+
+    def imports(self, *names):
+        for n in names:
+            self.begin()
+            __import__(n)
+            self.end(f"import {n}")
+
+    def begin(self, *classes):
+        if not self.enabled: return
+        for cls in classes: self._hook(cls)
+        self._objs = []
+        self._start()
+        self._bt, self._bm, self._bgc = self._t, self._m, self._gc
+
+    def end(self, name, container=None):
+        if not self.enabled: return
+        t = time.monotonic_ns() - self._bt - (self._gc - self._bgc)
+        self._start()
+        self._rows.append((name, t, self._m - self._bm, 0))
+        for cls, init in self._hooked: cls.__init__ = init
+        self._hooked = []
+        if container is not None:
+            names = Profiler._names(container)
+            for o, t, m in self._objs: self._rows.append((names.get(id(o), type(o).__name__), t, m, 1))
+        self._objs = []
+
+    @staticmethod
+    def _names(container):
+        names = {}
+        for k, v in container.__dict__.items():
+            if k.startswith("_"): continue
+            names[id(v)] = k
+            for i, e in enumerate(getattr(v, "_map", ())):
+                if id(e) not in names and not isinstance(e, (int, tuple)): names[id(e)] = f"{k}[{i}]"
+        return names
+
+    def _hook(self, cls):
+        init = cls.__init__
+        prof = self
+        def __init__(obj, *pargs, **nargs):
+            prof._depth += 1
+            try:
+                init(obj, *pargs, **nargs)
+            finally:
+                prof._depth -= 1
+            if prof._depth == 0: prof._objs.append((obj,) + prof._lap())
+        self._hooked.append((cls, init))
+        cls.__init__ = __init__
+
+    def report(self, out=print):
+        if not self.enabled: return
+        out(f"{'Startup':<36}{'ms':>9}{'bytes':>9}")
+        for name, t, m, sub in self._rows:
+            out(f"{'  ' * sub + name:<36}{t / 1000000:>9.1f}{m:>9}")
+        t = time.monotonic_ns() - self._t0 - self._gc
+        out(f"{'total':<36}{t / 1000000:>9.1f}{self._mem() - self._m0:>9}")
+        if hasattr(gc, "mem_free"): out(f"{'free':<36}{'':>9}{gc.mem_free():>9}")
+'''
+from JH_Prof import Profiler
+prof = Profiler()
+prof.imports("JH_Lib", "HidUsage")
+from JH_Lib import IMap
+prof.begin(IMap)
+class MAPS:
+    A = IMap((1, 2, 3))
+    B = IMap(tuple(range(100)))
+prof.end("MAPS", MAPS)
+prof.report()
+'''
@@ -0,0 +1,173 @@
+import time
+from array import array
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+try:
+    from supervisor import ticks_ms
+except ImportError:
+    def ticks_ms():
+        return (time.monotonic_ns() // 1000000) & 0x1FFFFFFF
+
+_MASK = 0x1FFFFFFF  # ticks_ms wraps at 2**29
+_HALF = 0x10000000
+
+class Scheduler:
+    ''' Runs a set of periodic tasks cooperatively. Each task is a callable taking no arguments which is called
+        every 'period' seconds, or on every pass if 'period' is 0. Tasks due together run in the order they were
+        added, so add the most latency sensitive first. Uses asyncio where the library is installed, otherwise a
+        simple deadline loop. Either way the processor sleeps when no task is due. The deadline loop keeps its
+        deadlines in ms on the wrapping ticks_ms clock, whose values stay small integers and never allocate.
+    '''
+    def __init__(self):
+        self._tasks = []
+
+    def add(self, func, period=0, name=None):
+        self._tasks.append((func, period, name if name is not None else getattr(func, "__name__", "task")))
+        return self
+
+    @property
+    def tasks(self):
+        return tuple(self._tasks)
+
+    def run(self):
+        if asyncio is not None:
+            asyncio.run(self._main())
+        else:
+            self._loop()
+
+    async def _main(self):
+        await asyncio.gather(*[asyncio.create_task(Scheduler._task(f, p)) for f, p, n in self._tasks])
+
+    @staticmethod
+    async def _task(func, period):
+        while True:
+            func()
+            await asyncio.sleep(period)
+
+    def _loop(self):
+        fn = tuple(t[0] for t in self._tasks)
+        per = array('l', (int(t[1] * 1000) for t in self._tasks))
+        due = array('l', (ticks_ms() for t in self._tasks))
+        while True:
+            wait = _HALF
+            for i in range(len(fn)):
+                now = ticks_ms()
+                if ((now - due[i]) & _MASK) < _HALF:
+                    fn[i]()
+                    due[i] = (now + per[i]) & _MASK
+                d = (due[i] - now) & _MASK
+                if d >= _HALF: d = 0  # Overdue
+                if d < wait: wait = d
+            if wait > 0: time.sleep(wait / 1000)
+'''
+import time
+from JH_Sched import Scheduler
+t0 = time.monotonic()
+def fast(): pass
+def slow(): print("slow", time.monotonic() - t0)
+Scheduler().add(fast, 0.001).add(slow, 0.5).run()
+'''
+
+class TimerWheel:
+    ''' Hashed wheel of one-shot timers on the supervisor.ticks_ms clock, for deadlines measured in milliseconds.
+        'slots' buckets each cover 2**'shift' ms, and a timer due further ahead than one turn of the wheel simply
+        waits in its bucket for later turns. Up to 'capacity' timers are held in preallocated arrays, so starting,
+        cancelling and firing allocate nothing. 'poll' is called from the main loop and costs one bucket per tick
+        elapsed since the last poll (at most 'slots') plus the timers found there; with no timers it returns at
+        once. Each expired timer is removed, then func(arg) is called.
+    '''
+    def __init__(self, capacity=8, slots=16, shift=3):
+        self._shift = shift
+        self._slots = slots
+        self._due = array('l', (0 for i in range(capacity)))
+        self._fn = [None] * capacity
+        self._arg = [None] * capacity
+        self._next = array('b', (i + 1 for i in range(capacity)))  # Bucket chains, and the chain of free entries
+        self._next[capacity - 1] = -1
+        self._free = 0
+        self._head = array('b', (-1 for i in range(slots)))
+        self._tick = ticks_ms() >> shift
+        self.count = 0
+
+    def _bucket(self, due):
+        return (due >> self._shift) % self._slots
+
+    def start(self, due, func, arg=None):
+        ''' Calls func(arg) once ticks_ms() reaches 'due'. Returns a handle for 'cancel'.
+        '''
+        i = self._free
+        if i < 0: raise RuntimeError("TimerWheel full")
+        self._free = self._next[i]
+        due &= _MASK
+        self._due[i] = due
+        self._fn[i] = func
+        self._arg[i] = arg
+        b = self._bucket(due)
+        if ((due >> self._shift) - self._tick) & (_MASK >> self._shift) > (_HALF >> self._shift):
+            b = self._tick % self._slots  # Already due, so into the bucket the next poll visits first
+        self._next[i] = self._head[b]
+        self._head[b] = i
+        self.count += 1
+        return i
+
+    def cancel(self, handle):
+        ''' Removes a timer which has not fired. Returns True if it was found.
+        '''
+        if handle < 0 or self._fn[handle] is None: return False
+        if self._unlink(self._bucket(self._due[handle]), handle): return True
+        for b in range(self._slots):  # Filed under the current tick as it was already due when started
+            if self._unlink(b, handle): return True
+        return False
+
+    def _unlink(self, b, handle):
+        p, i = -1, self._head[b]
+        while i >= 0:
+            if i == handle:
+                if p < 0: self._head[b] = self._next[i]
+                else: self._next[p] = self._next[i]
+                self._release(i)
+                return True
+            p, i = i, self._next[i]
+        return False
+
+    def _release(self, i):
+        self._fn[i] = self._arg[i] = None
+        self._next[i] = self._free
+        self._free = i
+        self.count -= 1
+
+    def poll(self, now=None):
+        if now is None: now = ticks_ms()
+        t = now >> self._shift
+        if not self.count:
+            self._tick = t
+            return
+        n = (t - self._tick) & (_MASK >> self._shift)
+        if n >= self._slots: n = self._slots - 1
+        for k in range(self._tick, self._tick + n + 1):
+            b = k % self._slots
+            p, i = -1, self._head[b]
+            while i >= 0:
+                nx = self._next[i]
+                if ((now - self._due[i]) & _MASK) < _HALF:
+                    if p < 0: self._head[b] = nx
+                    else: self._next[p] = nx
+                    fn, arg = self._fn[i], self._arg[i]
+                    self._release(i)
+                    fn(arg)
+                else:
+                    p = i
+                i = nx
+        self._tick = t
+'''
+from JH_Sched import TimerWheel, ticks_ms
+w = TimerWheel()
+t = ticks_ms()
+w.start(t + 50, print, "50 ms")
+h = w.start(t + 100, print, "cancelled")
+w.start(t + 300, print, "300 ms")
+w.cancel(h)
+while w.count: w.poll()
+'''
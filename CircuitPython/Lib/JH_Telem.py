@@ -0,0 +1,100 @@
+import struct
+from array import array
+
+class Telemetry:
+    ''' Counters, gauges and fixed-bucket histograms for watching a running keyboard at little cost to it.
+        Counters and histogram buckets live in preallocated arrays: hot code increments 'counters[i]' directly
+        (index with 'counter(name)' once, at startup) and calls 'sample' for histograms, neither of which
+        allocates. Gauges are functions read only when a frame is built. A histogram with edges (e0, e1, ...)
+        counts values below e0, below e1 and so on, with a last bucket for the rest.
+        'frame' returns a binary frame of the current values and 'schema' one naming them, for 'Host/Telem.py':
+            magic 0xBA 0xE7, u8 kind (1 data, 2 schema), u8 format, u16 sequence, u32 ticks_ms, u16 length,
+            'length' bytes of payload, u16 sum of all the bytes before it. Integers are little-endian.
+        A data payload is each counter as u32, each gauge as i32 and each histogram bucket as u32, in schema
+        order. A schema payload is text lines 'C name', 'G name' and 'H name e0 e1 ...'.
+    '''
+    MAGIC = b"\xba\xe7"
+    DATA = 1
+    SCHEMA = 2
+    FORMAT = 1
+
+    def __init__(self, counters=(), histograms=()):
+        self._cn = tuple(counters)
+        self.counters = array('I', (0 for c in self._cn))
+        self._gn = []
+        self._gf = []
+        self._hn = tuple(h[0] for h in histograms)
+        self._he = tuple(array('l', h[1]) for h in histograms)
+        self._hb = tuple(array('I', (0 for i in range(len(h[1]) + 1))) for h in histograms)
+        self.seq = 0
+
+    def counter(self, name):
+        return self._cn.index(name)
+
+    def histogram(self, name):
+        return self._hn.index(name)
+
+    def gauge(self, name, func):
+        ''' Adds a gauge whose value, an integer, is func() when a frame is built.
+        '''
+        self._gn.append(name)
+        self._gf.append(func)
+
+    def sample(self, h, v):
+        e = self._he[h]
+        i = 0
+        n = len(e)
+        while i < n and v >= e[i]: i += 1
+        self._hb[h][i] += 1
+
+    def reset(self):
+        for i in range(len(self.counters)): self.counters[i] = 0
+        for b in self._hb:
+            for i in range(len(b)): b[i] = 0
+
+    def _frame(self, kind, ticks, size):
+        b = bytearray(12 + size + 2)
+        b[0:2] = Telemetry.MAGIC
+        struct.pack_into("<BBHLH", b, 2, kind, Telemetry.FORMAT, self.seq & 0xFFFF, ticks & 0xFFFFFFFF, size)
+        self.seq += 1
+        return b
+
+    @staticmethod
+    def _seal(b):
+        s = 0
+        for i in range(len(b) - 2): s += b[i]
+        struct.pack_into("<H", b, len(b) - 2, s & 0xFFFF)
+        return b
+
+    def frame(self, ticks=0):
+        n = len(self.counters) + len(self._gf) + sum(len(b) for b in self._hb)
+        b = self._frame(Telemetry.DATA, ticks, 4 * n)
+        o = 12
+        for v in self.counters:
+            struct.pack_into("<L", b, o, v)
+            o += 4
+        for f in self._gf:
+            struct.pack_into("<l", b, o, f())
+            o += 4
+        for h in self._hb:
+            for v in h:
+                struct.pack_into("<L", b, o, v)
+                o += 4
+        return Telemetry._seal(b)
+
+    def schema(self, ticks=0):
+        lines = [f"C {n}" for n in self._cn] + [f"G {n}" for n in self._gn]
+        lines += [f"H {self._hn[i]} " + " ".join(str(e) for e in self._he[i]) for i in range(len(self._hn))]
+        t = "\n".join(lines).encode()
+        b = self._frame(Telemetry.SCHEMA, ticks, len(t))
+        b[12:12 + len(t)] = t
+        return Telemetry._seal(b)
+'''
+from JH_Telem import Telemetry
+t = Telemetry(("events", "reports"), (("latency", (1, 2, 5, 10)),))
+t.gauge("free", lambda: 1234)
+t.counters[t.counter("events")] += 3
+for v in (0, 1, 3, 7, 50): t.sample(t.histogram("latency"), v)
+print(t.schema())
+print(t.frame())
+'''
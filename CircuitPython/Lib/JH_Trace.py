@@ -0,0 +1,49 @@
+from array import array
+
+class EventRecorder:
+    ''' Ring buffer holding the last 'size' key events, for replay on a host by 'Host/Replay.py'. 'record' stores
+        the physical key number, pressed flag and keypad timestamp of an event in two preallocated arrays and
+        allocates nothing. 'mark' records a queue overflow, after which the firmware released all keys.
+        'dump' writes the buffer, oldest event first, as text lines to 'write' (for example usb_cdc.data.write).
+    '''
+    RESET = 0x7F  # Key number recorded by 'mark'
+
+    def __init__(self, size=512):
+        self.size = size
+        self._t = array('L', (0 for i in range(size)))
+        self._k = bytearray(size)
+        self.count = 0  # Events recorded since construction or 'clear', including any overwritten
+
+    def record(self, key_number, pressed, timestamp):
+        i = self.count % self.size
+        self._t[i] = timestamp & 0x1FFFFFFF  # As supervisor.ticks_ms
+        self._k[i] = key_number | 0x80 if pressed else key_number
+        self.count += 1
+
+    def mark(self, timestamp):
+        self.record(EventRecorder.RESET, False, timestamp)
+
+    def clear(self):
+        self.count = 0
+
+    def events(self):
+        ''' Yields (timestamp, key_number, pressed) for the recorded events, oldest first.
+        '''
+        n = min(self.count, self.size)
+        for j in range(self.count - n, self.count):
+            i = j % self.size
+            k = self._k[i]
+            yield self._t[i], k & 0x7F, k >> 7
+
+    def dump(self, write):
+        write(f"# BaerKB trace {min(self.count, self.size)} of {self.count}\n".encode())
+        for t, k, p in self.events(): write(f"{t},{k},{p}\n".encode())
+        write(b"# end\n")
+'''
+from JH_Trace import EventRecorder
+import sys
+r = EventRecorder(4)
+for i in range(6): r.record(i, i % 2 == 0, 1000 + i)
+r.mark(2000)
+r.dump(lambda b: sys.stdout.write(b.decode()))
+'''
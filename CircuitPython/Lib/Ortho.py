@@ -1,10 +1,61 @@
 import keypad
+from array import array
 import neopixel
 import usb_hid
 from adafruit_hid.keyboard import Keyboard
-from JH_Lib import IMap, Enum, Mech, BitField, Cont
+from JH_Lib import IMap, Enum, Mech, SmallBitField, Cont
 from JH_PixelMap import PixelMap
-from HidUsage import USBKB as KB, USBKP as KP
+from JH_Anim import Animator
+from JH_Trace import EventRecorder
+from JH_Telem import Telemetry
+from JH_Sched import TimerWheel
+try:
+    from micropython import const
+except ImportError:
+    const = lambda x: x
+try:
+    from supervisor import ticks_ms  # The clock keypad.Event timestamps are taken from
+except ImportError:
+    import time
+    def ticks_ms():
+        return (time.monotonic_ns() // 1000000) & _TICKS_MASK
+
+_TICKS_MASK = const(0x1FFFFFFF)  # supervisor.ticks_ms wraps at 2**29
+
+# HID codes sent to change lock states. Held here, rather than taken from HidUsage, so that HidUsage is only
+# imported when debug output needs its names.
+_KP_NUMLK = const(0x53)
+_KB_CPLK = const(0x39)
+_KB_SCLK = const(0x47)
+_KB_APP = const(0x65)
+_LOCK_CODES = ((_KP_NUMLK,), (_KB_CPLK,), (_KB_SCLK,), (_KB_APP,))  # Indexed by Leds bit
+
+# Telemetry counters after the six KeyMech state counters, and histograms, in the order 'telemetry' defines them.
+_TM_REPORTS = const(6)
+_TM_MACROS = const(7)
+_TH_LATENCY = const(0)
+_TH_MACRO = const(2)
+
+def telemetry():
+    ''' Returns a Telemetry for KEY_MAPS.TELEMETRY, to be passed to Usbkb and Orthokb. Its counters are the key
+        events handled in each KeyMech state, the HID reports sent and the macros typed. Its histograms are the
+        latency from the scanner to the event being handled, the main loop period (sampled by code.py) and the
+        steps in each macro. Usbkb and Orthokb add their existing statistics as gauges.
+    '''
+    ms = (1, 2, 5, 10, 20, 50, 100)
+    return Telemetry(("init", "p", "pt", "ps", "s", "pp", "reports", "macros"),
+                     (("latency_ms", ms), ("loop_ms", ms), ("macro_steps", (2, 4, 8, 16, 32, 64, 128))))
+
+def lock_needs(seq):
+    ''' Returns, as Leds bits, the lock states which change what the HID codes in macro steps 'seq' type: Caps
+        Lock for letter keys and Num Lock for keypad digits and point. Sequences assume these locks are off.
+    '''
+    n = 0
+    for t, codes in seq:
+        for c in codes:
+            if 0x04 <= c <= 0x1D: n |= 2
+            elif 0x59 <= c <= 0x63: n |= 1
+    return n
         
 class KeyMap(IMap):
     ''' Tuple of actions against an index which may be key numbers or code points in a string. The elements
@@ -21,11 +72,61 @@ class KeyMap(IMap):
         if code_map is not None and not isinstance(code_map, KeyMap): raise TypeError("Must be KeyMap")
         self._base_map = base_map
         self._code_map = code_map
+        self._flat = None
+        self._seqs = None
+
+    # Action kinds recorded per slot by 'freeze'.
+    NONE = 0
+    INT = 1
+    TUPLE = 2
+    STR = 3
+    CALL = 4
+
+    def freeze(self):
+        ''' Resolves the 'base_map' chain into one flat tuple covering every index any map in the chain defines,
+            with a parallel table of action kinds, so that lookups no longer recurse and 'action' no longer tests
+            types. KeyMaps are immutable so this need only be done once, at startup. Freezes 'code_map' too.
+        '''
+        if self._flat is not None: return self
+        lo, hi = self._span()
+        flat = tuple(self[i] for i in range(lo, hi))
+        kinds = bytearray(len(flat))
+        for i, code in enumerate(flat):
+            if type(code) is int: kinds[i] = KeyMap.INT
+            elif type(code) is tuple: kinds[i] = KeyMap.TUPLE
+            elif type(code) is str and type(self._code_map) is KeyMap: kinds[i] = KeyMap.STR
+            elif callable(code): kinds[i] = KeyMap.CALL
+        self._lo = lo
+        self._kinds = kinds
+        self._flat = flat
+        if self._code_map is not None: self._code_map.freeze()
+        for i, code in enumerate(flat):
+            if kinds[i] == KeyMap.STR: self._sequence(code)
+        return self
+
+    def _span(self):
+        lo, hi = self.first_index, self.first_index + len(self._map)
+        if isinstance(self._base_map, KeyMap):
+            blo, bhi = self._base_map._span()
+            if blo < lo: lo = blo
+            if bhi > hi: hi = bhi
+        return lo, hi
 
     def action(self, act_func, act_type, ix=0):
         if act_type is ActionType.RELEASE_ALL:
             act_func(act_type)
             return
+        if self._flat is not None:
+            ix -= self._lo
+            if ix < 0 or ix >= len(self._flat): return
+            k = self._kinds[ix]
+            if k == KeyMap.INT or k == KeyMap.CALL:
+                act_func(act_type, self._flat[ix])
+            elif k == KeyMap.TUPLE:
+                act_func(act_type, *self._flat[ix])
+            elif k == KeyMap.STR and (act_type is ActionType.PRESS or act_type is ActionType.SEND):
+                self._macro(act_func, self._flat[ix])
+            return
         code = self[ix]
         if type(code) is int or callable(code):
             act_func(act_type, code)
@@ -33,36 +134,112 @@ class KeyMap(IMap):
             act_func(act_type, *code)
         if act_type not in (ActionType.PRESS, ActionType.SEND): return
         if type(code) is str and type(self._code_map) is KeyMap:
-            kbs = act_func(ActionType.LED_STATE, 0)
-            for ch in code:
-                oc = ord(ch)
-                self._code_map.action(act_func, ActionType.SEND, oc)
-            act_func(ActionType.LED_STATE, kbs)
+            self._macro(act_func, code)
+
+    def _macro(self, act_func, code):
+        seq = self._sequence(code)
+        act_func(ActionType.MACRO, seq, self._needs[code])
+
+    def _sequence(self, code):
+        ''' Returns the report sequence for string 'code', built from 'code_map' on first use and then cached. The
+            sequence is a tuple of (PRESS, codes) and (RELEASE_ALL, ()) steps, each giving exactly one HID report.
+            Characters needing the same modifiers are typed by adding each key to the keys already held (like a
+            rollover), so only a repeated key, a modifier change or a full report forces a release in between.
+        '''
+        if self._seqs is None:
+            self._seqs = {}
+            self._needs = {}
+        seq = self._seqs.get(code)
+        if seq is not None: return seq
+        seq = []
+        held = []
+        mods = ()
+        for ch in code:
+            cd = self._code_map[ord(ch)]
+            if type(cd) is int: cd = (cd,)
+            if type(cd) is not tuple: continue
+            m = tuple(c for c in cd if 0xE0 <= c <= 0xE7)
+            k = tuple(c for c in cd if c < 0xE0 or c > 0xE7)
+            if held and (m != mods or not k or len(held) + len(k) > 6 or any(c in held for c in k)):
+                seq.append((ActionType.RELEASE_ALL, ()))
+                held = []
+            seq.append((ActionType.PRESS, k if held else m + k))
+            if not held: mods = m
+            held.extend(k)
+            if not k: held.append(0)  # Modifier-only character: force a release before the next
+        if held: seq.append((ActionType.RELEASE_ALL, ()))
+        seq = tuple(seq)
+        self._seqs[code] = seq
+        self._needs[code] = lock_needs(seq)
+        return seq
 
     def __getitem__(self, ix):
+        if self._flat is not None:
+            ix = int(ix) - self._lo
+            cd = self._flat[ix] if 0 <= ix < len(self._flat) else None
+            return self.default if cd is None else cd
         cd = super().__getitem__(ix)
         if cd is not None: return cd
         if isinstance(self._base_map, KeyMap): cd = self._base_map[ix]
         if cd is not None: return cd
         return self.default
 
+def freeze_maps(maps):
+    ''' Freezes every KeyMap reachable from the constants in a CODE_MAPS class, including those held in IMaps,
+        ChordMaps and tuples.
+    '''
+    def walk(v):
+        if isinstance(v, KeyMap):
+            v.freeze()
+        elif isinstance(v, IMap):
+            for e in v._map: walk(e)
+        elif isinstance(v, tuple):
+            for e in v: walk(e)
+    for v in maps.__dict__.values(): walk(v)
+    KEY_MAP_NULL.freeze()
+
 KEY_MAP_NULL = KeyMap(())
 ''' Dummy keymap with no entries used as 'do nothing' for unused chords below.
 '''
 
 class ChordMap(IMap):
     ''' Tuple of entries which may be KeyMap, None or a Tuple of KeyMap and a colour tuple.
-        Indexed by the binary value of a chord of PKEYs (represented by BitFields)
+        Indexed by the binary value of a chord of PKEYs (represented by SmallBitFields)
         Maintains a record of the currently selected entry and a 'locked' entry which is
-        restored to current by the 'reset' method. An optional 'notifier' method is called
-        on a change of selection and passed BitFields of old and new chords and the colour
-        corresponding to the new.
+        restored to current by the 'reset' method. Functions registered with 'subscribe' are
+        passed the BitField of the new chord and its colour when 'notify' finds the selection
+        changed since they were last called. Changes only mark the map, so however many are made
+        between calls of 'notify', as while a chord is being built up, only the last is delivered.
     '''
     def __init__(self, map, pkeys=4, initial=0):
         super().__init__(map)
-        self._current = BitField(pkeys, initial)
-        self._locked = BitField(pkeys, self._current)
+        self._current = SmallBitField(pkeys, initial)
+        self._locked = SmallBitField(pkeys, self._current)
         self._lk = False
+        self._subs = ()
+        self._pending = False
+        self._sent = int(self._current)
+
+    def subscribe(self, func):
+        ''' Adds func(chord, colour) to the functions called by 'notify'. Returns 'func', so may decorate it.
+        '''
+        self._subs = self._subs + (func,)
+        return func
+
+    def unsubscribe(self, func):
+        self._subs = tuple(f for f in self._subs if f is not func)
+
+    def notify(self):
+        ''' Calls the subscribers if the selection has changed since they were last called.
+        '''
+        if not self._pending: return
+        self._pending = False
+        ch = int(self._current)
+        if ch == self._sent: return
+        self._sent = ch
+        m = self._map[ch]
+        c = m[1] if isinstance(m, tuple) else (0,0,0)
+        for f in self._subs: f(self._current, c)
 
     @property
     def current(self):
@@ -71,10 +248,7 @@ class ChordMap(IMap):
     def current(self, chord):
         if self._lk or self._current == chord: return
         self._current[:] = int(chord)
-        if hasattr(self, 'notifier') and callable(self.notifier):
-            m = self._map[int(self._current)]
-            c = m[1] if isinstance(m, tuple) else (0,0,0)
-            self.notifier(self._current, c)
+        self._pending = True
 
     def lock(self):
         self._locked[:] = self._current
@@ -83,6 +257,7 @@ class ChordMap(IMap):
     def reset(self):
         self._lk = False
         self.current[:] = self._locked
+        self._pending = True
 
     @property
     def keymap(self):
@@ -91,6 +266,135 @@ class ChordMap(IMap):
         if m is None: return KEY_MAP_NULL
         return m
 
+class PackedKeyMap(KeyMap):
+    ''' Read-only KeyMap whose slots are packed into a 'bytes' table built on the host by 'Host/Compile.py',
+        rather than held as Python objects. Each slot is a little-endian 16 bit word with the KeyMap action
+        kind in the top 3 bits and a value in the rest: the HID code for INT, the offset of a length-prefixed
+        run of codes in the pool for TUPLE, the index of the StateControl for CALL and the index of a
+        precompiled macro for STR. The base_map chain is already resolved, so the map behaves as if frozen.
+    '''
+    def __init__(self, table, pool, first_index=0):
+        super().__init__((), first_index=first_index)
+        self._tab = table
+        self._pool = pool
+
+    def freeze(self):
+        return self
+
+    def _span(self):
+        return self.first_index, self.first_index + len(self)
+
+    def __len__(self):
+        return len(self._tab) // 2
+
+    def _word(self, ix):
+        ix = (ix - self.first_index) * 2
+        if ix < 0 or ix >= len(self._tab): return 0
+        return self._tab[ix] | (self._tab[ix + 1] << 8)
+
+    def action(self, act_func, act_type, ix=0):
+        if act_type is ActionType.RELEASE_ALL:
+            act_func(act_type)
+            return
+        w = self._word(ix)
+        k, v = w >> 13, w & 0x1FFF
+        if k == KeyMap.INT:
+            act_func(act_type, v)
+        elif k == KeyMap.TUPLE:
+            act_func(act_type, *self._pool.codes(v))
+        elif k == KeyMap.CALL:
+            act_func(act_type, self._pool.calls[v])
+        elif k == KeyMap.STR and (act_type is ActionType.PRESS or act_type is ActionType.SEND):
+            seq = self._pool.sequence(v)
+            act_func(ActionType.MACRO, seq, self._pool.needs(v, seq))
+
+    def __getitem__(self, ix):
+        w = self._word(int(ix))
+        k, v = w >> 13, w & 0x1FFF
+        if k == KeyMap.INT: return v
+        if k == KeyMap.TUPLE: return self._pool.codes(v)
+        if k == KeyMap.CALL: return self._pool.calls[v]
+        if k == KeyMap.STR: return self._pool.macros[v][0]
+        return self.default
+
+class MapPool:
+    ''' Data shared by the PackedKeyMaps loaded from one compiled module: 'data' holds length-prefixed runs of
+        HID codes and macro step lists, 'macros' pairs each macro string with the offset of its steps and
+        'calls' holds the StateControl values in the order the compiler numbered them.
+        Code runs and macro sequences are decoded on first use and cached, as a frozen KeyMap holds them, so
+        that a key press allocates nothing.
+    '''
+    def __init__(self, data, macros, calls):
+        self.data = data
+        self.macros = macros
+        self.calls = calls
+        self._codes = {}
+        self._seqs = {}
+        self._needs = {}
+
+    def codes(self, off):
+        ''' Returns the run of codes at 'off' as a tuple.
+        '''
+        c = self._codes.get(off)
+        if c is None: c = self._codes[off] = tuple(self.data[off + 1:off + 1 + self.data[off]])
+        return c
+
+    def sequence(self, ix):
+        ''' Returns the steps of macro 'ix' in the form KeyMap._sequence gives. A step with no codes is a
+            RELEASE_ALL.
+        '''
+        seq = self._seqs.get(ix)
+        if seq is None: seq = self._seqs[ix] = self._decode(ix)
+        return seq
+
+    def _decode(self, ix):
+        d = self.data
+        off = self.macros[ix][1]
+        seq = []
+        for i in range(d[off]):
+            off += 1
+            n = d[off]
+            seq.append((ActionType.PRESS, tuple(d[off + 1:off + 1 + n])) if n else (ActionType.RELEASE_ALL, ()))
+            off += n
+        return tuple(seq)
+
+    def needs(self, ix, seq):
+        ''' Returns lock_needs for macro 'ix', whose steps are 'seq', computing it on first use.
+        '''
+        n = self._needs.get(ix)
+        if n is None: n = self._needs[ix] = lock_needs(seq)
+        return n
+
+COMPILED_FORMAT = 1  # Version of the module layout written by Host/Compile.py and read by 'load_maps'
+
+def load_maps(module, *variant):
+    ''' Builds a CODE_MAPS class from a module written by 'Host/Compile.py'. 'variant' gives the values of the
+        option switches (as named in module.PINS) the maps were compiled for. Returns None if the module was
+        built by an incompatible compiler or does not hold the variant, so the caller can fall back to source.
+    '''
+    if getattr(module, "FORMAT", None) != COMPILED_FORMAT: return None
+    spec = module.VARIANTS.get(tuple(bool(v) for v in variant))
+    if spec is None: return None
+    pool = MapPool(module.POOL, module.MACROS, tuple(getattr(StateControl, n) for n in module.CALLS))
+    kms = {}
+    def km(i):
+        if i not in kms: kms[i] = PackedKeyMap(module.TABLES[i][1], pool, module.TABLES[i][0])
+        return kms[i]
+    attrs = dict(module.CONSTS)
+    for name, v in spec.items():
+        if v[0] == "K":
+            attrs[name] = km(v[1])
+        elif v[0] == "I":
+            attrs[name] = IMap(tuple(km(i) for i in v[2]), v[1])
+        elif v[0] == "C":
+            b = v[1]
+            attrs[name] = ChordMap(
+                tuple(None if b[i] == 0xFF else (km(b[i]), (b[i + 1], b[i + 2], b[i + 3])) for i in range(0, len(b), 4)),
+                pkeys=v[2], initial=v[3]
+            )
+    return type("CODE_MAPS", (), attrs)
+
+@Enum.register
 class Side(Enum):
     ''' Enum recording if the primary multi-function keys are the right or left set.
     '''
@@ -98,6 +402,7 @@ class Side(Enum):
     left = Enum.v()
     right = Enum.v()
 
+@Enum.register
 class KeyType(Enum):
     ''' Enum classifying key actions. 'l' and 'r' is left or right multi-function when Side is 'unassigned'.
         'p' and 's' are primary and secondary multi-function keys. 't' is typing key.
@@ -115,8 +420,8 @@ class KeyType(Enum):
     tdown = Enum.v()
     tup = Enum.v()
 
-class Leds(BitField):
-    ''' BitField with one bit per state LED provided by the USB HID keyboard specification.
+class Leds(SmallBitField):
+    ''' SmallBitField with one bit per state LED provided by the USB HID keyboard specification.
     '''
     NUM_LOCK = (0,1)
     CAPS_LOCK = (1,2)
@@ -126,16 +431,21 @@ class Leds(BitField):
     def __init__(self, val=0):
         super().__init__(4, val)
 
+@Enum.register
 class ActionType(Enum):
     ''' Actions for the action_func callback which implements USB HID interface functionality. All match
-        USB function names except added 'LED_STATE' which attempts to apply a given LED state and returns previous.
+        USB function names except added 'LED_STATE' which attempts to apply a given LED state and returns previous,
+        and 'MACRO' which queues a sequence of actions (see KeyMap._sequence) to be sent without blocking. MACRO
+        takes the sequence and the lock states it depends on (see lock_needs).
     '''
     RELEASE_ALL = Enum.v()
     PRESS = Enum.v()
     RELEASE = Enum.v() 
     SEND = Enum.v()
     LED_STATE = Enum.v()
+    MACRO = Enum.v()
 
+@Enum.register
 class StateControl(Enum):
 
     MLK = Enum.v()  # Map Lock (Only makes sense in CFUNC as applies to currently selected PKEY chord)
@@ -152,120 +462,152 @@ class KeyMech(Mech):
         self._debug = debug
 
     def init(self, key_type, key_code):
-        if key_type == KeyType.tdown:
-            self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
-        elif key_type == KeyType.tup:
-            self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE, key_code)
-        elif key_type == KeyType.ldown:
-            self._pside[:] = Side.left
-            self._pchord[key_code] = 1
-            self._ix = key_code
+        if key_type.state is KeyType.tdown:
+            self._tpress(key_code)
+        elif key_type.state is KeyType.tup:
+            self._trelease(key_code)
+        elif key_type.state is KeyType.ldown:
+            self._lassign(key_code)
             return KeyMech.p
-        elif key_type == KeyType.rdown:
-            self._pside[:] = Side.right
-            self._pchord[key_code] = 1
-            self._ix = key_code
+        elif key_type.state is KeyType.rdown:
+            self._rassign(key_code)
             return KeyMech.p
     def p(self, key_type, key_code):
-        if key_type == KeyType.pup:
-            self._m.PTAP.action(self._action, ActionType.SEND, key_code)
-            self._pside[:] = Side.unassigned
+        if key_type.state is KeyType.pup:
+            self._ptap(key_code)
             return KeyMech.init
-        elif key_type == KeyType.tdown:
-            self._pmods().action(self._action, ActionType.PRESS, self._ix)
-            self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
+        elif key_type.state is KeyType.tdown:
+            self._pmodpress(key_code)
             return KeyMech.pt
-        elif key_type == KeyType.pdown:
-            self._m.CHORDS.current = self._pchord
+        elif key_type.state is KeyType.pdown:
+            self._chord(key_code)
             return KeyMech.pp
-        elif key_type == KeyType.sdown:
-            self._m.SFUNCS[self._ix].action(self._action, ActionType.PRESS, key_code)
+        elif key_type.state is KeyType.sdown:
+            self._sfpress(key_code)
             return KeyMech.ps
     def pt(self, key_type, key_code):
-        if key_type == KeyType.tdown:
-            self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
+        if key_type.state is KeyType.tdown:
+            self._tpress(key_code)
             return
-        elif key_type == KeyType.tup:
-            self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE, key_code)
+        elif key_type.state is KeyType.tup:
+            self._trelease(key_code)
             return
-        elif key_type == KeyType.pup:
-            self._pmods().action(self._action, ActionType.RELEASE, self._ix)
-        self._pside[:] = Side.unassigned
+        elif key_type.state is KeyType.pup:
+            self._pmodrelease(key_code)
+        else:
+            self._unassign(key_code)
         return KeyMech.init
     def ps(self, key_type, key_code):
-        if self._ix >= 0:
-            if key_type == KeyType.sup:
-                self._m.SFUNCS[self._ix].action(self._action, ActionType.RELEASE, key_code)
-            elif key_type == KeyType.sdown:
-                self._m.SFUNCS[self._ix].action(self._action, ActionType.PRESS, key_code)
-        else:
-            if key_type == KeyType.pup:
-                for i in range(0, 4):
-                    if self._schord[i]:
-                        self._smods().action(self._action, ActionType.PRESS, i)
-                return KeyMech.s
+        if key_type.state is KeyType.sup:
+            self._sfrelease(key_code)
+        elif key_type.state is KeyType.sdown:
+            self._sfpress(key_code)
+        elif key_type.state is KeyType.pup:
+            return self._smodpress(key_code)
     def s(self, key_type, key_code):
-        if key_type == KeyType.sup:
-            self._smods().action(self._action, ActionType.RELEASE, key_code)
-        elif key_type == KeyType.tdown:
-            self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
-        elif key_type == KeyType.tup:
-            self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE, key_code)
-        elif key_type == KeyType.pdown:
-            if self._ix == -1:
-                self._m.PTAP.action(self._action, ActionType.PRESS, key_code)
-            else:
-                self._m.UTAP.action(self._action, ActionType.PRESS, key_code)
-        elif key_type == KeyType.pup:
-            if self._ix == -1:
-                self._m.PTAP.action(self._action, ActionType.RELEASE, key_code)
-            else:
-                self._m.UTAP.action(self._action, ActionType.RELEASE, key_code)
+        if key_type.state is KeyType.sup:
+            self._smodrelease(key_code)
+        elif key_type.state is KeyType.tdown:
+            self._tpress(key_code)
+        elif key_type.state is KeyType.tup:
+            self._trelease(key_code)
+        elif key_type.state is KeyType.pdown:
+            self._stappress(key_code)
+        elif key_type.state is KeyType.pup:
+            self._staprelease(key_code)
     def pp(self, key_type, key_code):
-        if key_type in (KeyType.pup, KeyType.pdown):
-            self._m.CHORDS.current = self._pchord
-        elif key_type == KeyType.tdown:
-            self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
-        elif key_type == KeyType.tup:
-            self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE, key_code)
-        elif key_type == KeyType.sdown:
-            self._m.CFUNC.action(self._action, ActionType.PRESS, key_code)
-        elif key_type == KeyType.sup:
-            self._m.CFUNC.action(self._action, ActionType.RELEASE, key_code)
+        if key_type.state in (KeyType.pup, KeyType.pdown):
+            self._chord(key_code)
+        elif key_type.state is KeyType.tdown:
+            self._tpress(key_code)
+        elif key_type.state is KeyType.tup:
+            self._trelease(key_code)
+        elif key_type.state is KeyType.sdown:
+            self._cfpress(key_code)
+        elif key_type.state is KeyType.sup:
+            self._cfrelease(key_code)
+
+    # Actions shared by the state methods above and the tables in CompiledKeyMech. Each takes the key code and
+    # returns None, or the next state where the transition depends on more than the state and key type.
+    def _tpress(self, key_code):
+        self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
+    def _trelease(self, key_code):
+        self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE, key_code)
+    def _lassign(self, key_code):
+        self._pside[:] = Side.left
+        self._pchord[key_code] = 1
+        self._ix = key_code
+    def _rassign(self, key_code):
+        self._pside[:] = Side.right
+        self._pchord[key_code] = 1
+        self._ix = key_code
+    def _unassign(self, key_code):
+        self._pside[:] = Side.unassigned
+    def _ptap(self, key_code):
+        self._m.PTAP.action(self._action, ActionType.SEND, key_code)
+        self._pside[:] = Side.unassigned
+    def _pmodpress(self, key_code):
+        self._pmods().action(self._action, ActionType.PRESS, self._ix)
+        self._m.CHORDS.keymap.action(self._action, ActionType.PRESS, key_code)
+    def _pmodrelease(self, key_code):
+        self._pmods().action(self._action, ActionType.RELEASE, self._ix)
+        self._pside[:] = Side.unassigned
+    def _chord(self, key_code):
+        self._m.CHORDS.current = self._pchord
+    def _sfpress(self, key_code):
+        if self._ix >= 0: self._m.SFUNCS[self._ix].action(self._action, ActionType.PRESS, key_code)
+    def _sfrelease(self, key_code):
+        if self._ix >= 0: self._m.SFUNCS[self._ix].action(self._action, ActionType.RELEASE, key_code)
+    def _smodpress(self, key_code):
+        if self._ix >= 0: return
+        for i in range(0, 4):
+            if self._schord[i]:
+                self._smods().action(self._action, ActionType.PRESS, i)
+        return KeyMech.s
+    def _smodrelease(self, key_code):
+        self._smods().action(self._action, ActionType.RELEASE, key_code)
+    def _stappress(self, key_code):
+        (self._m.PTAP if self._ix == -1 else self._m.UTAP).action(self._action, ActionType.PRESS, key_code)
+    def _staprelease(self, key_code):
+        (self._m.PTAP if self._ix == -1 else self._m.UTAP).action(self._action, ActionType.RELEASE, key_code)
+    def _cfpress(self, key_code):
+        self._m.CFUNC.action(self._action, ActionType.PRESS, key_code)
+    def _cfrelease(self, key_code):
+        self._m.CFUNC.action(self._action, ActionType.RELEASE, key_code)
 
     def __pre__(self, key_type, key_code):
-        if key_type == KeyType.allup: return KeyMech.init
-        if self._pside != Side.unassigned:
-            if key_type == KeyType.ldown:
-                if self._pside == Side.left:
+        if key_type.state is KeyType.allup: return KeyMech.init
+        if self._pside.state is not Side.unassigned:
+            if key_type.state is KeyType.ldown:
+                if self._pside.state is Side.left:
                     key_type[:] = KeyType.pdown
                 else:
                     key_type[:] = KeyType.sdown
-            elif key_type == KeyType.lup:
-                if self._pside == Side.left:
+            elif key_type.state is KeyType.lup:
+                if self._pside.state is Side.left:
                     key_type[:] = KeyType.pup
                 else:
                     key_type[:] = KeyType.sup
-            elif key_type == KeyType.rdown:
-                if self._pside == Side.right:
+            elif key_type.state is KeyType.rdown:
+                if self._pside.state is Side.right:
                     key_type[:] = KeyType.pdown
                 else:
                     key_type[:] = KeyType.sdown
-            elif key_type == KeyType.rup:
-                if self._pside == Side.right:
+            elif key_type.state is KeyType.rup:
+                if self._pside.state is Side.right:
                     key_type[:] = KeyType.pup
                 else:
                     key_type[:] = KeyType.sup
-        if key_type == KeyType.pdown:
+        if key_type.state is KeyType.pdown:
             self._pchord[key_code] = 1
-        elif key_type == KeyType.sdown:
+        elif key_type.state is KeyType.sdown:
             self._schord[key_code] = 1
-        elif key_type == KeyType.pup:
+        elif key_type.state is KeyType.pup:
             self._pchord[key_code] = 0
-        elif key_type == KeyType.sup:
+        elif key_type.state is KeyType.sup:
             self._schord[key_code] = 0
     def __trans__(self, from_state, to_state):
-        if self._debug > 1: print(from_state, " => ", to_state)
+        if self._debug > 1: print(self.state_name(from_state), "=>", self.state_name(to_state))
         if to_state is KeyMech.init:
             self._m.CHORDS.keymap.action(self._action, ActionType.RELEASE_ALL)
             self._m.CHORDS.reset()
@@ -275,35 +617,418 @@ class KeyMech(Mech):
             self._schord[:] = False
         return to_state
 
+    def reset(self):
+        ''' Returns to 'init' as if all keys had been released, without the action a release would trigger.
+        '''
+        if self.state is not KeyMech.init:
+            self.__trans__(self.state, KeyMech.init)
+            self.state = KeyMech.init
+
     def _pmods(self):
-        return self._m.LMOD if self._pside == Side.left else self._m.RMOD
+        return self._m.LMOD if self._pside.state is Side.left else self._m.RMOD
     def _smods(self):
-        return self._m.RMOD if self._pside == Side.left else self._m.LMOD
+        return self._m.RMOD if self._pside.state is Side.left else self._m.LMOD
     _pside = Side(Side.unassigned)
-    _pchord = BitField(4)
-    _schord = BitField(4)
+    _pchord = SmallBitField(4)
+    _schord = SmallBitField(4)
     _ix = 0
 
+class CompiledKeyMech(KeyMech):
+    ''' KeyMech with the state methods and the '__pre__' side remapping compiled at construction into integer indexed
+        tables. Each event costs two dictionary lookups to turn the KeyType and Side into ordinals, a remap table read
+        and a dispatch table read giving (action, next state). Behaviour is identical to KeyMech.
+    '''
+    init, p, pt, ps, s, pp = KeyMech.init, KeyMech.p, KeyMech.pt, KeyMech.ps, KeyMech.s, KeyMech.pp  # For state_name
+    STATES = (init, p, pt, ps, s, pp)
+    KEYTYPES = (KeyType.allup, KeyType.setix, KeyType.ldown, KeyType.lup, KeyType.rdown, KeyType.rup,
+                KeyType.pdown, KeyType.pup, KeyType.sdown, KeyType.sup, KeyType.tdown, KeyType.tup)
+    SIDES = (Side.unassigned, Side.left, Side.right)
+
+    def __init__(self, action_func, maps, debug = 0):
+        super().__init__(action_func, maps, debug)
+        ST, KT, SD = self.STATES, self.KEYTYPES, self.SIDES
+        nk = len(KT)
+        self._sti = {v: i for i, v in enumerate(ST)}
+        self._kti = {v: i for i, v in enumerate(KT)}
+        self._sdi = {v: i for i, v in enumerate(SD)}
+        self._nk = nk
+        self._st = self._sti[self.state]
+        # Side remapping: (side, raw key type) -> effective key type.
+        own = {KeyType.ldown: Side.left, KeyType.lup: Side.left, KeyType.rdown: Side.right, KeyType.rup: Side.right}
+        self._remap = bytearray(len(SD) * nk)
+        for si, sd in enumerate(SD):
+            for ki, kt in enumerate(KT):
+                if sd is not Side.unassigned and kt in own:
+                    dn = kt is KeyType.ldown or kt is KeyType.rdown
+                    if own[kt] is sd:
+                        kt = KeyType.pdown if dn else KeyType.pup
+                    else:
+                        kt = KeyType.sdown if dn else KeyType.sup
+                self._remap[si * nk + ki] = self._kti[kt]
+        # Dispatch: (state, effective key type) -> (action, next state). None for next state means no change unless
+        # the action returns a state.
+        M = KeyMech
+        spec = (
+            (M.init, KeyType.tdown, M._tpress, None), (M.init, KeyType.tup, M._trelease, None),
+            (M.init, KeyType.ldown, M._lassign, M.p), (M.init, KeyType.rdown, M._rassign, M.p),
+            (M.p, KeyType.pup, M._ptap, M.init), (M.p, KeyType.tdown, M._pmodpress, M.pt),
+            (M.p, KeyType.pdown, M._chord, M.pp), (M.p, KeyType.sdown, M._sfpress, M.ps),
+            (M.ps, KeyType.sup, M._sfrelease, None), (M.ps, KeyType.sdown, M._sfpress, None),
+            (M.ps, KeyType.pup, M._smodpress, None),
+            (M.s, KeyType.sup, M._smodrelease, None), (M.s, KeyType.tdown, M._tpress, None),
+            (M.s, KeyType.tup, M._trelease, None), (M.s, KeyType.pdown, M._stappress, None),
+            (M.s, KeyType.pup, M._staprelease, None),
+            (M.pp, KeyType.pup, M._chord, None), (M.pp, KeyType.pdown, M._chord, None),
+            (M.pp, KeyType.tdown, M._tpress, None), (M.pp, KeyType.tup, M._trelease, None),
+            (M.pp, KeyType.sdown, M._cfpress, None), (M.pp, KeyType.sup, M._cfrelease, None),
+        )
+        tab = [None] * (len(ST) * nk)
+        for kt in KT:
+            tab[self._sti[M.pt] * nk + self._kti[kt]] = (M._unassign, self._sti[M.init])
+        tab[self._sti[M.pt] * nk + self._kti[KeyType.tdown]] = (M._tpress, None)
+        tab[self._sti[M.pt] * nk + self._kti[KeyType.tup]] = (M._trelease, None)
+        tab[self._sti[M.pt] * nk + self._kti[KeyType.pup]] = (M._pmodrelease, self._sti[M.init])
+        for st, kt, fn, ns in spec:
+            tab[self._sti[st] * nk + self._kti[kt]] = (fn, None if ns is None else self._sti[ns])
+        self._tab = tuple(tab)
+
+    _PDOWN, _PUP, _SDOWN, _SUP = 6, 7, 8, 9  # Ordinals in KEYTYPES
+
+    def __call__(self, key_type, key_code):
+        kt = self._kti[key_type.state]
+        if kt == 0:  # allup
+            ns = 0
+        else:
+            kt = self._remap[self._sdi[self._pside.state] * self._nk + kt]
+            if kt == self._PDOWN: self._pchord[key_code] = 1
+            elif kt == self._SDOWN: self._schord[key_code] = 1
+            elif kt == self._PUP: self._pchord[key_code] = 0
+            elif kt == self._SUP: self._schord[key_code] = 0
+            e = self._tab[self._st * self._nk + kt]
+            if e is None: return
+            ns = e[0](self, key_code)
+            ns = e[1] if ns is None else self._sti[ns]
+            if ns is None: return
+        if ns != self._st:
+            self.__trans__(self.state, self.STATES[ns])
+            self.state = self.STATES[ns]
+            self._st = ns
+
+    def reset(self):
+        super().reset()
+        self._st = 0
+
+class TapHold:
+    ''' Decides between tap and hold of a lone PKEY by time as well as by event order, in front of a KeyMech.
+        Without it, releasing the PKEY in state 'p' always sends PTAP and a typing key pressed first always gets
+        the PKEY modifier, so a fast roll from a PKEY onto a typing key comes out modified.
+        A typing key pressed within 'term' ms of the PKEY is held back, with anything else typed, until the
+        decision is made: a tap (PTAP, then the held back keys unmodified) if the PKEY is released first, a hold
+        (the events passed on in order, as without TapHold) when 'term' expires on the TimerWheel 'timers', when
+        another multi-function key is used or, with 'permissive', when a held back key is both pressed and
+        released. Typing keys pressed later than 'term' are not delayed at all, nor is anything outside state
+        'p'. A PKEY held for longer than 'term' and released alone sends nothing. A PKEY pressed again within
+        'quick' ms of tapping it, with no other key pressed between, is always a tap, so a typing key following
+        it is never modified.
+        Event timestamps are supervisor.ticks_ms values. Counters: 'deferred' decisions, 'taps' and 'holds'.
+    '''
+    def __init__(self, mech, term, permissive=False, quick=0, timers=None, capacity=8):
+        self._mech = mech
+        self.term = term
+        self.permissive = permissive
+        self.quick = quick
+        self._timers = timers if timers is not None else TimerWheel()
+        self._timer = -1
+        self._kt = KeyType(KeyType.allup)
+        self._bt = [None] * capacity  # Held back events
+        self._bc = bytearray(capacity)
+        self._n = 0
+        self._pup = None  # Raw key type and code releasing the PKEY of state 'p', and when it was pressed
+        self._pcode = 0
+        self._pstart = 0
+        self._quick = False
+        self._tup = None  # Raw key type and code of the last PKEY tap, and when it was released
+        self._tcode = 0
+        self._ttime = 0
+        self.deferred = 0
+        self.taps = 0
+        self.holds = 0
+
+    def __call__(self, key_type, key_code, timestamp):
+        st = key_type.state
+        if self._n:
+            if ((timestamp - self._pstart) & _TICKS_MASK) >= self.term:
+                self._hold()  # The timer would have fired by now had the main loop polled it
+            elif st is self._pup and key_code == self._pcode:
+                self._tap(timestamp)
+                return
+            elif (st is KeyType.tdown or st is KeyType.tup) and self._n < len(self._bc):
+                self._push(st, key_code)
+                if st is KeyType.tup and self.permissive and self._held(key_code): self._hold()
+                return
+            else:
+                self._hold()
+        m = self._mech
+        if m.state is KeyMech.p:
+            if st is KeyType.tdown:
+                if self._quick:
+                    self._kt.state = self._pup
+                    m(self._kt, self._pcode)
+                    self._tapped(timestamp)
+                elif ((timestamp - self._pstart) & _TICKS_MASK) < self.term:
+                    self._push(st, key_code)
+                    self._timer = self._timers.start(self._pstart + self.term, self._expire)
+                    self.deferred += 1
+                    return
+            elif st is self._pup and key_code == self._pcode:
+                if not self._quick and ((timestamp - self._pstart) & _TICKS_MASK) >= self.term:
+                    m.reset()
+                    self.holds += 1
+                    return
+                self._tapped(timestamp)
+        init = m.state is KeyMech.init
+        m(key_type, key_code)
+        if init and m.state is KeyMech.p:
+            self._pup = KeyType.lup if st is KeyType.ldown else KeyType.rup
+            self._pcode = key_code
+            self._pstart = timestamp
+            self._quick = (self.quick and self._tup is self._pup and self._tcode == key_code
+                           and ((timestamp - self._ttime) & _TICKS_MASK) < self.quick)
+        if st is KeyType.tdown or st is KeyType.ldown or st is KeyType.rdown: self._tup = None
+
+    def _push(self, st, key_code):
+        self._bt[self._n] = st
+        self._bc[self._n] = key_code
+        self._n += 1
+
+    def _held(self, key_code):
+        for i in range(self._n):
+            if self._bt[i] is KeyType.tdown and self._bc[i] == key_code: return True
+        return False
+
+    def _tapped(self, timestamp):
+        self._tup, self._tcode, self._ttime = self._pup, self._pcode, timestamp
+        self.taps += 1
+
+    def _tap(self, timestamp):
+        self._kt.state = self._pup
+        self._mech(self._kt, self._pcode)
+        self._tapped(timestamp)
+        self._flush()
+
+    def _hold(self):
+        self.holds += 1
+        self._flush()
+
+    def _flush(self):
+        if self._timer >= 0:
+            self._timers.cancel(self._timer)
+            self._timer = -1
+        n = self._n
+        self._n = 0
+        if n: self._tup = None  # Keys pressed since the tap rule out a quick tap
+        for i in range(n):
+            self._kt.state = self._bt[i]
+            self._bt[i] = None
+            self._mech(self._kt, self._bc[i])
+
+    def _expire(self, arg):
+        self._timer = -1
+        if self._n: self._hold()
+
+class ActionQueue:
+    ''' Bounded ring of pending USB actions held in preallocated slots as (ActionType, codes) pairs. The keys which
+        will be down once everything queued has been sent are tracked in a bitmap so that actions which would not
+        change the HID report (pressing keys already down, releasing keys already up, RELEASE_ALL with nothing down)
+        are coalesced away as they are queued. A queued LED_STATE may or may not send lock keys, so coalescing is
+        suspended after one until the next RELEASE_ALL or SEND makes the outcome certain again.
+        Counters: 'coalesced' actions removed, 'overflows' actions forced out early because the ring was full and
+        'high_water' the greatest number queued at once.
+    '''
+    def __init__(self, capacity=64):
+        self._n = int(capacity)
+        self._t = [None] * self._n
+        self._c = [None] * self._n
+        self._h = 0
+        self._len = 0
+        self._down = bytearray(32)
+        self._ndown = 0
+        self._known = True
+        self.coalesced = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        ''' Yields the queued (type, codes) pairs, oldest first.
+        '''
+        i = self._h
+        for k in range(self._len):
+            yield self._t[i], self._c[i]
+            i = i + 1 if i + 1 < self._n else 0
+
+    @property
+    def capacity(self):
+        return self._n
+
+    def full(self):
+        return self._len >= self._n
+
+    def push(self, type, codes):
+        ''' Queues an action unless it is redundant. The caller must make room first if the queue is full.
+        '''
+        if not self._project(type, codes):
+            self.coalesced += 1
+            return False
+        i = self._h + self._len
+        if i >= self._n: i -= self._n
+        self._t[i] = type
+        self._c[i] = codes
+        self._len += 1
+        if self._len > self.high_water: self.high_water = self._len
+        return True
+
+    def drain(self, func, count=1):
+        ''' Removes up to 'count' actions from the head, oldest first, calling func(type, *codes) for each.
+        '''
+        while count > 0 and self._len > 0:
+            i = self._h
+            t, c = self._t[i], self._c[i]
+            self._t[i] = self._c[i] = None
+            self._h = i + 1 if i + 1 < self._n else 0
+            self._len -= 1
+            count -= 1
+            func(t, *c)
+
+    def _project(self, type, codes):
+        d = self._down
+        if type is ActionType.PRESS:
+            ch = False
+            for c in codes:
+                if not d[c >> 3] & (1 << (c & 7)):
+                    d[c >> 3] |= 1 << (c & 7)
+                    self._ndown += 1
+                    ch = True
+            return ch or not self._known
+        elif type is ActionType.RELEASE:
+            ch = False
+            for c in codes:
+                if d[c >> 3] & (1 << (c & 7)):
+                    d[c >> 3] &= ~(1 << (c & 7))
+                    self._ndown -= 1
+                    ch = True
+            return ch or not self._known
+        elif type is ActionType.RELEASE_ALL or type is ActionType.SEND:
+            ch = self._ndown > 0 or not self._known or type is ActionType.SEND
+            if self._ndown:
+                for i in range(len(d)): d[i] = 0
+                self._ndown = 0
+            self._known = True
+            return ch
+        elif type is ActionType.LED_STATE:
+            self._known = False
+        return True
+
 class Usbkb:
-    ''' Encapsulates the USB HID keyboard interface. 'update' must be called at intervals. The instance
+    ''' Encapsulates the USB HID keyboard interface. 'update', or 'send' and 'poll' separately, must be called at
+        intervals. The instance
         is called when a key change is detected. Provides 'action' callback to implement USB actions.
         The mapping of keys to functions is customisable in the class passed as 'maps'.
+        USB actions are placed in an ActionQueue and 'update' sends up to OUTPUT_RATE of them per call, so a
+        slow HID write or a long MACRO never holds up key scanning. If the queue is full, the oldest action is
+        sent immediately to make room; actions are never discarded unless redundant. LED_STATE is queued like the
+        rest and returns the lock state the host will have before it is applied; the lock keys it needs are worked
+        out from the host's LEDs when it reaches the head of the queue.
+        A MACRO is typed with the lock states it depends on turned off, by queueing taps of just those lock keys
+        that are on around its steps. The lock state used is the host's last LED report with the lock key presses
+        and LED_STATE changes still queued applied, which is the state the macro will meet.
+        With TAPPING_TERM set, key events pass through a TapHold before the state machine and 'timers' must be
+        polled from the main loop.
+        With 'telemetry' (see 'telemetry') it counts events by state, reports sent and macro lengths.
     '''
-    def __init__(self, maps, debug = 0):
+    def __init__(self, maps, debug = 0, telemetry = None):
         self._maps = maps
-        self._KB_State = KeyMech(self.action, maps, debug)
+        compiled = getattr(maps, "COMPILED", False)
+        if compiled: freeze_maps(maps)
+        self._KB_State = (CompiledKeyMech if compiled else KeyMech)(self.action, maps, debug)
         self._kb = Keyboard(usb_hid.devices)
         self._kb_leds = Leds(self._kb.led_status[0])
+        self._led_raw = self._kb.led_status[0]
+        self._subs = ()
+        self._q = ActionQueue(getattr(maps, "OUTPUT_QUEUE", 64))
+        self._rate = getattr(maps, "OUTPUT_RATE", 1)
+        self.timers = TimerWheel()
+        term = getattr(maps, "TAPPING_TERM", 0)
+        self._tap = TapHold(self._KB_State, term, getattr(maps, "PERMISSIVE_HOLD", False),
+                            getattr(maps, "QUICK_TAP", 0), self.timers) if term else None
+        self._tm = telemetry
+        self._tc = None
+        if telemetry is not None:
+            self._tc = telemetry.counters
+            self._tsi = {v: i for i, v in enumerate(CompiledKeyMech.STATES)}
+            q = self._q
+            telemetry.gauge("queue_high_water", lambda: q.high_water)
+            telemetry.gauge("queue_overflows", lambda: q.overflows)
+            telemetry.gauge("coalesced", lambda: q.coalesced)
+            if self._tap is not None:
+                th = self._tap
+                telemetry.gauge("taps", lambda: th.taps)
+                telemetry.gauge("holds", lambda: th.holds)
+                telemetry.gauge("deferred", lambda: th.deferred)
         self._debug = debug
 
     def update(self):
-        leds = self._kb.led_status
-        if int(self._kb_leds) != leds[0]:
-            self._kb_leds[0:4] = leds[0]
-            if hasattr(self, 'notifier') and callable(self.notifier): self.notifier(self._kb_leds)
+        self.send()
+        self.poll()
+
+    def send(self):
+        ''' Sends up to OUTPUT_RATE queued actions.
+        '''
+        if self._q: self._q.drain(self._do, self._rate)
+
+    def poll(self):
+        ''' Reads the host's LED report and calls the subscribers if it changed.
+        '''
+        v = self._kb.led_status[0]
+        if v != self._led_raw:
+            self._led_raw = v
+            self._kb_leds[0:4] = v
+            for f in self._subs: f(self._kb_leds)
+
+    def subscribe(self, func):
+        ''' Adds func(leds) to the functions called with the Leds when the host's LED state changes.
+        '''
+        self._subs = self._subs + (func,)
+        return func
 
-    def __call__(self, keytype, keycode):
-        self._KB_State(keytype, keycode)
+    def unsubscribe(self, func):
+        self._subs = tuple(f for f in self._subs if f is not func)
+
+    @property
+    def pending(self):
+        ''' Number of queued actions not yet sent.
+        '''
+        return len(self._q)
+
+    @property
+    def queue(self):
+        return self._q
+
+    def __call__(self, keytype, keycode, timestamp=None):
+        if self._tc is not None: self._tc[self._tsi[self._KB_State.state]] += 1
+        if self._tap is None:
+            self._KB_State(keytype, keycode)
+        else:
+            self._tap(keytype, keycode, ticks_ms() if timestamp is None else timestamp)
+
+    @property
+    def taphold(self):
+        return self._tap
 
     def action(self, type, *codes):
         if len(codes) == 1 and callable(codes[0]):
@@ -317,8 +1042,53 @@ class Usbkb:
             elif codes[0] is StateControl.CMU:
                 self._KB_State._ix = -2
             return
+        if type is ActionType.MACRO:
+            if self._debug > 0: print("Usbkb.action MACRO", len(codes[0]), "steps")
+            self._macro(codes[0], codes[1] if len(codes) > 1 else 0)
+            return
         if self._debug > 0:
+            from HidUsage import USBKB as KB, USBKP as KP
             print("Usbkb.action", ActionType.class_state_name(type), tuple(Cont.namein((KB,KP),v) for v in codes))
+        if type is ActionType.LED_STATE:
+            v = self._locks()
+            self._push(type, codes)
+            return v
+        self._push(type, codes)
+
+    def _locks(self):
+        ''' Returns, as Leds bits, the lock state the host will have once the queued actions have been sent.
+        '''
+        self.poll()
+        v = int(self._kb_leds)
+        for t, codes in self._q:
+            if t is ActionType.LED_STATE:
+                v = int(codes[0]) & 0xF
+            elif t is ActionType.PRESS or t is ActionType.SEND:
+                for c in codes:
+                    for i in range(4):
+                        if c == _LOCK_CODES[i][0]: v ^= 1 << i
+        return v
+
+    def _macro(self, seq, needs):
+        if self._tc is not None:
+            self._tc[_TM_MACROS] += 1
+            self._tm.sample(_TH_MACRO, len(seq))
+        on = needs & self._locks() if needs else 0
+        for i in range(4):
+            if on & (1 << i): self._push(ActionType.SEND, _LOCK_CODES[i])
+        for t, c in seq: self._push(t, c)
+        for i in range(4):
+            if on & (1 << i): self._push(ActionType.SEND, _LOCK_CODES[i])
+
+    def _push(self, type, codes):
+        if self._q.full():
+            self._q.overflows += 1
+            self._q.drain(self._do)
+        self._q.push(type, codes)
+
+    def _do(self, type, *codes):
+        if self._tc is not None and type is not ActionType.LED_STATE:
+            self._tc[_TM_REPORTS] += 2 if type is ActionType.SEND else 1
         if type is ActionType.RELEASE_ALL:
             self._kb.release_all()
         elif type is ActionType.PRESS:
@@ -328,14 +1098,15 @@ class Usbkb:
         elif type is ActionType.SEND:
             self._kb.send(*codes)
         elif type is ActionType.LED_STATE:
-            self.update()
+            self.poll()
             os = self._kb_leds
             ds = Leds(codes[0])
             if ds == os: return ds
-            if ds[Leds.NUM_LOCK] != os[Leds.NUM_LOCK]: self._kb.send(KP.NUMLK)
-            if ds[Leds.CAPS_LOCK] != os[Leds.CAPS_LOCK]: self._kb.send(KB.CPLK)
-            if ds[Leds.SCROLL_LOCK] != os[Leds.SCROLL_LOCK]: self._kb.send(KB.SCLK)
-            if ds[Leds.COMPOSE] != os[Leds.COMPOSE]: self._kb.send(KB.APP)
+            if self._tc is not None: self._tc[_TM_REPORTS] += 2 * bin(int(ds) ^ int(os)).count("1")
+            if ds[Leds.NUM_LOCK] != os[Leds.NUM_LOCK]: self._kb.send(_KP_NUMLK)
+            if ds[Leds.CAPS_LOCK] != os[Leds.CAPS_LOCK]: self._kb.send(_KB_CPLK)
+            if ds[Leds.SCROLL_LOCK] != os[Leds.SCROLL_LOCK]: self._kb.send(_KB_SCLK)
+            if ds[Leds.COMPOSE] != os[Leds.COMPOSE]: self._kb.send(_KB_APP)
             return int(ds)
 
     @property
@@ -345,9 +1116,22 @@ class Usbkb:
 class Orthokb:
     ''' Encapsulates the hardware interface comprising a matrix of keywsitches with diodes and a chain
         of Neopixel LEDs. The hardware layout is specified in the class passed as 'maps'. 'target' must
-        be an instance of 'usbkb'.
+        be an instance of 'usbkb', which is called with each event's keypad timestamp.
+        Each 'update' takes up to EVENT_BATCH (all if 0) queued key events into one reusable Event.
+        'event_high_water' is the most events found queued at once and 'event_overflows' counts the times
+        the queue overflowed, after which the scanner is reset and all keys are treated as released.
+        KEY2MAP and MKEYMAP are resolved at construction into one descriptor per physical key number, so that
+        handling an event is a single array read and allocates nothing.
+        The scanner uses SCAN_INTERVAL and DEBOUNCE from 'maps'. A press arriving less than CHATTER_WINDOW ms
+        after the same key was released is counted as a bounce in 'bounces' (per physical key) and, with
+        CHATTER_FILTER, dropped together with its release. The filter also merges genuine repeats typed faster
+        than the window, so keep the window short. 'stats' reports these counts with the latency from the
+        scanner detecting a change to the event being handled.
+        With TRACE_EVENTS non-zero, 'trace' is an EventRecorder keeping that many of the most recent events, as
+        taken from the queue and before the chatter filter, so that a replay reproduces everything after it.
+        With 'telemetry' (see 'telemetry') event latencies go to its histogram and 'stats' values to its gauges.
     '''
-    def __init__(self, target, maps, debug = 0):
+    def __init__(self, target, maps, debug = 0, telemetry = None):
         self._target = target
         self._m = maps
         self._keytype = KeyType(KeyType.allup)
@@ -355,50 +1139,156 @@ class Orthokb:
             row_pins=maps.ROWPINS,
             column_pins=maps.COLPINS,
             columns_to_anodes=False,
+            interval=getattr(maps, "SCAN_INTERVAL", 0.02),
+            max_events=getattr(maps, "MAX_EVENTS", 64),
+            debounce_threshold=getattr(maps, "DEBOUNCE", 1),
         )
+        self._event = keypad.Event()
+        self._desc = Orthokb.descriptors(maps)
+        nk = len(self._desc)
+        self._cw = getattr(maps, "CHATTER_WINDOW", 30)
+        self._cf = getattr(maps, "CHATTER_FILTER", False)
+        self._rel = array('l', (-1 for i in range(nk)))
+        self._muted = bytearray(nk)
+        self.bounces = array('H', (0 for i in range(nk)))
+        self.reset_stats()
+        self._batch = getattr(maps, "EVENT_BATCH", 0)
+        n = getattr(maps, "TRACE_EVENTS", 0)
+        self.trace = EventRecorder(n) if n else None
+        self.event_high_water = 0
+        self.event_overflows = 0
+        self._tm = telemetry
+        if telemetry is not None:
+            telemetry.gauge("events", lambda: self.events)
+            telemetry.gauge("bounces", lambda: sum(self.bounces))
+            telemetry.gauge("chatter_suppressed", lambda: self.chatter_suppressed)
+            telemetry.gauge("event_high_water", lambda: self.event_high_water)
+            telemetry.gauge("event_overflows", lambda: self.event_overflows)
         px = neopixel.NeoPixel(
             maps.NEOPIXEL,
             48,
             brightness=maps.PIXBRIGHT,
             auto_write=False
         )
-        self._pixels = PixelMap(px, maps.MAP2PIX)
+        self._pixels = PixelMap(px, maps.MAP2PIX, frame_period=getattr(maps, "PIXEL_PERIOD", 0),
+                                framebuffer=getattr(maps, "PIXEL_FRAMEBUFFER", False))
         self._pixels.fill()
-        self._pixels.show()
+        self._pixels.show(True)
+        self._anim = Animator(self._pixels, getattr(maps, "ANIM_SLOTS", 16), getattr(maps, "ANIM_BUDGET", 0.002))
         self._kd = 0
         self._debug = debug
 
-    def update(self):
-        key_event = self._keys.events.get()
-        if key_event:
-            k = self._m.KEY2MAP[key_event.key_number]
-            m = self._m.MKEYMAP[k]
-            if key_event.pressed:
-                self._kd += 1
-                if m == 0:
-                    self._keytype[:] = KeyType.tdown
-                elif m < 0:
-                    self._keytype[:] = KeyType.rdown
-                    k = (m * -1) - 1
-                else:
-                    self._keytype[:] = KeyType.ldown
-                    k = m - 1
+    TKEY, LKEY, RKEY = 0, 1, 2  # Key classes in a descriptor
+    _DOWN = (KeyType.tdown, KeyType.ldown, KeyType.rdown)
+    _UP = (KeyType.tup, KeyType.lup, KeyType.rup)
+
+    @staticmethod
+    def descriptors(maps):
+        ''' Returns an array('H') with one entry per physical key number: the logical key number in bits 8-15,
+            the code passed to the target (logical key number for a TKEY, PKEY slot for an LKEY or RKEY) in bits
+            2-7 and the key class in bits 0-1.
+        '''
+        d = array('H')
+        for n in range(len(maps.KEY2MAP)):
+            k = maps.KEY2MAP[n]
+            m = maps.MKEYMAP[k]
+            if m == 0:
+                d.append((k << 8) | (k << 2) | Orthokb.TKEY)
+            elif m > 0:
+                d.append((k << 8) | ((m - 1) << 2) | Orthokb.LKEY)
             else:
-                self._kd -= 1
-                if m == 0:
-                    self._keytype[:] = KeyType.tup
-                elif m < 0:
-                    self._keytype[:] = KeyType.rup
-                    k = (m * -1) - 1
-                else:
-                    self._keytype[:] = KeyType.lup
-                    k = m - 1
-            self._target(self._keytype, k)
-            if self._kd < 1:
+                d.append((k << 8) | ((-m - 1) << 2) | Orthokb.RKEY)
+        return d
+
+    def update(self):
+        q = self._keys.events
+        if q.overflowed:
+            self.event_overflows += 1
+            q.clear()
+            self._keys.reset()
+            for i in range(len(self._muted)):  # The scanner reports held keys afresh, chattering or not
+                self._muted[i] = 0
+                self._rel[i] = -1
+            if self.trace is not None: self.trace.mark(ticks_ms())
+            if self._kd:
                 self._kd = 0
-                self._keytype[:] = KeyType.allup
-                self._target(self._keytype, k)
+                self._keytype.state = KeyType.allup
+                self._target(self._keytype, 0)
+            return
+        n = len(q)
+        if n > self.event_high_water: self.event_high_water = n
+        if self._batch: n = min(n, self._batch)
+        key_event = self._event
+        rec = self.trace
+        tm = self._tm
+        if n: now = ticks_ms()
+        while n > 0 and q.get_into(key_event):
+            n -= 1
+            if rec is not None: rec.record(key_event.key_number, key_event.pressed, key_event.timestamp)
+            lat = (now - key_event.timestamp) & _TICKS_MASK
+            if lat > self.latency_max: self.latency_max = lat
+            self._lat_sum += lat
+            if tm is not None: tm.sample(_TH_LATENCY, lat)
+            self.events += 1
+            self._handle(key_event)
+
+    def _handle(self, key_event):
+        kn = key_event.key_number
+        d = self._desc[kn]
+        k = (d >> 2) & 0x3F
+        if key_event.pressed:
+            r = self._rel[kn]
+            if r >= 0 and ((key_event.timestamp - r) & _TICKS_MASK) < self._cw:
+                self.bounces[kn] += 1
+                if self._cf:
+                    self._muted[kn] = 1
+                    self.chatter_suppressed += 1
+                    return
+            self._kd += 1
+            self._keytype.state = Orthokb._DOWN[d & 3]
+        else:
+            if self._muted[kn]:
+                self._muted[kn] = 0
+                self.chatter_suppressed += 1
+                return
+            self._rel[kn] = key_event.timestamp
+            self._kd -= 1
+            self._keytype.state = Orthokb._UP[d & 3]
+        self._target(self._keytype, k, key_event.timestamp)
+        if self._kd < 1:
+            self._kd = 0
+            self._keytype.state = KeyType.allup
+            self._target(self._keytype, k, key_event.timestamp)
+
+    def reset_stats(self):
+        for i in range(len(self.bounces)): self.bounces[i] = 0
+        self.chatter_suppressed = 0
+        self.events = 0
+        self.latency_max = 0
+        self._lat_sum = 0
+
+    @property
+    def stats(self):
+        ''' Event and debounce statistics since construction or 'reset_stats'. 'bounce_keys' pairs the logical
+            number of each key that bounced with its count. Latencies are in ms.
+        '''
+        return dict(
+            events=self.events, bounces=sum(self.bounces), chatter_suppressed=self.chatter_suppressed,
+            bounce_keys=tuple((self._desc[i] >> 8, self.bounces[i]) for i in range(len(self.bounces)) if self.bounces[i]),
+            latency_max=self.latency_max, latency_mean=self._lat_sum / self.events if self.events else 0,
+            event_high_water=self.event_high_water, event_overflows=self.event_overflows
+        )
+
+    @property
+    def keys_down(self):
+        ''' Number of keys currently held.
+        '''
+        return self._kd
 
     @property
     def pixels(self):
         return self._pixels
+
+    @property
+    def anim(self):
+        return self._anim
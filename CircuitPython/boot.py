@@ -1,10 +1,17 @@
 import board, digitalio
 import storage, usb_cdc, usb_hid
 
+TELEMETRY = False  # Keep the usb_cdc data channel outside debug mode, for KEY_MAPS.TELEMETRY (see code.py 'serve')
+
 s1 = digitalio.DigitalInOut(board.A0)
 s1.pull = digitalio.Pull.UP
 
 if s1.value:
     storage.disable_usb_drive()
-    usb_cdc.disable()
+    if TELEMETRY:
+        usb_cdc.enable(console=False, data=True)
+    else:
+        usb_cdc.disable()
     usb_hid.enable((Device.KEYBOARD), boot_device=1)
+else:
+    usb_cdc.enable(console=True, data=True)  # Data channel answers host tool requests (see code.py 'serve')
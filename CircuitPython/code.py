@@ -1,24 +1,30 @@
 import time
-import board, digitalio
+import board, digitalio, usb_cdc
+
+# s1 is used in boot.py to control presentation of CIRCUITPY and serial console
+s1 = digitalio.DigitalInOut(board.A0)
+s1.pull = digitalio.Pull.UP
+debug = 1 if not s1.value else 0
+
+from JH_Prof import Profiler
+prof = Profiler(debug > 0)  # Startup time and heap report, printed when debug is set
+prof.imports("JH_Lib", "adafruit_led_animation.color", "JH_PixelMap", "JH_Anim", "JH_Trace", "JH_Telem", "JH_Sched",
+             "JH_Heap", "adafruit_hid.keyboard", "Ortho")  # Modules imported by code.py or Ortho
+
 from JH_Lib import IMap
-from JH_PixelMap import PixelMap
+from JH_Sched import Scheduler, ticks_ms
+from JH_Heap import HeapMonitor
 from Ortho import KeyMap
 from Ortho import ChordMap
 from Ortho import Usbkb
 from Ortho import Orthokb
+from Ortho import load_maps
+from Ortho import telemetry
 from Ortho import StateControl as SC
-from HidUsage import USBKB as KB
-from HidUsage import USBKP as KP
-from HidUsage import USBCO
 import adafruit_led_animation.color as C
 
 PKEYS = 4 # The number of special keys in the LKEY and RKEY sets (many tuples below must have this number of elements)
 
-# s1 is used in boot.py to control presentation of CIRCUITPY and serial console
-s1 = digitalio.DigitalInOut(board.A0)
-s1.pull = digitalio.Pull.UP
-debug = 1 if not s1.value else 0
-
 # s2 is used to control US or Non-US key interpretation
 s2 = digitalio.DigitalInOut(board.A1)
 s2.pull = digitalio.Pull.UP
@@ -26,12 +32,11 @@ s2.pull = digitalio.Pull.UP
 s3 = digitalio.DigitalInOut(board.D6)
 s3.pull = digitalio.Pull.UP
 
-CO = USBCO(us=s2.value, apple=s3.value)
-
 s4 = digitalio.DigitalInOut(board.D9)
 s4.pull = digitalio.Pull.UP
 
 
+prof.begin()
 class KEY_MAPS:
     ''' Never instanced, this class is a container for constants defining the hardware layout. Must Contain:
         ROWPINS: Tuple of the GPIO pins used as row sense lines in the keyswitch matrix.
@@ -42,6 +47,26 @@ class KEY_MAPS:
         NEOPIXEL: Single GPIO pin used to drive the Neopixel chain.
         PIXBRIGHT: Float 0..1 representing the base brightness of the NeoPixels.
         MAP2PIX: Tuple containing a tuple per row with each having an integer element, the NeoPixel address, per column.
+        May Contain:
+        MAX_EVENTS (default 64): Capacity of the keypad event queue.
+        SCAN_INTERVAL (default 0.02): Seconds between scans of the key matrix by the keypad module.
+        DEBOUNCE (default 1): Scans a key must be seen in a new state before the keypad module reports it.
+        CHATTER_WINDOW (default 30): A press less than this many ms after the same key's release counts as a bounce.
+        CHATTER_FILTER (default False): Drop such a press and its release (see Orthokb).
+        EVENT_BATCH (default 0): Maximum key events handled per main loop iteration, 0 for all that are queued.
+        SCAN_PERIOD (default 0): Seconds between runs of the task handling key events and sending USB reports.
+        LED_PERIOD (default 0.05): Seconds between polls of the host's lock LED state.
+        PIXEL_PERIOD (default 0.02): Minimum seconds between NeoPixel refreshes (the PixelMap frame cap).
+        PIXEL_FRAMEBUFFER (default False): Keep pixels in a PixelMap framebuffer copied to the strip in one go.
+        ANIM_SLOTS (default 16): Number of LED animations that may run at once.
+        ANIM_BUDGET (default 0.002): Maximum seconds spent advancing LED animations per pixel refresh.
+        GC_MANUAL (default False): Disable automatic garbage collection and collect only when no keys are down
+            (after GC_IDLE_BYTES have been allocated) or when free heap falls below GC_THRESHOLD bytes.
+        GC_THRESHOLD (default 16384): Free heap in bytes below which a collection is forced with GC_MANUAL.
+        GC_IDLE_BYTES (default 4096): Bytes allocated since the last collection before an idle collection.
+        TRACE_EVENTS (default 0): Number of recent key events kept for replay by 'Host/Replay.py', 0 for none.
+        TELEMETRY (default False): Keep counters and histograms for 'Host/Telem.py' (see Ortho 'telemetry'). They
+            are sent over the usb_cdc data channel, which boot.py enables in debug mode or with its TELEMETRY set.
     '''
 
     ROWPINS = (board.D25, board.D24, board.A3, board.A2, board.D10, board.D11, board.D12, board.D13)
@@ -70,6 +95,40 @@ class KEY_MAPS:
 
     PIXBRIGHT = 0.3
 
+    MAX_EVENTS = 64
+
+    SCAN_INTERVAL = 0.02
+
+    DEBOUNCE = 1
+
+    CHATTER_WINDOW = 30
+
+    CHATTER_FILTER = False
+
+    EVENT_BATCH = 0
+
+    SCAN_PERIOD = 0.001
+
+    LED_PERIOD = 0.05
+
+    PIXEL_PERIOD = 0.02
+
+    PIXEL_FRAMEBUFFER = False
+
+    ANIM_SLOTS = 16
+
+    ANIM_BUDGET = 0.002
+
+    GC_MANUAL = False
+
+    GC_THRESHOLD = 16384
+
+    GC_IDLE_BYTES = 4096
+
+    TRACE_EVENTS = 0
+
+    TELEMETRY = False
+
     MAP2PIX = (
         ( 36,37,38,39,40,41,42,43,44,45,46,47 ),
         ( 35,34,33,32,31,30,29,28,27,26,25,24 ),
@@ -77,183 +136,259 @@ class KEY_MAPS:
         ( 11,10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0 )
     )
 
+prof.end("KEY_MAPS")
+
+prof.begin(KeyMap, ChordMap, IMap)
+try:
+    import CompiledMaps  # Packed tables written by Host/Compile.py from the CODE_MAPS class below
+    CODE_MAPS = load_maps(CompiledMaps, s2.value, s3.value)
+except ImportError:
+    CODE_MAPS = None
+
+if CODE_MAPS is None:  # No usable compiled maps, so build them from source
+    from HidUsage import USBKB as KB  # Only needed here, so not imported when the maps are compiled
+    from HidUsage import USBKP as KP
+    from HidUsage import USBCO
+    CO = USBCO(us=s2.value, apple=s3.value)
+
+    class CODE_MAPS:
+        ''' Never instanced, this class is a container for constants defining the keyboard to USB HID mappings. May Contain:
+            KeyMap instances: The entries can be USB constants from the KB (keyboard) or KP (keypad) classes, tuples of up to
+                six such constances (keys to be down simultaneously), constants from an instance of the USBCO class named CO
+                which containes named multi-key tuples tailored for either US or Non-US keyboard settings, and Enum values
+                from the SC class which supply state switches processed internally to the keyboard, or strings.
+            CodeMap: These are KeyMap instances indexed by character codes in strings. If another KeyMap instance contains
+                strings, it must have a code_map parameter specified to supplu the USB keycodes for each possible character.
+            KeyMap: These are KeyMap instances indexed by logical key number. They contain the USB actions triggered by each
+                typing key. These maps are activated by chords of the multifunction keys and are referenced in the CHORDS
+                map. They may also be used as base maps for overlays and specified in the base_map parameter. Any entry in
+                the overlay map which is not indexed or has the value None will delegate through to the base_map recursively.
+            CHORDS (required singleton instance of ChordMap): One entry per binary combination of PKEY (therefore 2**PKEYS
+                entries). Values must be None, a KeyMap instance or a Tuple of KeyMap instance and a Colour tuple.
+            PTAP (required KeyMap instance with one entry per PKEY): Actions when a single PKEY is tapped, possibly with a
+                chord of SKEY modifiers, after SC.CML.
+            UTAP (required KeyMap instance with one entry per PKEY): Actions when a single PKEY is tapped after a chord of
+                SKEY modifiers, after SC.CMU. Typically would also be assigned to the shift key entry in SFUNC.
+            LMOD (required KeyMap instance with one entry per PKEY): Wrapping actions when a PKEY is held down and TKEY or
+                SKEY is/are tapped. These codes are typically the modifiers Shift, Cntrl, Alt and Gui when PKEY = LKEY.
+            RMOD (required KeyMap instance with one entry per PKEY): Ditto LMOD, but when PKEY = RKEY.
+            SFUNCS (required IMap instance with one entry per PKEY): Contains a KeyMap for each single PKEY held down while
+                SKEY are tapped. Each KeyMap contains one entry for each SKEY. The SC.CMU and/or SC.CML actions, if assigned,
+                must be assigned in these KeyMaps and normally would be assigned to all entries in the KeyMap.
+            CFUNC (required KeyMap instance with one entry per PKEY): Actions when a chord of PKEY is held down and SKEY
+                are tapped. SC.MLK would normally be assigned to one of these keys to lock in a map selection.
+            COMPILED (optional boolean, default False): Precompile at startup. Every KeyMap is frozen into a flat table
+                with its base_map chain resolved, and CompiledKeyMech, which dispatches the keyboard state machine
+                through integer indexed tables, is used in place of the interpreted KeyMech.
+            OUTPUT_QUEUE (optional integer, default 64): Capacity of the queue of USB actions waiting to be sent.
+            OUTPUT_RATE (optional integer, default 1): Maximum number of queued USB actions sent per main loop iteration.
+            TAPPING_TERM (optional integer, default 0): Milliseconds within which a lone PKEY released is a tap even if
+                typing keys were pressed while it was down, and after which it is a hold (see TapHold). 0 decides by
+                event order alone.
+            PERMISSIVE_HOLD (optional boolean, default False): A typing key pressed and released while a PKEY is down
+                makes it a hold within TAPPING_TERM.
+            QUICK_TAP (optional integer, default 0): A PKEY pressed again within this many ms of tapping it is a tap.
+            When a 'CompiledMaps' module written by Host/Compile.py is installed, this class is not built and the maps
+            are loaded from its packed tables by 'load_maps' instead, so recompile after any change here.
+        '''
+
+        COMPILED = False
+
+        OUTPUT_QUEUE = 64
+
+        OUTPUT_RATE = 1
+
+        TAPPING_TERM = 0
+
+        PERMISSIVE_HOLD = False
+
+        QUICK_TAP = 0
+
+        CODE_TABLE_UK = KeyMap(
+            ( # CodeMap for UK ASCII
+                KB.ENT, ) + (None,)*18 + (
+                KB.SP, CO.EXCM, CO.DQOT, CO.HASH, CO.DOLR, CO.PCNT, CO.AMPS, KB.QUOTE,
+                CO.OBKT, CO.CBKT, CO.STAR, CO.PLUS, KB.COMMA, KB.MINUS, KB.FSTOP, KB.FSLSH,
+                KB.D0, KB.D1, KB.D2, KB.D3, KB.D4, KB.D5, KB.D6, KB.D7, KB.D8, KB.D9,
+                CO.COLON, KB.SEMIC, CO.OANG, KB.EQ, CO.CANG, CO.QMK, CO.AT,
+                (KB.LSFT, KB.A), (KB.LSFT, KB.B), (KB.LSFT, KB.C), (KB.LSFT, KB.D), (KB.LSFT, KB.E), (KB.LSFT, KB.F), (KB.LSFT, KB.G),
+                (KB.LSFT, KB.H), (KB.LSFT, KB.I), (KB.LSFT, KB.J), (KB.LSFT, KB.K), (KB.LSFT, KB.L), (KB.LSFT, KB.M), (KB.LSFT, KB.N),
+                (KB.LSFT, KB.O), (KB.LSFT, KB.P), (KB.LSFT, KB.Q), (KB.LSFT, KB.R), (KB.LSFT, KB.S), (KB.LSFT, KB.T), (KB.LSFT, KB.U),
+                (KB.LSFT, KB.V), (KB.LSFT, KB.W), (KB.LSFT, KB.X), (KB.LSFT, KB.Y), (KB.LSFT, KB.Z),
+                KB.OBRCE, CO.BSLSH, KB.CBRCE, CO.CRT, CO.USCORE, CO.GRAVE,
+                KB.A, KB.B, KB.C, KB.D, KB.E, KB.F, KB.G, KB.H, KB.I, KB.J, KB.K, KB.L, KB.M, KB.N, KB.O,
+                KB.P, KB.Q, KB.R, KB.S, KB.T, KB.U, KB.V, KB.W, KB.X, KB.Y, KB.Z,
+                CO.OCURL, CO.PIPE, CO.CCURL, CO.TILD
+            ),
+            first_index = 13
+        )
 
-class CODE_MAPS:
-    ''' Never instanced, this class is a container for constants defining the keyboard to USB HID mappings. May Contain:
-        KeyMap instances: The entries can be USB constants from the KB (keyboard) or KP (keypad) classes, tuples of up to
-            six such constances (keys to be down simultaneously), constants from an instance of the USBCO class named CO
-            which containes named multi-key tuples tailored for either US or Non-US keyboard settings, and Enum values
-            from the SC class which supply state switches processed internally to the keyboard, or strings.
-        CodeMap: These are KeyMap instances indexed by character codes in strings. If another KeyMap instance contains
-            strings, it must have a code_map parameter specified to supplu the USB keycodes for each possible character.
-        KeyMap: These are KeyMap instances indexed by logical key number. They contain the USB actions triggered by each
-            typing key. These maps are activated by chords of the multifunction keys and are referenced in the CHORDS
-            map. They may also be used as base maps for overlays and specified in the base_map parameter. Any entry in
-            the overlay map which is not indexed or has the value None will delegate through to the base_map recursively.
-        CHORDS (required singleton instance of ChordMap): One entry per binary combination of PKEY (therefore 2**PKEYS
-            entries). Values must be None, a KeyMap instance or a Tuple of KeyMap instance and a Colour tuple.
-        PTAP (required KeyMap instance with one entry per PKEY): Actions when a single PKEY is tapped, possibly with a
-            chord of SKEY modifiers, after SC.CML.
-        UTAP (required KeyMap instance with one entry per PKEY): Actions when a single PKEY is tapped after a chord of
-            SKEY modifiers, after SC.CMU. Typically would also be assigned to the shift key entry in SFUNC.
-        LMOD (required KeyMap instance with one entry per PKEY): Wrapping actions when a PKEY is held down and TKEY or
-            SKEY is/are tapped. These codes are typically the modifiers Shift, Cntrl, Alt and Gui when PKEY = LKEY.
-        RMOD (required KeyMap instance with one entry per PKEY): Ditto LMOD, but when PKEY = RKEY.
-        SFUNCS (required IMap instance with one entry per PKEY): Contains a KeyMap for each single PKEY held down while
-            SKEY are tapped. Each KeyMap contains one entry for each SKEY. The SC.CMU and/or SC.CML actions, if assigned,
-            must be assigned in these KeyMaps and normally would be assigned to all entries in the KeyMap.
-        CFUNC (required KeyMap instance with one entry per PKEY): Actions when a chord of PKEY is held down and SKEY
-            are tapped. SC.MLK would normally be assigned to one of these keys to lock in a map selection.
-    '''
-
-    CODE_TABLE_UK = KeyMap(
-        ( # CodeMap for UK ASCII
-            KB.ENT, ) + (None,)*18 + (
-            KB.SP, CO.EXCM, CO.DQOT, CO.HASH, CO.DOLR, CO.PCNT, CO.AMPS, KB.QUOTE,
-            CO.OBKT, CO.CBKT, CO.STAR, CO.PLUS, KB.COMMA, KB.MINUS, KB.FSTOP, KB.FSLSH,
-            KB.D0, KB.D1, KB.D2, KB.D3, KB.D4, KB.D5, KB.D6, KB.D7, KB.D8, KB.D9,
-            CO.COLON, KB.SEMIC, CO.OANG, KB.EQ, CO.CANG, CO.QMK, CO.AT,
-            (KB.LSFT, KB.A), (KB.LSFT, KB.B), (KB.LSFT, KB.C), (KB.LSFT, KB.D), (KB.LSFT, KB.E), (KB.LSFT, KB.F), (KB.LSFT, KB.G),
-            (KB.LSFT, KB.H), (KB.LSFT, KB.I), (KB.LSFT, KB.J), (KB.LSFT, KB.K), (KB.LSFT, KB.L), (KB.LSFT, KB.M), (KB.LSFT, KB.N),
-            (KB.LSFT, KB.O), (KB.LSFT, KB.P), (KB.LSFT, KB.Q), (KB.LSFT, KB.R), (KB.LSFT, KB.S), (KB.LSFT, KB.T), (KB.LSFT, KB.U),
-            (KB.LSFT, KB.V), (KB.LSFT, KB.W), (KB.LSFT, KB.X), (KB.LSFT, KB.Y), (KB.LSFT, KB.Z),
-            KB.OBRCE, CO.BSLSH, KB.CBRCE, CO.CRT, CO.USCORE, CO.GRAVE,
-            KB.A, KB.B, KB.C, KB.D, KB.E, KB.F, KB.G, KB.H, KB.I, KB.J, KB.K, KB.L, KB.M, KB.N, KB.O,
-            KB.P, KB.Q, KB.R, KB.S, KB.T, KB.U, KB.V, KB.W, KB.X, KB.Y, KB.Z,
-            CO.OCURL, CO.PIPE, CO.CCURL, CO.TILD
-        ),
-        first_index = 13
-    )
-
-    KEY_MAP_QWERTY = KeyMap(
-        ( # KeyMap for basic QWERTY alpha-numeric layer.
-            None, KB.D1, KB.D2, KB.D3, KB.D4, KB.D5, KB.D6, KB.D7, KB.D8, KB.D9, KB.D0, None,
-            None, KB.Q, KB.W, KB.E, KB.R, KB.T, KB.Y, KB.U, KB.I, KB.O, KB.P, None,
-            None, KB.A, KB.S, KB.D, KB.F, KB.G, KB.H, KB.J, KB.K, KB.L, KB.SEMIC, None,
-            None, KB.QUOTE, KB.Z, KB.X, KB.C, KB.V, KB.B, KB.N, KB.M, KB.COMMA, KB.FSTOP, None
+        KEY_MAP_QWERTY = KeyMap(
+            ( # KeyMap for basic QWERTY alpha-numeric layer.
+                None, KB.D1, KB.D2, KB.D3, KB.D4, KB.D5, KB.D6, KB.D7, KB.D8, KB.D9, KB.D0, None,
+                None, KB.Q, KB.W, KB.E, KB.R, KB.T, KB.Y, KB.U, KB.I, KB.O, KB.P, None,
+                None, KB.A, KB.S, KB.D, KB.F, KB.G, KB.H, KB.J, KB.K, KB.L, KB.SEMIC, None,
+                None, KB.QUOTE, KB.Z, KB.X, KB.C, KB.V, KB.B, KB.N, KB.M, KB.COMMA, KB.FSTOP, None
+            )
         )
-    )
 
-    KEY_MAP_EXTENDED = KeyMap(
-        ( # KeyMap for overflow layer with function keys and extra punctuation.
-            None, KB.F1, KB.F2, KB.F3, KB.F4, KB.F5, KB.F6, KB.F7, KB.F8, KB.F9, KB.F10, None,
-            None, CO.QMK, KB.UP, CO.HASH, KB.PGUP, KB.HOME, CO.NOTS, CO.PLUS, KB.MINUS, KB.OBRCE, KB.CBRCE, None,
-            None, KB.LEFT, KB.DOWN, KB.RIGHT, KB.PGDN, KB.END, CO.GRAVE, CO.TILD, KB.EQ, CO.OCURL, CO.CCURL, None,
-            None, KB.F11, KB.F12, KB.F13, KB.F14, KB.F15, KB.F16, CO.PIPE, CO.USCORE, KB.FSLSH, CO.BSLSH, None
+        KEY_MAP_EXTENDED = KeyMap(
+            ( # KeyMap for overflow layer with function keys and extra punctuation.
+                None, KB.F1, KB.F2, KB.F3, KB.F4, KB.F5, KB.F6, KB.F7, KB.F8, KB.F9, KB.F10, None,
+                None, CO.QMK, KB.UP, CO.HASH, KB.PGUP, KB.HOME, CO.NOTS, CO.PLUS, KB.MINUS, KB.OBRCE, KB.CBRCE, None,
+                None, KB.LEFT, KB.DOWN, KB.RIGHT, KB.PGDN, KB.END, CO.GRAVE, CO.TILD, KB.EQ, CO.OCURL, CO.CCURL, None,
+                None, KB.F11, KB.F12, KB.F13, KB.F14, KB.F15, KB.F16, CO.PIPE, CO.USCORE, KB.FSLSH, CO.BSLSH, None
+            )
         )
-    )
 
-    KEY_MAP_TEST = KeyMap(
-        ( # Test overlay KeyMap with a string.
-            "John Hind\r",
-        ),
-        base_map = KEY_MAP_QWERTY,
-        code_map = CODE_TABLE_UK,
-        first_index = 1
-    )
+        KEY_MAP_TEST = KeyMap(
+            ( # Test overlay KeyMap with a string.
+                "John Hind\r",
+            ),
+            base_map = KEY_MAP_QWERTY,
+            code_map = CODE_TABLE_UK,
+            first_index = 1
+        )
 
-    CHORDS = ChordMap(
-        (
-            None,     # Chord 0000 (CANNOT BE ACCESSED)
-            None,     # Chord 0001 (ONLY ACCESSED AFTER TWO KEY CHORD)
-            None,     # Chord 0010 (ONLY ACCESSED AFTER TWO KEY CHORD)
-            (KEY_MAP_TEST, C.GREEN),    # Chord 0011
-            None,     # Chord 0100
-            None,     # Chord 0101
-            (KEY_MAP_EXTENDED, C.RED),  # Chord 0110
-            None,     # Chord 0111
-            None,     # Chord 1000 (ONLY ACCESSED AFTER TWO KEY CHORD)
-            None,     # Chord 1001
-            None,     # Chord 1010
-            None,     # Chord 1011
-            (KEY_MAP_QWERTY, C.BLACK),  # Chord 1100
-            None,     # Chord 1101
-            None,     # Chord 1110
-            None      # Chord 1111
-        ),
-        pkeys = PKEYS,
-        initial = 0b1100
-    )
+        CHORDS = ChordMap(
+            (
+                None,     # Chord 0000 (CANNOT BE ACCESSED)
+                None,     # Chord 0001 (ONLY ACCESSED AFTER TWO KEY CHORD)
+                None,     # Chord 0010 (ONLY ACCESSED AFTER TWO KEY CHORD)
+                (KEY_MAP_TEST, C.GREEN),    # Chord 0011
+                None,     # Chord 0100
+                None,     # Chord 0101
+                (KEY_MAP_EXTENDED, C.RED),  # Chord 0110
+                None,     # Chord 0111
+                None,     # Chord 1000 (ONLY ACCESSED AFTER TWO KEY CHORD)
+                None,     # Chord 1001
+                None,     # Chord 1010
+                None,     # Chord 1011
+                (KEY_MAP_QWERTY, C.BLACK),  # Chord 1100
+                None,     # Chord 1101
+                None,     # Chord 1110
+                None      # Chord 1111
+            ),
+            pkeys = PKEYS,
+            initial = 0b1100
+        )
 
-    PTAP = KeyMap(
-        (
-            KB.BS,
-            KB.TAB,
-            KB.ENT,
-            KB.SP
+        PTAP = KeyMap(
+            (
+                KB.BS,
+                KB.TAB,
+                KB.ENT,
+                KB.SP
+            )
         )
-    )
 
-    UTAP = KeyMap(
-        (
-            KB.DEL,
-            KB.INS,
-            KB.ESC,
-            KB.CPLK
+        UTAP = KeyMap(
+            (
+                KB.DEL,
+                KB.INS,
+                KB.ESC,
+                KB.CPLK
+            )
         )
-    )
-    LMOD = KeyMap(
-        (
-            KB.LGUI,
-            KB.LALT,
-            KB.LCTL,
-            KB.LSFT
+        LMOD = KeyMap(
+            (
+                KB.LGUI,
+                KB.LALT,
+                KB.LCTL,
+                KB.LSFT
+            )
         )
-    )
 
-    RMOD = KeyMap(
-        (
-            KB.RGUI,
-            KB.RALT,
-            KB.RCTL,
-            KB.RSFT
+        RMOD = KeyMap(
+            (
+                KB.RGUI,
+                KB.RALT,
+                KB.RCTL,
+                KB.RSFT
+            )
         )
-    )
 
-    SFUNCS = IMap(
-        (
-            KeyMap((KB.UP, KB.RIGHT, KB.LEFT, KB.DOWN)),
-            KeyMap((SC.CMU,)*PKEYS),
-            KeyMap((SC.CML,)*PKEYS),
-            UTAP
+        SFUNCS = IMap(
+            (
+                KeyMap((KB.UP, KB.RIGHT, KB.LEFT, KB.DOWN)),
+                KeyMap((SC.CMU,)*PKEYS),
+                KeyMap((SC.CML,)*PKEYS),
+                UTAP
+            )
         )
-    )
 
-    CFUNC = KeyMap(
-        (
-            KB.DEL,
-            KB.INS,
-            KB.ESC,
-            SC.MLK
+        CFUNC = KeyMap(
+            (
+                KB.DEL,
+                KB.INS,
+                KB.ESC,
+                SC.MLK
+            )
         )
-    )
 
-def update_leds(self, leds):
-    kb.pixels.indexing()
-    kb.pixels[(37,46)] = C.BLUE if leds[leds.CAPS_LOCK] else C.BLACK
-    kb.pixels.show()
+prof.end("CODE_MAPS", CODE_MAPS)
 
-Usbkb.notifier = update_leds
+def update_leds(leds):
+    kb.anim.fade((37,46), C.BLUE if leds[leds.CAPS_LOCK] else C.BLACK)
+
+CHORD_PIX = ((0, 11), (12, 23), (24, 35), (36, 47))
 
 def update_chords(newchord, colour):
-    kb.pixels.indexing(index_mode=PixelMap.COLUMNS)
-    kb.pixels[(0,11)] = C.BLACK
-    kb.pixels.indexing(index_mode=PixelMap.RASTER)
-    if colour != C.BLACK:
-        px = []
-        if newchord[0]: px.extend((0, 11))
-        if newchord[1]: px.extend((12, 23))
-        if newchord[2]: px.extend((24, 35))
-        if newchord[3]: px.extend((36, 47))
-        kb.pixels[px] = colour
-    kb.pixels.show()
-
-CODE_MAPS.CHORDS.notifier = update_chords
-
-time.sleep(2)  # Sleep for a bit to avoid a race condition on some systems
-
-usb = Usbkb(CODE_MAPS, debug)
-kb = Orthokb(usb, KEY_MAPS, debug)
-while True:
+    for i in range(PKEYS):
+        kb.anim.fade(CHORD_PIX[i], colour if newchord[i] and colour != C.BLACK else C.BLACK, 0.1)
+
+CODE_MAPS.CHORDS.subscribe(update_chords)
+
+_loop = [0, 0]  # Main loop period histogram index and last scan tick
+
+def scan():
+    if telem is not None:
+        t = ticks_ms()
+        telem.sample(_loop[0], (t - _loop[1]) & 0x1FFFFFFF)
+        _loop[1] = t
     kb.update()
-    usb.update()
\ No newline at end of file
+    usb.timers.poll(ticks_ms())
+    usb.send()
+    heap.check(kb.keys_down == 0 and not usb.pending)
+
+def pixels():
+    CODE_MAPS.CHORDS.notify()  # Chord changes since the last frame are delivered as one
+    kb.anim.update()
+
+def serve():
+    ''' Answers single byte requests from the host tools on the usb_cdc data channel, enabled by boot.py in
+        debug mode. 'T' dumps the key event trace, 'M' sends a telemetry frame and 'S' the frame naming its values.
+    '''
+    port = usb_cdc.data
+    if port is None or not port.in_waiting: return
+    c = port.read(1)
+    if c == b"T" and kb.trace is not None: kb.trace.dump(port.write)
+    elif c == b"M" and telem is not None: port.write(telem.frame(ticks_ms()))
+    elif c == b"S" and telem is not None: port.write(telem.schema(ticks_ms()))
+
+if __name__ == "__main__":  # Allows the maps above to be imported by the host-side tools in 'Host'
+    time.sleep(2)  # Sleep for a bit to avoid a race condition on some systems
+
+    telem = telemetry() if getattr(KEY_MAPS, "TELEMETRY", False) else None
+    prof.begin()
+    usb = Usbkb(CODE_MAPS, debug, telem)
+    usb.subscribe(update_leds)
+    prof.end("Usbkb")
+    prof.begin()
+    kb = Orthokb(usb, KEY_MAPS, debug, telem)
+    prof.end("Orthokb")
+    prof.report()
+    heap = HeapMonitor(getattr(KEY_MAPS, "GC_MANUAL", False), getattr(KEY_MAPS, "GC_THRESHOLD", 16384),
+                       getattr(KEY_MAPS, "GC_IDLE_BYTES", 4096))
+    if telem is not None:
+        telem.gauge("heap_free", lambda: heap.stats["free"] or 0)
+        telem.gauge("gc_collections", lambda: heap.collections + heap.auto_collections)
+        _loop[0] = telem.histogram("loop_ms")
+        _loop[1] = ticks_ms()
+    sched = Scheduler()
+    sched.add(scan, getattr(KEY_MAPS, "SCAN_PERIOD", 0), "scan")
+    sched.add(usb.poll, getattr(KEY_MAPS, "LED_PERIOD", 0.05), "leds")
+    sched.add(pixels, getattr(KEY_MAPS, "PIXEL_PERIOD", 0.02), "pixels")
+    if debug: sched.add(heap.report, 10, "heap")
+    if usb_cdc.data is not None: sched.add(serve, 0.1, "serve")
+    sched.run()
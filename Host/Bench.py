@@ -0,0 +1,119 @@
+'''
+Key-to-HID latency benchmark. Replays scripted traces that exercise each KeyMech state and reports per-event
+latency percentiles and events per second grouped by the state the event arrived in. Results may be saved and
+compared against a previous run to act as a regression gate:
+
+    python Host/Bench.py --save base.json
+    python Host/Bench.py --compare base.json --tolerance 20
+    python Host/Bench.py --trace typing.trace       # add a trace recorded from real typing (see Replay.py)
+'''
+
+import argparse
+import ast
+import json
+import os
+import sys
+
+from Sim import Sim, down, up, hold, tap, L1, L2, L3, L4, R1, R2, R3, R4
+import Replay
+
+STATES = ("init", "p", "pt", "ps", "s", "pp")
+TYPING = (13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 25, 26, 27, 28, 29)
+
+SCENARIOS = {
+    # Plain typing on the selected layer.
+    "type": tap(*TYPING),
+    # PKEY taps (backspace, tab, enter, space).
+    "ptap": tap(L1, L2, L3, L4, R1, R2, R3, R4),
+    # PKEY held as a modifier over typing keys.
+    "modify": hold((L4,), tap(*TYPING[:6])) + hold((R4,), tap(*TYPING[6:12])),
+    # PKEY held while SKEY functions (arrows) are tapped.
+    "sfunc": hold((L1,), tap(R1, R2, R3, R4)),
+    # Sticky SKEY modifiers: hold P3, S2, S3, release P3 then tap typing keys and a PKEY.
+    "stick": down(L3) + down(R2) + down(R3) + up(L3) + tap(*TYPING[:6], L4) + up(R3) + up(R2),
+    # PKEY chord selecting the overflow layer.
+    "chord": hold((L2, L3), tap(*TYPING)),
+    # PKEY chord selecting the test layer with a string macro.
+    "macro": hold((L1, L2), tap(1)),
+}
+
+
+def percentile(sv, p):
+    if not sv: return 0
+    return sv[min(len(sv) - 1, int(round(p / 100.0 * (len(sv) - 1))))]
+
+
+def run(repeat=200, scenarios=None, options={}, burst=1):
+    sim = Sim(**options)
+    samples = {s: [] for s in STATES}
+    def timer(state, ns):
+        samples.setdefault(state, []).append(ns)
+    for name in scenarios or SCENARIOS:
+        trace = SCENARIOS[name]
+        sim.play(trace, burst=burst)  # Warm up
+        for _ in range(repeat): sim.play(trace, timer, burst)
+    results = {}
+    for state, ns in samples.items():
+        if not ns: continue
+        sv = sorted(ns)
+        total = sum(sv)
+        results[state] = dict(
+            events=len(sv),
+            p50=percentile(sv, 50) / 1000.0, p90=percentile(sv, 90) / 1000.0, p99=percentile(sv, 99) / 1000.0,
+            max=sv[-1] / 1000.0, eps=len(sv) * 1e9 / total if total else 0.0
+        )
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write(f"{'state':<6}{'events':>8}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'max us':>10}{'events/s':>12}\n")
+    for state in results:
+        r = results[state]
+        out.write(f"{state:<6}{r['events']:>8}{r['p50']:>10.1f}{r['p90']:>10.1f}{r['p99']:>10.1f}{r['max']:>10.1f}"
+                  f"{r['eps']:>12.0f}\n")
+
+
+def compare(results, base, tolerance):
+    ''' Returns a list of states whose median latency is more than 'tolerance' percent worse than 'base'.
+    '''
+    worse = []
+    for state, r in results.items():
+        b = base.get(state)
+        if b and r["p50"] > b["p50"] * (1 + tolerance / 100.0):
+            worse.append(f"{state}: p50 {b['p50']:.1f}us -> {r['p50']:.1f}us")
+    return worse
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repeat", type=int, default=200, help="Replays of each scenario")
+    ap.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Limit to named scenario(s)")
+    ap.add_argument("--burst", type=int, default=1, help="Events queued together before the loop runs")
+    ap.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                    help="Override a KEY_MAPS or CODE_MAPS constant, for example COMPILED=1")
+    ap.add_argument("--trace", action="append", default=[], help="Add a recorded trace file as a scenario")
+    ap.add_argument("--save", help="Write results as JSON to this file")
+    ap.add_argument("--compare", help="Fail if median latency regresses against this JSON file")
+    ap.add_argument("--tolerance", type=float, default=20.0, help="Allowed regression in percent")
+    a = ap.parse_args(argv)
+    for path in a.trace:
+        name = os.path.splitext(os.path.basename(path))[0]
+        SCENARIOS[name] = Replay.logical(Replay.load(path))
+        if a.scenario: a.scenario.append(name)
+    options = {}
+    for o in a.set:
+        k, v = o.split("=", 1)
+        options[k] = ast.literal_eval(v)
+    results = run(a.repeat, a.scenario, options, a.burst)
+    report(results)
+    if a.save:
+        with open(a.save, "w") as f: json.dump(results, f, indent=1)
+    if a.compare:
+        with open(a.compare) as f: worse = compare(results, json.load(f), a.tolerance)
+        for w in worse: print("REGRESSION", w)
+        return 1 if worse else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+'''
+Keymap compiler. Loads the CODE_MAPS class from 'CircuitPython/code.py' once for every combination of the option
+switch pins and writes all the maps as packed 'bytes' tables to a module which 'code.py' loads at boot, through
+'Ortho.load_maps', in place of building the maps from source:
+
+    python Host/Compile.py                  # writes CircuitPython/Lib/CompiledMaps.py
+    python Host/Compile.py --check          # fails if the compiled module no longer matches code.py
+
+Copy the output to the CIRCUITPY 'lib' folder (or compile it with mpy-cross). It must be rebuilt whenever the maps
+in 'code.py' change; delete it to go back to building the maps from source.
+'''
+
+import argparse
+import itertools
+import os
+import sys
+import types
+
+import Stubs
+from Sim import load_config, LIB
+import Ortho
+from Ortho import KeyMap, ChordMap, ActionType, StateControl
+from JH_Lib import IMap
+
+OUTPUT = os.path.join(LIB, "CompiledMaps.py")
+
+
+class Compiler:
+    ''' Accumulates the tables of one or more variants of CODE_MAPS. HID code runs, macro step lists and
+        whole KeyMap tables are shared between maps and variants wherever they are identical.
+    '''
+    def __init__(self, pins):
+        self.pins = tuple(pins)
+        self.pool = bytearray()
+        self._runs = {}
+        self.macros = []
+        self._macros = {}
+        self.calls = [n for n in StateControl.__dict__ if not n.startswith("_")]
+        self.tables = []
+        self._tables = {}
+        self.names = {}
+        self.consts = None
+        self.variants = {}
+
+    def _run(self, b):
+        b = bytes(b)
+        off = self._runs.get(b)
+        if off is None:
+            off = len(self.pool)
+            self.pool.extend(b)
+            self._runs[b] = off
+        if off > 0x1FFF: raise ValueError("Code pool too large for 13 bit offsets")
+        return off
+
+    def _macro(self, km, code):
+        steps = km._sequence(code)
+        b = bytearray((len(steps),))
+        for t, codes in steps:
+            b.append(len(codes) if t is ActionType.PRESS else 0)
+            if t is ActionType.PRESS: b.extend(codes)
+        key = (code, bytes(b))
+        ix = self._macros.get(key)
+        if ix is None:
+            ix = len(self.macros)
+            self.macros.append((code, self._run(b)))
+            self._macros[key] = ix
+        return ix
+
+    def _word(self, km, code):
+        if code is None: return 0
+        if type(code) is int:
+            if not 0 < code < 0x2000: raise ValueError(f"HID code {code} out of range")
+            return (KeyMap.INT << 13) | code
+        if type(code) is tuple:
+            return (KeyMap.TUPLE << 13) | self._run((len(code),) + code)
+        if type(code) is str:
+            if type(km._code_map) is not KeyMap: return 0  # Strings without a code_map do nothing
+            return (KeyMap.STR << 13) | self._macro(km, code)
+        if callable(code):
+            return (KeyMap.CALL << 13) | self.calls.index(StateControl.class_state_name(code))
+        raise TypeError(f"Cannot compile KeyMap entry {code!r}")
+
+    def table(self, km, name=None):
+        lo, hi = km._span()
+        b = bytearray()
+        for i in range(lo, hi):
+            w = self._word(km, km[i])
+            b.append(w & 0xFF)
+            b.append(w >> 8)
+        key = (lo, bytes(b))
+        ix = self._tables.get(key)
+        if ix is None:
+            ix = len(self.tables)
+            self.tables.append(key)
+            self._tables[key] = ix
+        if name and ix not in self.names: self.names[ix] = name
+        return ix
+
+    def add(self, values, maps):
+        ''' Compiles the CODE_MAPS class 'maps' as the variant for pin 'values'.
+        '''
+        spec = {}
+        consts = {}
+        for name, v in maps.__dict__.items():
+            if name.startswith("_"): continue
+            if isinstance(v, ChordMap):
+                b = bytearray()
+                for e in v._map:
+                    if e is None:
+                        b.extend((0xFF, 0, 0, 0))
+                    else:
+                        m, c = e if isinstance(e, tuple) else (e, (0, 0, 0))
+                        b.append(self.table(m))
+                        b.extend(c[0:3])
+                spec[name] = ("C", bytes(b), len(v.current), int(v.current))
+            elif isinstance(v, KeyMap):
+                spec[name] = ("K", self.table(v, name))
+            elif isinstance(v, IMap):
+                spec[name] = ("I", v.first_index, tuple(self.table(m, f"{name}[{i}]") for i, m in enumerate(v._map)))
+            elif v is None or type(v) in (bool, int, float, str):
+                consts[name] = v
+            else:
+                raise TypeError(f"Cannot compile CODE_MAPS.{name} of type {type(v).__name__}")
+        if len(self.tables) >= 0xFF: raise ValueError("Too many KeyMap tables: chord entries are one byte and 0xFF means none")
+        if self.consts is not None and consts != self.consts: raise ValueError("Constants differ between variants")
+        self.consts = consts
+        self.variants[tuple(values)] = spec
+
+    def module(self):
+        ''' Returns the compiled module as a namespace, as the firmware would import it.
+        '''
+        return types.SimpleNamespace(
+            FORMAT=Ortho.COMPILED_FORMAT, PINS=self.pins, CONSTS=self.consts, CALLS=tuple(self.calls),
+            POOL=bytes(self.pool), MACROS=tuple(self.macros), TABLES=tuple(self.tables), VARIANTS=self.variants
+        )
+
+    def source(self):
+        m = self.module()
+        out = [
+            "# Generated by Host/Compile.py from CircuitPython/code.py. Do not edit, rerun the compiler instead.",
+            f"FORMAT = {m.FORMAT}",
+            f"PINS = {m.PINS!r}",
+            f"CONSTS = {m.CONSTS!r}",
+            f"CALLS = {m.CALLS!r}",
+            f"POOL = {m.POOL!r}",
+            f"MACROS = {m.MACROS!r}",
+            "TABLES = (",
+        ]
+        for i, t in enumerate(m.TABLES): out.append(f"    {t!r},  # {i} {self.names.get(i, '')}".rstrip())
+        out.append(")")
+        out.append("VARIANTS = {")
+        for k, spec in m.VARIANTS.items():
+            out.append(f"    {k!r}: {{")
+            for name, v in spec.items(): out.append(f"        {name!r}: {v!r},")
+            out.append("    },")
+        out.append("}")
+        return "\n".join(out) + "\n"
+
+    def size(self):
+        return len(self.pool) + sum(len(t[1]) for t in self.tables)
+
+
+def load_variant(values, pins):
+    ''' Loads code.py from source with the option switch pins set to 'values'.
+    '''
+    Stubs.PIN_VALUES.clear()
+    Stubs.PIN_VALUES.update(zip(pins, values))
+    sys.modules["CompiledMaps"] = None  # Make code.py build its maps from source
+    try:
+        return load_config()
+    finally:
+        del sys.modules["CompiledMaps"]
+        Stubs.PIN_VALUES.clear()
+
+
+def verify(module, values, maps):
+    ''' Checks every slot of every map loaded from 'module' against the source maps. Returns a list of problems.
+    '''
+    bad = []
+    loaded = Ortho.load_maps(module, *values)
+    def same(name, src, km):
+        lo, hi = src._span()
+        for i in range(lo - 1, hi + 1):
+            a, b = src[i], km[i]
+            if type(a) is str and type(src._code_map) is KeyMap:
+                if src._sequence(a) != km._pool.sequence(km._word(i) & 0x1FFF): bad.append(f"{name}[{i}] macro")
+            elif a != b:
+                bad.append(f"{name}[{i}] {a!r} != {b!r}")
+    for name, v in maps.__dict__.items():
+        if name.startswith("_"): continue
+        w = getattr(loaded, name)
+        if isinstance(v, ChordMap):
+            for c in range(len(v._map)):
+                e = v._map[c]
+                if e is None:
+                    if w._map[c] is not None: bad.append(f"{name}[{c}]")
+                    continue
+                same(f"{name}[{c}]", e[0] if isinstance(e, tuple) else e, w._map[c][0])
+        elif isinstance(v, KeyMap):
+            same(name, v, w)
+        elif isinstance(v, IMap):
+            for i, m in enumerate(v._map): same(f"{name}[{i}]", m, w._map[i])
+        elif v != w:
+            bad.append(name)
+    return bad
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--pin", action="append", help="Option switch pin read by code.py (default A1 and D6)")
+    ap.add_argument("--output", default=OUTPUT, help="Module to write")
+    ap.add_argument("--check", action="store_true", help="Compare with the existing output instead of writing")
+    a = ap.parse_args(argv)
+    pins = tuple(a.pin or ("A1", "D6"))
+    comp = Compiler(pins)
+    sources = {}
+    for values in itertools.product((False, True), repeat=len(pins)):
+        sources[values] = load_variant(values, pins).CODE_MAPS
+        comp.add(values, sources[values])
+    module = comp.module()
+    bad = [f"{v}: {b}" for v, m in sources.items() for b in verify(module, v, m)]
+    for b in bad: print("MISMATCH", b)
+    if bad: return 1
+    text = comp.source()
+    print(f"{len(comp.tables)} tables, {len(comp.macros)} macros, {comp.size()} bytes of table data "
+          f"for {len(comp.variants)} variants")
+    if a.check:
+        old = open(a.output).read() if os.path.exists(a.output) else None
+        if old != text:
+            print(f"{a.output} is out of date")
+            return 1
+        return 0
+    with open(a.output, "w") as f: f.write(text)
+    print("Wrote", a.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+'''
+Debounce tuning. Replays raw switch traces, with contact bounce and the dropouts of worn switches, through a
+model of the keypad scanner for a grid of SCAN_INTERVAL, DEBOUNCE and CHATTER_FILTER settings. The resulting
+events go through the real Orthokb, and each setting is scored on missed presses, extra (chattered) presses and
+the latency from the switch closing to the event reaching the keyboard state machine:
+
+    python Host/Debounce.py
+    python Host/Debounce.py --trace worn.csv --interval 5 10 --debounce 1 2 3
+
+A trace file has one 't_ms,key,level' line per raw contact change, with 'key' the logical key number and 'level'
+1 for closed. Without one, a trace of typing on bouncy switches is generated. The scanner model reports a key in
+a new state once DEBOUNCE consecutive scans have read it there.
+'''
+
+import argparse
+import random
+import sys
+
+from Sim import Sim
+from Bench import TYPING
+from Ortho import KeyType
+
+
+def synthetic(presses=300, seed=1, bounce=5.0, dropout=0.02, keys=TYPING):
+    ''' Returns raw transitions [(t_us, key, level)] and the true presses [(key, t_us)] for random typing.
+        Each contact change rattles for up to 'bounce' ms and a fraction 'dropout' of holds open briefly.
+    '''
+    rnd = random.Random(seed)
+    raw, truth = [], []
+    t = 10000
+    def rattle(k, t, level):
+        n = rnd.randint(0, 6)
+        for i in range(n):
+            raw.append((t, k, level if i % 2 == 0 else 1 - level))
+            t += rnd.randint(100, max(101, int(bounce * 1000 / max(n, 1))))
+        raw.append((t, k, level))
+    for i in range(presses):
+        k = rnd.choice(keys)
+        hold = rnd.randint(40000, 140000)
+        truth.append((k, t))
+        rattle(k, t, 1)
+        if rnd.random() < dropout:
+            d = t + rnd.randint(10000, hold - 10000)
+            raw.append((d, k, 0))
+            raw.append((d + rnd.randint(300, 3000), k, 1))
+        rattle(k, t + hold, 0)
+        t += hold + rnd.randint(20000, 150000)
+    raw.sort()
+    return raw, truth
+
+
+def load(path):
+    ''' Reads a trace file. A press is taken to start at a rise after the key has been open for 30 ms.
+    '''
+    raw = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            t, k, v = line.split(",")
+            raw.append((int(float(t) * 1000), int(k), int(v)))
+    raw.sort()
+    truth, last = [], {}
+    for t, k, v in raw:
+        if v and t - last.get(k, -10 ** 9) >= 30000: truth.append((k, t))
+        if not v: last[k] = t
+    return raw, truth
+
+
+def scan(raw, interval, debounce):
+    ''' Models the keypad scanner. Returns events [(t_us, key, pressed)] in time order.
+    '''
+    per = {}
+    for t, k, v in raw: per.setdefault(k, []).append((t, v))
+    out = []
+    for k, tr in per.items():
+        i, level, state, count, s = 0, 0, 0, 0, 0
+        while True:
+            while i < len(tr) and tr[i][0] <= s:
+                level = tr[i][1]
+                i += 1
+            if level != state:
+                count += 1
+                if count >= debounce:
+                    state, count = level, 0
+                    out.append((s, k, bool(state)))
+            else:
+                count = 0
+                if i >= len(tr): break
+                if tr[i][0] > s + interval:
+                    s += (tr[i][0] - s) // interval * interval
+                    continue
+            s += interval
+    out.sort()
+    return out
+
+
+def score(events, truth, chatter_filter, window):
+    ''' Feeds 'events' through Orthokb and matches the typing key presses it passes on against 'truth'.
+    '''
+    sim = Sim(CHATTER_FILTER=chatter_filter, CHATTER_WINDOW=window)
+    kb = sim.kb
+    seen = []
+    target = kb._target
+    def spy(key_type, key_code, timestamp):
+        if key_type.state is KeyType.tdown: seen.append((key_code, timestamp))
+        target(key_type, key_code, timestamp)
+    kb._target = spy
+    for t, k, p in events:
+        sim.inject(k, p, t // 1000)
+        while sim.queue or sim.usb.pending: sim.step()
+    starts = {}
+    for k, t in truth: starts.setdefault(k, []).append(t // 1000)
+    got = {k: [0] * len(v) for k, v in starts.items()}
+    extra, lat = 0, []
+    for k, t in seen:
+        st = starts.get(k, [])
+        j = max((i for i in range(len(st)) if st[i] <= t), default=None)
+        if j is None or got[k][j]:
+            extra += 1
+        else:
+            got[k][j] = 1
+            lat.append(t - st[j])
+    missed = sum(v.count(0) for v in got.values())
+    lat.sort()
+    return dict(missed=missed, extra=extra, bounces=kb.stats["bounces"],
+                mean=sum(lat) / len(lat) if lat else 0.0, p99=lat[int(0.99 * (len(lat) - 1))] if lat else 0)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--trace", help="Raw switch trace file (default: generated)")
+    ap.add_argument("--presses", type=int, default=300, help="Presses in a generated trace")
+    ap.add_argument("--seed", type=int, default=1, help="Seed for a generated trace")
+    ap.add_argument("--bounce", type=float, default=5.0, help="Longest contact bounce in ms for a generated trace")
+    ap.add_argument("--dropout", type=float, default=0.02, help="Fraction of generated holds that open briefly")
+    ap.add_argument("--interval", type=float, nargs="+", default=[1, 2, 5, 10, 20], help="SCAN_INTERVAL ms to try")
+    ap.add_argument("--debounce", type=int, nargs="+", default=[1, 2, 3, 5], help="DEBOUNCE values to try")
+    ap.add_argument("--window", type=int, default=30, help="CHATTER_WINDOW ms for the chatter filter")
+    a = ap.parse_args(argv)
+    raw, truth = load(a.trace) if a.trace else synthetic(a.presses, a.seed, a.bounce, a.dropout)
+    print(f"{len(truth)} presses, {len(raw)} contact changes")
+    print(f"{'interval':>9}{'debounce':>9}{'filter':>7}{'missed':>8}{'extra':>7}{'bounces':>8}{'mean ms':>9}{'p99 ms':>8}")
+    best = None
+    for iv in a.interval:
+        for db in a.debounce:
+            events = scan(raw, int(iv * 1000), db)
+            for cf in (False, True):
+                r = score(events, truth, cf, a.window)
+                print(f"{iv:>9g}{db:>9}{'on' if cf else 'off':>7}{r['missed']:>8}{r['extra']:>7}{r['bounces']:>8}"
+                      f"{r['mean']:>9.1f}{r['p99']:>8}")
+                key = (r["missed"] + r["extra"], r["mean"])
+                if best is None or key < best[0]: best = (key, iv, db, cf)
+    _, iv, db, cf = best
+    print(f"Best: SCAN_INTERVAL = {iv / 1000:g}, DEBOUNCE = {db}, CHATTER_FILTER = {cf}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+'''
+Startup profiler. Runs the start of 'CircuitPython/code.py' under CPython with tracemalloc, with the debug switch
+on so that the same JH_Prof report the firmware prints over the serial console is printed here:
+
+    python Host/Profile.py
+    python Host/Profile.py --source --top 10
+
+Times and byte counts are CPython's rather than CircuitPython's, so compare rows with each other and between
+runs rather than with the limits of the board.
+'''
+
+import argparse
+import importlib.util
+import os
+import sys
+import tracemalloc
+
+import Stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRMWARE = os.path.join(ROOT, "CircuitPython")
+LIB = os.path.join(FIRMWARE, "Lib")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--source", action="store_true", help="Build CODE_MAPS from source even if compiled maps exist")
+    ap.add_argument("--top", type=int, default=0, help="Also list the firmware source lines holding the most heap")
+    a = ap.parse_args(argv)
+    Stubs.install()
+    Stubs.PIN_VALUES["A0"] = False  # Debug switch closed
+    for p in (LIB, FIRMWARE):
+        if p not in sys.path: sys.path.insert(0, p)
+    if a.source: sys.modules["CompiledMaps"] = None
+    tracemalloc.start()
+    # Import code.py under a private name (code.py would shadow the standard 'code' module) without its main loop.
+    spec = importlib.util.spec_from_file_location("baer_code", os.path.join(FIRMWARE, "code.py"))
+    cfg = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cfg)
+    prof = cfg.prof
+    prof.begin()
+    usb = cfg.Usbkb(cfg.CODE_MAPS, 0)
+    prof.end("Usbkb")
+    prof.begin()
+    cfg.Orthokb(usb, cfg.KEY_MAPS, 0)
+    prof.end("Orthokb")
+    prof.report()
+    if a.top:
+        snap = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(True, FIRMWARE + os.sep + "*"),))
+        print()
+        for st in snap.statistics("lineno")[:a.top]:
+            f = st.traceback[0]
+            print(f"{os.path.relpath(f.filename, ROOT)}:{f.lineno:<6}{st.size:>9} bytes {st.count:>6} blocks")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+'''
+Trace replay. Feeds a key event trace recorded by the firmware (KEY_MAPS.TRACE_EVENTS) back through Orthokb,
+KeyMech and Usbkb on the host, with their recorded timestamps, and compares the HID reports produced:
+
+    python Host/Replay.py --port /dev/ttyACM1 --output typing.trace    # fetch a trace from the keyboard
+    python Host/Replay.py typing.trace --save typing.hid               # record the reports of this tree
+    python Host/Replay.py typing.trace --expect typing.hid             # fail if this tree's reports differ
+    python Host/Replay.py typing.trace --against COMPILED=True         # compare two configurations
+    python Host/Replay.py typing.trace --repeat 50                     # events per second
+
+Fetching needs pyserial and the keyboard in debug mode, where boot.py enables the usb_cdc data channel. A trace
+is the text written by JH_Trace.EventRecorder.dump: one 'timestamp,key_number,pressed' line per event, with
+physical key numbers. Recorded traces may also be added to the Bench scenarios with 'Bench.py --trace'.
+'''
+
+import argparse
+import ast
+import sys
+import time
+
+from Sim import Sim, load_config
+from JH_Trace import EventRecorder
+
+
+def parse(lines):
+    ''' Returns [(timestamp, key_number, pressed)] from the lines of a dumped trace.
+    '''
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        t, k, p = line.split(",")
+        events.append((int(t), int(k), p.strip() == "1"))
+    return events
+
+
+def load(path):
+    with open(path) as f: return parse(f)
+
+
+def fetch(port, timeout=5.0):
+    ''' Requests the trace from a keyboard on the usb_cdc data channel 'port' and returns its lines.
+    '''
+    try:
+        import serial
+    except ImportError:
+        raise SystemExit("Fetching a trace needs pyserial (pip install pyserial)")
+    lines = []
+    with serial.Serial(port, timeout=timeout) as s:
+        s.reset_input_buffer()
+        s.write(b"T")
+        while True:
+            line = s.readline().decode()
+            if not line: raise SystemExit(f"No complete trace from {port}: is KEY_MAPS.TRACE_EVENTS set?")
+            lines.append(line)
+            if line.startswith("# end"): return lines
+
+
+def logical(events, config=None):
+    ''' Converts a trace to a (logical_key, pressed) trace for Sim.play, dropping overflow marks.
+    '''
+    k2m = (config or load_config()).KEY_MAPS.KEY2MAP
+    return tuple((k2m[k], p) for t, k, p in events if k != EventRecorder.RESET)
+
+
+def replay(events, options={}, sim=None):
+    ''' Replays 'events' one at a time, running the main loop until each is consumed and its output sent.
+        Returns the HID reports produced, the number of reports produced by the end of each event and the
+        nanoseconds taken.
+    '''
+    sim = sim or Sim(**options)
+    start = len(sim.reports)
+    ends = []
+    clock = time.perf_counter_ns
+    t0 = clock()
+    for t, k, p in events:
+        if k == EventRecorder.RESET:
+            sim.queue.overflowed = True
+        else:
+            sim.inject(k, p, t, physical=True)
+        sim.step()
+        while sim.queue or sim.usb.pending: sim.step()
+        ends.append(len(sim.reports) - start)
+    ns = clock() - t0
+    return [bytes(r) for r in sim.reports[start:]], ends, ns
+
+
+def diff(events, ends, a, b):
+    ''' Returns a description of the first difference between report streams 'a' and 'b', or None.
+    '''
+    n = next((i for i in range(min(len(a), len(b))) if a[i] != b[i]), min(len(a), len(b)))
+    if n == len(a) == len(b): return None
+    e = next((i for i in range(len(ends)) if ends[i] > n), len(ends) - 1)
+    t, k, p = events[e]
+    ra = a[n].hex() if n < len(a) else "none"
+    rb = b[n].hex() if n < len(b) else "none"
+    return (f"Report {n} differs ({ra} != {rb}), caused by event {e}: key {k} "
+            f"{'pressed' if p else 'released'} at {t} ms. {len(a)} reports against {len(b)}.")
+
+
+def options(pairs):
+    o = {}
+    for s in pairs:
+        k, v = s.split("=", 1)
+        o[k] = ast.literal_eval(v)
+    return o
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("trace", nargs="?", help="Trace file to replay")
+    ap.add_argument("--port", help="Fetch the trace from the keyboard's usb_cdc data port instead")
+    ap.add_argument("--output", help="With --port, also write the fetched trace to this file")
+    ap.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                    help="Override a KEY_MAPS or CODE_MAPS constant for the replay")
+    ap.add_argument("--against", action="append", default=[], metavar="NAME=VALUE",
+                    help="Replay again with these overrides added and compare the reports")
+    ap.add_argument("--save", help="Write the reports, one hex line each, to this file")
+    ap.add_argument("--expect", help="Compare the reports with a file written by --save")
+    ap.add_argument("--repeat", type=int, default=0, help="Time this many further replays")
+    a = ap.parse_args(argv)
+    if a.port:
+        lines = fetch(a.port)
+        if a.output:
+            with open(a.output, "w") as f: f.writelines(lines)
+        events = parse(lines)
+    elif a.trace:
+        events = load(a.trace)
+    else:
+        ap.error("a trace file or --port is needed")
+    opts = options(a.set)
+    reports, ends, ns = replay(events, opts)
+    print(f"{len(events)} events, {len(reports)} reports")
+    bad = []
+    if a.against:
+        other = replay(events, dict(opts, **options(a.against)))[0]
+        bad.append(diff(events, ends, reports, other))
+    if a.expect:
+        with open(a.expect) as f: expected = [bytes.fromhex(line.strip()) for line in f if line.strip()]
+        bad.append(diff(events, ends, reports, expected))
+    for b in bad:
+        if b: print("DIFF", b)
+    if a.save:
+        with open(a.save, "w") as f: f.writelines(r.hex() + "\n" for r in reports)
+    if a.repeat:
+        sim = Sim(**opts)
+        total = 0
+        for _ in range(a.repeat): total += replay(events, sim=sim)[2]
+        print(f"{len(events) * a.repeat * 1e9 / total:.0f} events/s over {a.repeat} replays")
+    return 1 if any(bad) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+'''
+Host-side simulation of the Baer keyboard firmware. Loads the real 'Ortho' module and the maps defined in
+'CircuitPython/code.py' on top of the stand-in hardware modules in 'Stubs', then replays scripted key traces
+through the same calls the main loop makes.
+'''
+
+import os
+import sys
+import time
+import importlib.util
+
+import Stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRMWARE = os.path.join(ROOT, "CircuitPython")
+LIB = os.path.join(FIRMWARE, "Lib")
+
+Stubs.install()
+for p in (LIB, FIRMWARE):
+    if p not in sys.path: sys.path.insert(0, p)
+
+import Ortho
+from JH_Heap import HeapMonitor
+
+
+def load_config(path=None):
+    ''' Imports a code.py style file under a private name (code.py would shadow the standard 'code' module)
+        without running its main loop.
+    '''
+    path = path or os.path.join(FIRMWARE, "code.py")
+    spec = importlib.util.spec_from_file_location("baer_code", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+# Logical key numbers (index into KEY_MAPS.MKEYMAP) for the multi-function keys.
+L1, L2, L3, L4 = 0, 12, 24, 36
+R1, R2, R3, R4 = 11, 23, 35, 47
+
+
+def down(k): return ((k, True),)
+def up(k): return ((k, False),)
+def tap(*ks): return tuple(e for k in ks for e in down(k) + up(k))
+def hold(ks, inner):
+    ''' Presses the keys in 'ks' in order, plays 'inner', then releases 'ks' in reverse order.
+    '''
+    return tuple(e for k in ks for e in down(k)) + tuple(inner) + tuple(e for k in reversed(ks) for e in up(k))
+
+
+class Sim:
+    ''' One simulated keyboard. 'step' performs a single iteration of the firmware main loop and 'play' feeds a
+        trace of (logical_key, pressed) tuples through it one event at a time, optionally timing each event.
+    '''
+    def __init__(self, config=None, debug=0, **options):
+        self.cfg = config or load_config()
+        for name, val in options.items(): self.configure(name, val)
+        km = self.cfg.KEY_MAPS
+        self.telem = Ortho.telemetry() if getattr(km, "TELEMETRY", False) else None
+        self.usb = Ortho.Usbkb(self.cfg.CODE_MAPS, debug, self.telem)
+        self.usb.subscribe(self.cfg.update_leds)
+        self.kb = Ortho.Orthokb(self.usb, km, debug, self.telem)
+        self.heap = HeapMonitor(getattr(km, "GC_MANUAL", False), getattr(km, "GC_THRESHOLD", 16384),
+                                getattr(km, "GC_IDLE_BYTES", 4096))
+        self.cfg.usb, self.cfg.kb, self.cfg.heap = self.usb, self.kb, self.heap  # Globals used by code.py
+        self.cfg.telem = self.telem
+        self.clock = None
+        self.cfg.ticks_ms = self.ticks_ms
+        if self.telem is not None:
+            self.telem.gauge("heap_free", lambda: self.heap.stats["free"] or 0)
+            self.telem.gauge("gc_collections", lambda: self.heap.collections + self.heap.auto_collections)
+            self.cfg._loop[0] = self.telem.histogram("loop_ms")
+            self.cfg._loop[1] = self.ticks_ms()
+        k2m = self.cfg.KEY_MAPS.KEY2MAP
+        self._phys = {k2m[i]: i for i in range(len(k2m))}
+
+    def configure(self, name, val):
+        ''' Overrides a constant already defined in the KEY_MAPS or CODE_MAPS class of the loaded configuration.
+        '''
+        for maps in (self.cfg.KEY_MAPS, self.cfg.CODE_MAPS):
+            if hasattr(maps, name):
+                setattr(maps, name, val)
+                return
+        raise AttributeError(f"Neither KEY_MAPS nor CODE_MAPS defines {name}")
+
+    @property
+    def mech(self):
+        return self.usb._KB_State
+
+    @property
+    def queue(self):
+        return self.kb._keys.events
+
+    @property
+    def reports(self):
+        return self.usb._kb.reports
+
+    def state(self):
+        return self.mech.state_name()
+
+    def step(self):
+        ''' One pass of the 'scan' and 'leds' tasks of code.py. Pixel refresh is left out as it runs on its own
+            period, off the key path.
+        '''
+        self.cfg.scan()
+        self.usb.poll()
+
+    def ticks_ms(self):
+        ''' The clock code.py polls timers with: 'clock' once a timestamp has been injected, else the real one.
+        '''
+        return Ortho.ticks_ms() if self.clock is None else self.clock
+
+    def inject(self, key, pressed, timestamp=None, physical=False):
+        ''' Queues an event for the logical key number 'key' (physical key number if 'physical') as the scanner
+            would. A 'timestamp' also sets 'clock', so that replays of recorded timings are deterministic.
+        '''
+        if timestamp is not None: self.clock = timestamp
+        self.queue.inject(key if physical else self._phys[key], pressed, timestamp)
+
+    def play(self, trace, timer=None, burst=1):
+        ''' Replays 'trace'. If 'timer' is given it is called with (state_name, nanoseconds) for every event where
+            state_name is the KeyMech state before the event and nanoseconds covers the loop iterations needed to
+            consume the event and send all the output it causes. With 'burst' greater than one, that many events
+            are queued before the loop runs, as in a fast roll, and each is charged an equal share of the time.
+        '''
+        clock = time.perf_counter_ns
+        for i in range(0, len(trace), burst):
+            chunk = trace[i:i + burst]
+            for key, pressed in chunk: self.inject(key, pressed)
+            if timer is None:
+                while self.queue or self.usb.pending: self.step()
+                continue
+            st = self.state()
+            t0 = clock()
+            while self.queue or self.usb.pending: self.step()
+            ns = (clock() - t0) // len(chunk)
+            for _ in chunk: timer(st, ns)
@@ -0,0 +1,247 @@
+'''
+Minimal CPython stand-ins for the CircuitPython modules used by the firmware so that Ortho, JH_PixelMap and
+code.py can be imported and driven on a host computer with no hardware attached. Call 'install' before
+importing any firmware module.
+'''
+
+import sys
+import time
+import types
+
+
+class Pin:
+    ''' Named placeholder for a board GPIO pin.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"board.{self.name}"
+
+
+class Event:
+    ''' Mirrors keypad.Event.
+    '''
+    def __init__(self, key_number=0, pressed=True, timestamp=None):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.timestamp = timestamp if timestamp is not None else (time.monotonic_ns() // 1000000) & 0x1FFFFFFF
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __repr__(self):
+        return f"<Event: key_number {self.key_number} {'pressed' if self.pressed else 'released'}>"
+
+
+class EventQueue:
+    ''' Mirrors keypad.EventQueue with an 'inject' method used by the simulator in place of the scanner.
+    '''
+    def __init__(self, max_events=64):
+        self._q = []
+        self._max = max_events
+        self.overflowed = False
+
+    def inject(self, key_number, pressed, timestamp=None):
+        if len(self._q) >= self._max:
+            self.overflowed = True
+            return False
+        self._q.append(Event(key_number, pressed, timestamp))
+        return True
+
+    def get(self):
+        if not self._q: return None
+        return self._q.pop(0)
+
+    def get_into(self, event):
+        if not self._q: return False
+        e = self._q.pop(0)
+        event.key_number, event.pressed, event.timestamp = e.key_number, e.pressed, e.timestamp
+        return True
+
+    def clear(self):
+        self._q.clear()
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._q)
+
+    def __bool__(self):
+        return len(self._q) > 0
+
+
+class KeyMatrix:
+    ''' Mirrors keypad.KeyMatrix. No scanning takes place; events are injected through 'events'.
+    '''
+    def __init__(self, row_pins, column_pins, columns_to_anodes=True, interval=0.02, max_events=64,
+                 debounce_threshold=1):
+        self.key_count = len(row_pins) * len(column_pins)
+        self.interval = interval
+        self.debounce_threshold = debounce_threshold
+        self.events = EventQueue(max_events)
+
+    def reset(self):
+        self.events.clear()
+
+    def deinit(self):
+        pass
+
+
+class NeoPixel:
+    ''' Mirrors neopixel.NeoPixel, holding colours in a list and a GRB byte buffer.
+    '''
+    def __init__(self, pin, n, *, bpp=3, brightness=1.0, auto_write=True, pixel_order=None):
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.brightness = brightness
+        self.auto_write = auto_write
+        self.byteorder = pixel_order if pixel_order is not None else "GRB"
+        self._px = [(0, 0, 0)] * n
+        self.buf = bytearray(n * bpp)
+        self.shows = 0
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, ix, color):
+        if isinstance(color, int): color = ((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+        if isinstance(ix, slice):
+            for i in range(*ix.indices(self.n)): self._px[i] = tuple(color)
+        else:
+            self._px[ix] = tuple(color)
+        if self.auto_write: self.show()
+
+    def __getitem__(self, ix):
+        return self._px[ix]
+
+    def fill(self, color):
+        self[0:self.n] = color
+
+    def show(self):
+        self.shows += 1
+
+    def deinit(self):
+        pass
+
+
+NEOPIXEL_WRITES = {}
+''' Last bytes written by neopixel_write, by pin.
+'''
+
+
+def neopixel_write(pin, buf):
+    ''' Mirrors neopixel_write.neopixel_write.
+    '''
+    NEOPIXEL_WRITES[pin] = bytes(buf)
+
+
+class Keyboard:
+    ''' Mirrors adafruit_hid.keyboard.Keyboard. Every 8 byte boot keyboard report that the real driver would
+        send is appended to 'reports' so that output streams can be inspected and compared. Pressing a lock key
+        toggles its bit in 'led_status', as the host would.
+    '''
+    LOCKS = {0x53: 1, 0x39: 2, 0x47: 4, 0x65: 8}  # Num, Caps and Scroll Lock and Compose (Application key)
+
+    def __init__(self, devices, timeout=None):
+        self.report = bytearray(8)
+        self.reports = []
+        self.led_status = bytes(1)
+
+    def _send(self):
+        self.reports.append(bytes(self.report))
+
+    def _add(self, code):
+        if 0xE0 <= code <= 0xE7:
+            self.report[0] |= 1 << (code - 0xE0)
+            return
+        for i in range(2, 8):
+            if self.report[i] == code: return
+        for i in range(2, 8):
+            if self.report[i] == 0:
+                self.report[i] = code
+                return
+        raise ValueError("Trying to press more than six keys at once.")
+
+    def _remove(self, code):
+        if 0xE0 <= code <= 0xE7:
+            self.report[0] &= ~(1 << (code - 0xE0)) & 0xFF
+            return
+        for i in range(2, 8):
+            if self.report[i] == code: self.report[i] = 0
+
+    def press(self, *codes):
+        for c in codes:
+            self._add(c)
+            if c in self.LOCKS: self.led_status = bytes((self.led_status[0] ^ self.LOCKS[c],))
+        self._send()
+
+    def release(self, *codes):
+        for c in codes: self._remove(c)
+        self._send()
+
+    def release_all(self):
+        for i in range(8): self.report[i] = 0
+        self._send()
+
+    def send(self, *codes):
+        self.press(*codes)
+        self.release_all()
+
+    def led_on(self, led_code):
+        return bool(self.led_status[0] & led_code)
+
+
+PIN_VALUES = {}
+''' Initial value of DigitalInOut by pin name, for simulating option switches. Pins not listed read True.
+'''
+
+
+class DigitalInOut:
+    ''' Mirrors digitalio.DigitalInOut. Inputs read True (switch open with pull-up) unless 'value' is set or the
+        pin is listed in PIN_VALUES.
+    '''
+    def __init__(self, pin):
+        self.pin = pin
+        self.pull = None
+        self.direction = None
+        self.value = PIN_VALUES.get(getattr(pin, "name", None), True)
+
+    def deinit(self):
+        pass
+
+
+COLORS = dict(
+    RED=(255, 0, 0), YELLOW=(255, 150, 0), ORANGE=(255, 40, 0), GREEN=(0, 255, 0), TEAL=(0, 255, 120),
+    CYAN=(0, 255, 255), BLUE=(0, 0, 255), PURPLE=(180, 0, 255), MAGENTA=(255, 0, 20), WHITE=(255, 255, 255),
+    BLACK=(0, 0, 0), GOLD=(255, 222, 30), PINK=(242, 90, 255), AQUA=(50, 255, 255), JADE=(0, 255, 40),
+    AMBER=(255, 100, 0), OLD_LACE=(253, 245, 230)
+)
+
+
+def _module(name, **members):
+    m = types.ModuleType(name)
+    for k, v in members.items(): setattr(m, k, v)
+    sys.modules[name] = m
+    return m
+
+
+def install():
+    ''' Registers the stand-in modules in sys.modules. Safe to call more than once.
+    '''
+    if "keypad" in sys.modules and getattr(sys.modules["keypad"], "STUB", False): return
+    board = _module("board", STUB=True)
+    board.__getattr__ = lambda name: Pin(name)
+    _module("keypad", STUB=True, Event=Event, EventQueue=EventQueue, KeyMatrix=KeyMatrix)
+    _module("neopixel", STUB=True, NeoPixel=NeoPixel, GRB="GRB", RGB="RGB")
+    _module("neopixel_write", STUB=True, neopixel_write=neopixel_write)
+    _module("digitalio", STUB=True, DigitalInOut=DigitalInOut,
+            Pull=types.SimpleNamespace(UP="UP", DOWN="DOWN"),
+            Direction=types.SimpleNamespace(INPUT="INPUT", OUTPUT="OUTPUT"))
+    _module("usb_cdc", STUB=True, console=None, data=None)
+    _module("usb_hid", STUB=True, devices=[], Device=types.SimpleNamespace(KEYBOARD="KEYBOARD"))
+    hid = _module("adafruit_hid", STUB=True)
+    hid.keyboard = _module("adafruit_hid.keyboard", STUB=True, Keyboard=Keyboard)
+    anim = _module("adafruit_led_animation", STUB=True)
+    anim.color = _module("adafruit_led_animation.color", STUB=True, **COLORS)
@@ -0,0 +1,211 @@
+'''
+Telemetry dashboard. Polls a keyboard running with KEY_MAPS.TELEMETRY for the binary frames written by
+JH_Telem.Telemetry and shows its counters (with rates), gauges and histograms:
+
+    python Host/Telem.py --port /dev/ttyACM1                    # refresh every second until interrupted
+    python Host/Telem.py --port /dev/ttyACM1 --count 60 --log kb.telem
+    python Host/Telem.py --file kb.telem                        # show the frames logged by --log
+    python Host/Telem.py --sim                                  # frames from the Bench scenarios in Sim
+
+The keyboard answers 'S' with a schema frame naming the values and 'M' with a data frame of their current values
+on the usb_cdc data channel, which boot.py enables in debug mode or with its TELEMETRY set. Reading a port needs
+pyserial. Counters and histograms count from start up, so the dashboard shows rates between successive frames.
+'''
+
+import argparse
+import struct
+import sys
+import time
+
+HEADER = struct.Struct("<2sBBHLH")
+MAGIC = b"\xba\xe7"
+DATA, SCHEMA = 1, 2
+FORMAT = 1
+
+
+class Schema:
+    ''' The names of the values in a data frame, from the text of a schema frame.
+    '''
+    def __init__(self, text):
+        self.counters, self.gauges, self.histograms = [], [], []
+        for line in text.splitlines():
+            f = line.split()
+            if not f: continue
+            if f[0] == "C": self.counters.append(f[1])
+            elif f[0] == "G": self.gauges.append(f[1])
+            elif f[0] == "H": self.histograms.append((f[1], tuple(int(e) for e in f[2:])))
+
+    def decode(self, payload):
+        ''' Returns (counters, gauges, histograms) as dicts, each histogram a list of bucket counts.
+        '''
+        nc, ng = len(self.counters), len(self.gauges)
+        nb = sum(len(e) + 1 for n, e in self.histograms)
+        if len(payload) != 4 * (nc + ng + nb): raise ValueError("Data frame does not match the schema")
+        c = struct.unpack_from(f"<{nc}L", payload, 0)
+        g = struct.unpack_from(f"<{ng}l", payload, 4 * nc)
+        b = struct.unpack_from(f"<{nb}L", payload, 4 * (nc + ng))
+        h, o = {}, 0
+        for n, e in self.histograms:
+            h[n] = list(b[o:o + len(e) + 1])
+            o += len(e) + 1
+        return dict(zip(self.counters, c)), dict(zip(self.gauges, g)), h
+
+
+def read_frame(read):
+    ''' Reads the next frame with 'read(n)', skipping anything before the magic bytes. Returns (kind, seq, ticks,
+        payload, raw) or None if 'read' runs dry. Raises ValueError on a bad checksum or an unknown format.
+    '''
+    buf = b""
+    while True:
+        while len(buf) < HEADER.size:
+            more = read(HEADER.size - len(buf))
+            if not more: return None
+            buf += more
+            i = buf.find(MAGIC)
+            if i < 0: buf = buf[-1:] if buf.endswith(MAGIC[:1]) else b""
+            elif i: buf = buf[i:]
+        magic, kind, fmt, seq, ticks, size = HEADER.unpack(buf)
+        if fmt != FORMAT: raise ValueError(f"Frame format {fmt}, this script reads {FORMAT}")
+        rest = b""
+        while len(rest) < size + 2:
+            more = read(size + 2 - len(rest))
+            if not more: return None
+            rest += more
+        raw = buf + rest
+        if sum(raw[:-2]) & 0xFFFF != struct.unpack_from("<H", raw, len(raw) - 2)[0]: raise ValueError("Bad checksum")
+        return kind, seq, ticks, raw[HEADER.size:-2], raw
+
+
+class Port:
+    ''' Requests frames from a keyboard's usb_cdc data channel.
+    '''
+    def __init__(self, port, timeout=2.0):
+        try:
+            import serial
+        except ImportError:
+            raise SystemExit("Reading a port needs pyserial (pip install pyserial)")
+        self._s = serial.Serial(port, timeout=timeout)
+        self._s.reset_input_buffer()
+
+    def request(self, c):
+        self._s.write(c)
+        f = read_frame(self._s.read)
+        if f is None: raise SystemExit("No reply from the keyboard: is KEY_MAPS.TELEMETRY set?")
+        return f
+
+    def close(self):
+        self._s.close()
+
+
+class SimPort:
+    ''' Answers requests from a Sim with TELEMETRY set, which plays a Bench scenario between data frames.
+    '''
+    def __init__(self):
+        import Bench
+        from Sim import Sim
+        self.sim = Sim(TELEMETRY=True)
+        self._scenarios = list(Bench.SCENARIOS.values())
+        self._i = 0
+
+    def request(self, c):
+        t = self.sim.telem
+        if c == b"S": raw = t.schema(self.sim.ticks_ms())
+        else:
+            self.sim.play(self._scenarios[self._i % len(self._scenarios)])
+            self._i += 1
+            raw = t.frame(self.sim.ticks_ms())
+        return read_frame(Reader(bytes(raw)).read)
+
+    def close(self):
+        pass
+
+
+class Reader:
+    def __init__(self, data):
+        self._d = data
+        self._o = 0
+
+    def read(self, n):
+        b = self._d[self._o:self._o + n]
+        self._o += len(b)
+        return b
+
+
+def percentile(edges, buckets, q):
+    ''' Returns the bucket holding fraction 'q' of the samples, as '<edge' or, for the last, '>=edge'.
+    '''
+    total = sum(buckets)
+    if not total: return "-"
+    n = 0
+    for i, b in enumerate(buckets):
+        n += b
+        if n >= q * total: return f"<{edges[i]}" if i < len(edges) else f">={edges[-1]}"
+
+
+def render(schema, frame, prev=None, cumulative=False, write=sys.stdout.write):
+    ''' Writes one dashboard screen for decoded 'frame', with rates and, unless 'cumulative', histograms since
+        'prev' where given.
+    '''
+    seq, ticks, (c, g, h) = frame
+    dt = ((ticks - prev[1]) & 0x1FFFFFFF) / 1000 if prev else 0
+    write(f"frame {seq}  ticks {ticks}\n")
+    for n, v in c.items():
+        rate = f"{(v - prev[2][0][n]) / dt:10.1f}/s" if dt else ""
+        write(f"  {n:<20}{v:>12}{rate}\n")
+    for n, v in g.items(): write(f"  {n:<20}{v:>12}\n")
+    for n, e in schema.histograms:
+        b = h[n]
+        if prev and not cumulative: b = [x - y for x, y in zip(b, prev[2][2][n])]
+        write(f"  {n:<20}{sum(b):>12}  p50 {percentile(e, b, 0.5)}  p99 {percentile(e, b, 0.99)}\n")
+        top = max(b) or 1
+        labels = [f"<{x}" for x in e] + [f">={e[-1]}"]
+        for label, x in zip(labels, b): write(f"    {label:>6} {x:>10} {'#' * (40 * x // top)}\n")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--port", help="The keyboard's usb_cdc data port")
+    src.add_argument("--file", help="Show the frames in a file written by --log")
+    src.add_argument("--sim", action="store_true", help="Take frames from the host simulation")
+    ap.add_argument("--interval", type=float, default=1.0, help="Seconds between frames")
+    ap.add_argument("--count", type=int, default=0, help="Stop after this many data frames (0 for no limit)")
+    ap.add_argument("--log", help="Append the raw frames received to this file")
+    ap.add_argument("--cumulative", action="store_true", help="Show histograms since start up, not per frame")
+    a = ap.parse_args(argv)
+    if a.file:
+        with open(a.file, "rb") as f: r = Reader(f.read())
+        frames = iter(lambda: read_frame(r.read), None)
+        source = None
+    else:
+        source = SimPort() if a.sim else Port(a.port)
+        if a.sim and not a.count: a.count = len(source._scenarios)
+        def poll():
+            yield source.request(b"S")
+            n = 0
+            while not a.count or n < a.count:
+                if n: time.sleep(0 if a.sim else a.interval)
+                yield source.request(b"M")
+                n += 1
+        frames = poll()
+    log = open(a.log, "ab") if a.log else None
+    schema, prev = None, None
+    try:
+        for kind, seq, ticks, payload, raw in frames:
+            if log: log.write(raw)
+            if kind == SCHEMA:
+                schema, prev = Schema(payload.decode()), None
+            elif kind == DATA and schema is not None:
+                frame = (seq, ticks, schema.decode(payload))
+                render(schema, frame, prev, a.cumulative)
+                prev = frame
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log: log.close()
+        if source: source.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+'''
+Host tests of the firmware, run through the simulation in 'Sim':
+
+    python -m pytest Host
+'''
+
+import pytest
+
+import Stubs
+from Sim import Sim, L1
+import Ortho
+from Ortho import ActionType, lock_needs
+from JH_PixelMap import PixelMap
+import JH_Anim
+
+
+@pytest.mark.parametrize("framebuffer", (False, True))
+def test_pixel_reads_back_as_set(framebuffer):
+    px = Sim(PIXEL_FRAMEBUFFER=framebuffer).kb.pixels
+    px.indexing(auto_update=False)
+    assert px.brightness < 1.0
+    for c in ((0, 0, 255), (12, 200, 33), (255, 255, 255)):
+        px[5] = c
+        assert px[5] == c
+    px[(1, 2)] = (9, 8, 7)
+    assert px[(1, 2)] == [(9, 8, 7)] * 2
+    px.brightness = 1.0
+    assert px[5] == (255, 255, 255)
+
+
+def test_animation_starts_from_current_colour():
+    kb = Sim(PIXEL_FRAMEBUFFER=True).kb
+    px, anim = kb.pixels, kb.anim
+    px.indexing(auto_update=False)
+    px[(5,)] = (0, 0, 255)
+    anim.fade((5,), (0, 0, 255), 0.05)
+    while anim.running:
+        anim.update()
+        assert px[5] == (0, 0, 255)
+    px[(6,)] = (0, 0, 200)
+    anim.fade((6,), (0, 0, 0), 0.05)
+    last = 200
+    while anim.running:
+        anim.update()
+        assert px[6][2] <= last
+        last = px[6][2]
+    assert last == 0
+
+
+def test_animation_keeps_indexing_and_runs_across_ticks_wrap(monkeypatch):
+    clock = [0x1FFFFFF0]
+    monkeypatch.setattr(JH_Anim, "ticks_ms", lambda: clock[0])
+    kb = Sim(PIXEL_FRAMEBUFFER=True).kb
+    px, anim = kb.pixels, kb.anim
+    px.indexing(PixelMap.ROWS, slice(0, 6), PixelMap.BOUNCE, False)
+    state = px.indexing_state
+    anim.fade((5,), (0, 0, 200), 0.1)
+    anim.update()
+    for t in (50, 99):
+        clock[0] = (0x1FFFFFF0 + t) & 0x1FFFFFFF
+        anim.update()
+        assert anim.running and px.indexing_state == state
+    px.indexing(auto_update=False)
+    assert 0 < px[5][2] < 200
+    clock[0] = (0x1FFFFFF0 + 100) & 0x1FFFFFFF
+    anim.update()
+    assert not anim.running and px[5] == (0, 0, 200)
+
+
+def test_overflow_clears_chatter_filter():
+    sim = Sim(CHATTER_FILTER=True)
+    def event(pressed, t):
+        sim.inject(5, pressed, t)
+        while sim.queue or sim.usb.pending: sim.step()
+    event(True, 1000)
+    event(False, 1100)
+    event(True, 1110)  # Chatter, so muted until its release
+    assert sim.kb.keys_down == 0
+    sim.queue.overflowed = True
+    sim.step()
+    event(True, 1200)  # The scanner reports the held key again after its reset
+    assert sim.kb.keys_down == 1
+    event(False, 1300)
+    assert sim.kb.keys_down == 0
+    assert sim.reports[-1] == bytes(8)
+
+
+@pytest.mark.parametrize("held", (50, 500))
+def test_pkey_tap_with_default_tapping_term(held):
+    sim = Sim()
+    assert sim.usb.taphold is None
+    for pressed, t in ((True, 1000), (False, 1000 + held)):
+        sim.inject(L1, pressed, t)
+        while sim.queue or sim.usb.pending: sim.step()
+    assert [bytes(r) for r in sim.reports] == [bytes((0, 0, 0x2A, 0, 0, 0, 0, 0)), bytes(8)]  # Tap of BS
+
+
+def test_macro_queued_behind_caps_lock_types_with_caps_off():
+    sim = Sim()
+    usb = sim.usb
+    usb.action(ActionType.PRESS, 0x39)  # Caps Lock typed and still queued
+    usb.action(ActionType.RELEASE, 0x39)
+    seq = ((ActionType.SEND, (0x04,)),)  # 'a'
+    usb.action(ActionType.MACRO, seq, lock_needs(seq))
+    assert usb.pending > len(seq)
+    while usb.pending: sim.step()
+    caps, held = False, set()
+    for r in sim.reports:
+        keys = set(r[2:]) - {0}
+        if 0x39 in keys - held: caps = not caps
+        if 0x04 in keys: assert not caps
+        held = keys
+    assert caps and usb.leds[usb.leds.CAPS_LOCK]
+
+
+def test_compiled_maps_round_trip():
+    import itertools
+    import Compile
+    pins = ("A1", "D6")
+    comp, sources = Compile.Compiler(pins), {}
+    for values in itertools.product((False, True), repeat=len(pins)):
+        sources[values] = Compile.load_variant(values, pins).CODE_MAPS
+        comp.add(values, sources[values])
+    module = comp.module()
+    for values, maps in sources.items():
+        assert Compile.verify(module, values, maps) == []
+    pool = Ortho.load_maps(module, *values).KEY_MAP_QWERTY._pool
+    assert pool.sequence(0) is pool.sequence(0)  # Decoded once, then cached
+
+
+BS, Q, LMOD_Q = "00002a0000000000", "0000140000000000", "0800140000000000"  # Tap of L1, 'q', 'q' with L1 held
+START = (1000, 0x1FFFFFF0)  # The second puts the ticks_ms wrap inside the pending decision
+
+
+def taphold(start, events, **options):
+    ''' Plays (logical_key, pressed, ms after 'start') through a Sim with a 200 ms tapping term, a key of None
+        just moving the clock on, and returns the HID reports sent so far after each event.
+    '''
+    sim = Sim(TAPPING_TERM=200, **options)
+    out = []
+    for key, pressed, t in events:
+        t = (start + t) & 0x1FFFFFFF
+        if key is None: sim.clock = t
+        else: sim.inject(key, pressed, t)
+        sim.step()
+        while sim.queue or sim.usb.pending: sim.step()
+        out.append([bytes(r).hex() for r in sim.reports])
+    return out
+
+
+@pytest.mark.parametrize("start", START)
+def test_taphold_tap_within_term(start):
+    out = taphold(start, ((L1, True, 0), (13, True, 50), (L1, False, 100), (13, False, 120)))
+    assert out[1] == []  # 'q' held back until the decision
+    assert out[-1] == [BS, "0" * 16, Q, "0" * 16]
+
+
+@pytest.mark.parametrize("start", START)
+def test_taphold_hold_past_term(start):
+    out = taphold(start, ((L1, True, 0), (13, True, 50), (None, None, 199), (None, None, 200),
+                          (13, False, 300), (L1, False, 310)))
+    assert out[2] == []
+    assert out[3] == ["0800000000000000", LMOD_Q]  # Decided by the timer, with both keys still down
+    assert out[-1] == ["0800000000000000", LMOD_Q, "0800000000000000", "0" * 16]
+    assert taphold(start, ((L1, True, 0), (L1, False, 300)))[-1] == []  # Held alone past the term
+
+
+@pytest.mark.parametrize("start", START)
+@pytest.mark.parametrize("permissive", (False, True))
+def test_taphold_permissive_hold(start, permissive):
+    out = taphold(start, ((L1, True, 0), (13, True, 50), (13, False, 100), (L1, False, 150)),
+                  PERMISSIVE_HOLD=permissive)
+    if permissive: assert out[2] == ["0800000000000000", LMOD_Q, "0800000000000000"]
+    else: assert out[2] == [] and out[-1] == [BS, "0" * 16, Q, "0" * 16]
+
+
+@pytest.mark.parametrize("start", START)
+@pytest.mark.parametrize("quick", (0, 150))
+def test_taphold_quick_tap_repeat(start, quick):
+    out = taphold(start, ((L1, True, 0), (L1, False, 50), (L1, True, 100), (13, True, 150), (13, False, 160),
+                          (L1, False, 400)), QUICK_TAP=quick)
+    if quick: assert out[3] == [BS, "0" * 16, BS, "0" * 16, Q]  # Tapped again at once, 'q' not delayed
+    else: assert out[-1] == [BS, "0" * 16, "0800000000000000", LMOD_Q, "0800000000000000", "0" * 16]
+
+
+def test_compiled_keymech_sends_the_same_reports():
+    import Bench
+    trace = tuple(e for t in Bench.SCENARIOS.values() for e in t)
+    def reports(compiled):
+        sim = Sim(COMPILED=compiled)
+        assert type(sim.mech) is (Ortho.CompiledKeyMech if compiled else Ortho.KeyMech)
+        states = []
+        for e in trace:
+            sim.play((e,))
+            states.append(sim.state())
+        return sim.reports, states
+    expected = reports(False)
+    assert len(expected[0]) > len(trace) // 2
+    assert reports(True) == expected
+
+
+def test_action_queue_coalesces_and_makes_room_when_full():
+    q = Ortho.ActionQueue(4)
+    P, R, RA = ActionType.PRESS, ActionType.RELEASE, ActionType.RELEASE_ALL
+    assert q.push(P, (4,)) and not q.push(P, (4,))  # Already down once the queue is sent
+    assert not q.push(R, (5,))
+    assert q.push(R, (4,)) and not q.push(RA, ())
+    assert list(q) == [(P, (4,)), (R, (4,))] and q.coalesced == 3
+    sent = []
+    q.drain(lambda t, *c: sent.append((t, c)), 5)
+    assert sent == [(P, (4,)), (R, (4,))] and not q
+    sim = Sim(OUTPUT_QUEUE=4)
+    usb = sim.usb
+    for c in range(4, 10): usb.action(P, c)
+    assert usb.pending == 4 and usb.queue.overflows == 2 and usb.queue.high_water == 4
+    assert len(sim.reports) == 2  # The oldest were sent at once to make room, none were lost
+    while usb.pending: sim.step()
+    assert sim.reports[-1] == bytes((0, 0, 4, 5, 6, 7, 8, 9))
+
+
+def test_led_state_is_queued_behind_other_actions():
+    sim = Sim()
+    usb = sim.usb
+    assert usb.action(ActionType.LED_STATE, 2) == 0  # Caps Lock on
+    assert usb.pending == 1 and not sim.reports
+    usb.action(ActionType.PRESS, 0x04)
+    assert usb.action(ActionType.LED_STATE, 0) == 2
+    while usb.pending: sim.step()
+    assert [bytes(r).hex() for r in sim.reports] == [
+        "0000390000000000", "0000000000000000", "0000040000000000", "0000043900000000", "0000000000000000"
+    ]
+    assert not usb.leds[usb.leds.CAPS_LOCK]
+
+
+def test_shards_of_strips_of_different_lengths():
+    short, long = Stubs.NeoPixel("P0", 3), Stubs.NeoPixel("P1", 5)
+    px = PixelMap((short, long), (0, 2, None, 8, 12), strip_period=8, framebuffer=True)
+    assert list(px._ps) == [0, 0, 0xFF, 1, 1] and list(px._po) == [0, 2, 0, 0, 4]
+    assert list(px._fo) == [0, 6, 0, 9, 21]  # Long strip's pixels after the short one's 3 * 3 bytes
+    px.indexing(auto_update=False)
+    px.brightness = 1.0
+    px.show()
+    Stubs.NEOPIXEL_WRITES.clear()
+    px[(4,)] = (1, 2, 3)
+    px.show()
+    assert Stubs.NEOPIXEL_WRITES == {"P1": bytes(12) + bytes((2, 1, 3))}  # GRB, and only the dirty shard
+    with pytest.raises(IndexError):
+        PixelMap((short, long), (3,))  # The short strip ends at 2 and the long one starts at 5
+
+
+def test_chord_changes_are_notified_once():
+    blue = Ortho.KEY_MAP_NULL, (0, 0, 255)
+    cm = Ortho.ChordMap((None, None, None, blue), pkeys=2)
+    calls = []
+    cm.subscribe(lambda chord, colour: calls.append((int(chord), colour)))
+    cm.current = 1
+    cm.current = 3  # Built up between frames: only the last is delivered
+    cm.notify()
+    cm.notify()
+    assert calls == [(3, (0, 0, 255))]
+    cm.current = 1
+    cm.current = 3  # Back where the subscribers last saw it
+    cm.notify()
+    assert calls == [(3, (0, 0, 255))]
+    cm.reset()
+    cm.notify()
+    assert calls == [(3, (0, 0, 255)), (0, (0, 0, 0))]
+
+
+def test_telemetry_frames_decode():
+    import Telem
+    from JH_Telem import Telemetry
+    t = Telemetry(("events", "reports"), (("latency", (1, 2, 5, 10)),))
+    t.gauge("free", lambda: -1234)
+    t.counters[t.counter("events")] += 3
+    for v in (0, 1, 3, 7, 50): t.sample(t.histogram("latency"), v)
+    data = b"\x00\xba" + bytes(t.schema(1000)) + bytes(t.frame(0x1FFFFFFF))  # Noise before the first frame
+    r = Telem.Reader(data)
+    kind, seq, ticks, payload, raw = Telem.read_frame(r.read)
+    assert (kind, seq, ticks) == (Telem.SCHEMA, 0, 1000)
+    schema = Telem.Schema(payload.decode())
+    assert schema.histograms == [("latency", (1, 2, 5, 10))]
+    kind, seq, ticks, payload, raw = Telem.read_frame(r.read)
+    assert (kind, seq, ticks) == (Telem.DATA, 1, 0x1FFFFFFF)
+    assert schema.decode(payload) == ({"events": 3, "reports": 0}, {"free": -1234}, {"latency": [1, 1, 1, 1, 1]})
+    assert Telem.read_frame(r.read) is None
+    bad = bytearray(t.frame())
+    bad[-3] ^= 1
+    with pytest.raises(ValueError):
+        Telem.read_frame(Telem.Reader(bytes(bad)).read)